@@ -3,18 +3,34 @@ Profit Sharing App - Python Backend
 Flask API server with Stellar testnet integration
 Soroban Smart Contract for automated commission distribution
 Demo for Whaleer.com profit-sharing system
+
+Deployed as a serverless function: stellar_sdk, numpy and requests are
+imported inside the functions that need them so that cold starts of cheap
+routes (/health, /bots, /contract-info) only pay for Flask.
+See benchmarks/cold_start.py.
 """
 
-from flask import Flask, request, jsonify
+from __future__ import annotations
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from stellar_sdk import Keypair, Server, TransactionBuilder, Network, Asset
-from stellar_sdk import SorobanServer, scval
-from stellar_sdk.soroban_rpc import GetTransactionStatus
-from stellar_sdk.exceptions import NotFoundError, BadRequestError
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from heapq import heapify, heappop, heappush
 from decimal import Decimal
-import random
+from functools import wraps
+from typing import TYPE_CHECKING
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
 import time
-import requests
+
+if TYPE_CHECKING:
+    import numpy as np
 
 # ============== XLM PRICE CACHE ==============
 xlm_price_cache = {
@@ -22,6 +38,178 @@ xlm_price_cache = {
     'last_updated': 0
 }
 
+# TWAP window used when converting USD profit to XLM commission
+XLM_TWAP_WINDOW_SECONDS = float(os.getenv("WHALEER_XLM_TWAP_WINDOW_SECONDS", "900"))
+XLM_PRICE_BUFFER_SIZE = int(os.getenv("WHALEER_XLM_PRICE_BUFFER_SIZE", "4096"))
+XLM_PRICE_LOG_PATH = os.getenv("WHALEER_XLM_PRICE_LOG_PATH")  # optional "timestamp,price" tick log
+# Log is compacted to the last XLM_PRICE_BUFFER_SIZE ticks once it passes this size
+XLM_PRICE_LOG_MAX_BYTES = int(os.getenv("WHALEER_XLM_PRICE_LOG_MAX_BYTES", str(1024 * 1024)))
+# Warm start reads only the log tail covering this much history (largest TWAP window worth restoring)
+XLM_PRICE_WARM_START_SECONDS = max(
+    float(os.getenv("WHALEER_XLM_PRICE_WARM_START_SECONDS", "86400")), XLM_TWAP_WINDOW_SECONDS
+)
+PRICE_LOG_BLOCK_SIZE = 64 * 1024
+
+
+class PriceRingBuffer:
+    """
+    Fixed-capacity ring of (timestamp, price) ticks.
+    Each slot also stores the running time-integral of price up to that tick,
+    so appending is O(1) and a TWAP is the difference of two integrals
+    (the window start is located with a binary search over the ring).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = [0.0] * capacity
+        self.prices = [0.0] * capacity
+        self.integrals = [0.0] * capacity
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp: float, price: float):
+        with self.lock:
+            if self.count:
+                last = (self.count - 1) % self.capacity
+                if timestamp <= self.timestamps[last]:
+                    return False  # Out-of-order tick
+                integral = self.integrals[last] + self.prices[last] * (timestamp - self.timestamps[last])
+            else:
+                integral = 0.0
+
+            slot = self.count % self.capacity
+            self.timestamps[slot] = timestamp
+            self.prices[slot] = price
+            self.integrals[slot] = integral
+            self.count += 1
+            return True
+
+    def _slot(self, logical_index: int):
+        return logical_index % self.capacity
+
+    def _integral_at(self, t: float, first: int):
+        """Integral up to time t (t must be >= the oldest retained tick)"""
+        lo, hi = first, self.count - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.timestamps[self._slot(mid)] <= t:
+                lo = mid
+            else:
+                hi = mid - 1
+        slot = self._slot(lo)
+        return self.integrals[slot] + self.prices[slot] * (t - self.timestamps[slot])
+
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            return self.prices[self._slot(self.count - 1)]
+
+    def twap(self, window_seconds: float, now: float = None):
+        """Time-weighted average price over the last window_seconds (None if empty)"""
+        with self.lock:
+            if not self.count:
+                return None
+            now = time.time() if now is None else now
+            first = max(0, self.count - self.capacity)
+            last_slot = self._slot(self.count - 1)
+            start = max(now - window_seconds, self.timestamps[self._slot(first)])
+            if now <= start:
+                return self.prices[last_slot]
+            end_integral = self.integrals[last_slot] + self.prices[last_slot] * (now - self.timestamps[last_slot])
+            return (end_integral - self._integral_at(start, first)) / (now - start)
+
+    def ticks(self, since: float = None):
+        """Retained ticks in time order, optionally only those after `since`"""
+        with self.lock:
+            first = max(0, self.count - self.capacity)
+            series = [
+                (self.timestamps[self._slot(i)], self.prices[self._slot(i)])
+                for i in range(first, self.count)
+            ]
+        if since is not None:
+            series = [tick for tick in series if tick[0] > since]
+        return series
+
+
+def load_price_ticks(path: str, limit: int = None, since: float = None):
+    """
+    Read a "timestamp,price" tick log (for warm start and offline replays).
+    With limit/since the file is read backwards block by block and only the
+    tail is parsed: the last `limit` ticks, or back to the first tick at or
+    before `since` (the price in force when the window opens).
+    """
+    ticks = []
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        carry = b""
+        while position > 0:
+            size = min(PRICE_LOG_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + carry).split(b"\n")
+            carry = lines.pop(0) if position else b""  # Blok başındaki satır yarım olabilir
+            for line in reversed(lines):
+                try:
+                    timestamp, price = line.strip().split(b",")
+                    ticks.append((float(timestamp), float(price)))
+                except ValueError:
+                    continue
+                if (limit and len(ticks) >= limit) or (since is not None and ticks[-1][0] <= since):
+                    ticks.reverse()
+                    return ticks
+    ticks.reverse()
+    return ticks
+
+
+xlm_price_ticks = PriceRingBuffer(XLM_PRICE_BUFFER_SIZE)
+if XLM_PRICE_LOG_PATH and os.path.exists(XLM_PRICE_LOG_PATH):
+    for _timestamp, _price in load_price_ticks(
+        XLM_PRICE_LOG_PATH, XLM_PRICE_BUFFER_SIZE, since=time.time() - XLM_PRICE_WARM_START_SECONDS
+    ):
+        xlm_price_ticks.append(_timestamp, _price)
+
+
+def _open_price_log():
+    """Open the tick log for append under flock; reopens if another shard compacted it meanwhile"""
+    import fcntl
+
+    while True:
+        f = open(XLM_PRICE_LOG_PATH, "a")
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(XLM_PRICE_LOG_PATH).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()  # Kilidi beklerken dosya değiştirildi, yenisini aç
+
+
+def compact_price_log():
+    """Keep only the ticks a warm start can use; caller holds the log's flock"""
+    ticks = load_price_ticks(XLM_PRICE_LOG_PATH, XLM_PRICE_BUFFER_SIZE)
+    tmp_path = XLM_PRICE_LOG_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(f"{timestamp},{price}\n" for timestamp, price in ticks)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, XLM_PRICE_LOG_PATH)
+    print(f"[XLM PRICE] Tick log compacted to {len(ticks)} ticks")
+
+
+def record_price_tick(price: float, timestamp: float = None):
+    timestamp = time.time() if timestamp is None else timestamp
+    if xlm_price_ticks.append(timestamp, price) and XLM_PRICE_LOG_PATH:
+        try:
+            with _open_price_log() as f:
+                f.write(f"{timestamp},{price}\n")
+                f.flush()
+                if f.tell() > XLM_PRICE_LOG_MAX_BYTES:
+                    compact_price_log()
+        except OSError as e:
+            print(f"[XLM PRICE] Tick log write failed: {e}")
+
+
 def get_xlm_usd_price():
     """Fetch real-time XLM/USD price from CoinGecko API with 60s cache"""
     global xlm_price_cache
@@ -31,6 +219,8 @@ def get_xlm_usd_price():
         return xlm_price_cache['price']
     
     try:
+        import requests
+        
         # CoinGecko free API - no key needed
         response = requests.get(
             'https://api.coingecko.com/api/v3/simple/price',
@@ -42,6 +232,7 @@ def get_xlm_usd_price():
             price = data.get('stellar', {}).get('usd', 0.40)
             xlm_price_cache['price'] = price
             xlm_price_cache['last_updated'] = time.time()
+            record_price_tick(price, xlm_price_cache['last_updated'])
             print(f"[XLM PRICE] Updated: ${price:.4f}")
             return price
     except Exception as e:
@@ -50,17 +241,42 @@ def get_xlm_usd_price():
     # Return cached or fallback price
     return xlm_price_cache['price']
 
+
+def get_xlm_usd_twap(window_seconds: float = None):
+    """XLM/USD time-weighted average over the window (falls back to spot)"""
+    spot = get_xlm_usd_price()
+    twap = xlm_price_ticks.twap(window_seconds or XLM_TWAP_WINDOW_SECONDS)
+    return twap if twap else spot
+
 app = Flask(__name__)
 CORS(app)
 
 # Stellar Testnet Configuration
 HORIZON_URL = "https://horizon-testnet.stellar.org"
 SOROBAN_RPC_URL = "https://soroban-testnet.stellar.org"
-NETWORK_PASSPHRASE = Network.TESTNET_NETWORK_PASSPHRASE
+NETWORK_PASSPHRASE = "Test SDF Network ; September 2015"  # Network.TESTNET_NETWORK_PASSPHRASE
+
+# Stellar servers are created on first use (keeps stellar_sdk out of cold start)
+stellar_clients = {}
+stellar_clients_lock = threading.Lock()
 
-# Initialize Stellar servers
-server = Server(horizon_url=HORIZON_URL)
-soroban_server = SorobanServer(SOROBAN_RPC_URL)
+
+def get_horizon_server():
+    if 'horizon' not in stellar_clients:
+        with stellar_clients_lock:
+            if 'horizon' not in stellar_clients:
+                from stellar_sdk import Server
+                stellar_clients['horizon'] = Server(horizon_url=HORIZON_URL)
+    return stellar_clients['horizon']
+
+
+def get_soroban_server():
+    if 'soroban' not in stellar_clients:
+        with stellar_clients_lock:
+            if 'soroban' not in stellar_clients:
+                from stellar_sdk import SorobanServer
+                stellar_clients['soroban'] = SorobanServer(SOROBAN_RPC_URL)
+    return stellar_clients['soroban']
 
 # ============== SOROBAN CONTRACT CONFIG ==============
 # Developer wallet that receives profit commissions
@@ -76,8 +292,10 @@ CONTRACT_ID = "CBEZLTP6IW3KETVKHHQIZP6MV4N5ROD3O2YMXE3WPDBHWYO53UBDJDFI"
 # Native XLM Asset ID on Soroban
 NATIVE_ASSET_ID = "CDLZFC3SYJYDZT7K67VZ75HPJVIEUVNIXF47ZG2FB2RMQQVU2HHGCYSC"
 
-# In-memory storage
-user_sessions = {}
+# In-memory storage (bounded, see SESSION CACHE below)
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("WHALEER_SESSION_CACHE_MAX_ENTRIES", "10000"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("WHALEER_SESSION_IDLE_TTL_SECONDS", "86400"))
+SESSION_SPILL_PATH = os.getenv("WHALEER_SESSION_SPILL_PATH")  # optional shelve file for evicted sessions
 
 # Trading Bots Configuration
 # total_commission_rate: Percentage of profit taken as total commission
@@ -93,6 +311,7 @@ TRADING_BOTS = [
         "min_commission_deposit": 10,
         "developer": DEVELOPER_PUBLIC_KEY,
         "platform": PLATFORM_PUBLIC_KEY,
+        "engine": {"type": "ema_crossover", "fast": 12, "slow": 26, "leverage": 1.5, "cost_bps": 10},
     },
     {
         "id": "bot-beta",
@@ -103,6 +322,7 @@ TRADING_BOTS = [
         "min_commission_deposit": 5,
         "developer": DEVELOPER_PUBLIC_KEY,
         "platform": PLATFORM_PUBLIC_KEY,
+        "engine": {"type": "arbitrage", "entry_spread_bps": 25, "utilization": 2.0, "cost_bps": 8},
     },
     {
         "id": "bot-gamma",
@@ -113,6 +333,7 @@ TRADING_BOTS = [
         "min_commission_deposit": 5,
         "developer": DEVELOPER_PUBLIC_KEY,
         "platform": PLATFORM_PUBLIC_KEY,
+        "engine": {"type": "dca", "cycle_days": 60, "interval_days": 5, "dip_percent": 3, "leverage": 1.0, "cost_bps": 10},
     },
 ]
 
@@ -129,18 +350,424 @@ def get_user_hash(user_public_key: str) -> int:
     """Create a consistent user ID from public key"""
     return hash(user_public_key) % 1000000
 
-def get_user_session(user_public_key):
-    """Get or create user session"""
-    if user_public_key not in user_sessions:
-        user_sessions[user_public_key] = {
-            "public_key": user_public_key,
-            "active_bots": {}
+def get_user_session(user_public_key, create: bool = False):
+    """
+    Get user session. Read paths never allocate: unknown keys get a transient
+    empty session that is not stored. Only create=True (a confirmed deposit)
+    inserts a new entry.
+    """
+    if create:
+        return user_sessions.get_or_create(user_public_key)
+    return user_sessions.get(user_public_key) or new_user_session(user_public_key)
+
+def new_user_session(user_public_key):
+    return {
+        "public_key": user_public_key,
+        "active_bots": {}
+    }
+
+# ============== SESSION CACHE ==============
+
+def estimate_size(obj, seen=None) -> int:
+    """Approximate deep size in bytes of dicts/lists/scalars"""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(estimate_size(item, seen) for item in obj)
+    return size
+
+
+class SessionCache:
+    """
+    User sessions keyed by public key with LRU + idle-TTL eviction.
+    
+    - The OrderedDict is kept in access order, so both idle and LRU victims
+      are found at the front in O(1).
+    - Sessions with active bots hold commission balances and vault
+      accounting, so they are only evicted when they can be spilled to the
+      optional shelve store; without one they stay in memory even past
+      max_entries (counted in "over_capacity"). The first eviction scan that
+      meets such a session moves it to a separate pinned dict, so later
+      scans never walk past it; it returns to the LRU once it has no active
+      bots (on access, or on the periodic pinned re-check).
+    - on_evict(key, session) runs for every session leaving memory and
+      on_restore(key, session) for every spilled session coming back, so the
+      revenue aggregates track exactly the sessions held in memory.
+    - get() never inserts: unknown keys cost nothing.
+    """
+
+    def __init__(self, max_entries: int, idle_ttl: float, spill_path: str = None,
+                 on_evict=None, on_restore=None):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.spill_path = spill_path
+        self.on_evict = on_evict
+        self.on_restore = on_restore
+        self.entries = OrderedDict()  # public_key -> [session, last_access]
+        self.pinned = {}              # Aktif bot'lu, spill edilemeyen oturumlar (LRU taramasının dışında)
+        self.pinned_checked_at = 0.0
+        self.lock = threading.RLock()
+        self.store = None
+        self.counters = {
+            "hits": 0, "misses": 0, "created": 0,
+            "evicted_idle": 0, "evicted_lru": 0, "over_capacity": 0,
+            "spilled": 0, "restored": 0,
         }
-    return user_sessions[user_public_key]
 
-def generate_daily_performance():
-    """Generate random daily performance between -3% and +5%"""
-    return round(random.uniform(-3.0, 5.0), 2)
+    def _get_store(self):
+        if self.store is None and self.spill_path:
+            import shelve
+            self.store = shelve.open(self.spill_path)
+        return self.store
+
+    def _touch(self, key, entry, now):
+        entry[1] = now
+        self.entries.move_to_end(key)
+
+    def get(self, key):
+        """Existing session (memory or spill store) or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.counters['hits'] += 1
+                self._touch(key, entry, now)
+                return entry[0]
+
+            entry = self.pinned.get(key)
+            if entry is not None:
+                self.counters['hits'] += 1
+                entry[1] = now
+                if not entry[0]['active_bots']:
+                    self.entries[key] = self.pinned.pop(key)  # Tekrar evict edilebilir
+                return entry[0]
+
+            store = self._get_store()
+            if store is not None and key in store:
+                session = self._restore(key, store)
+                self.entries[key] = [session, now]
+                self._evict(now, keep=key)
+                return session
+
+            self.counters['misses'] += 1
+            return None
+
+    def get_or_create(self, key):
+        with self.lock:
+            session = self.get(key)
+            if session is None:
+                session = new_user_session(key)
+                self.entries[key] = [session, time.time()]
+                self.counters['created'] += 1
+                self._evict(time.time(), keep=key)
+            return session
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None) or self.pinned.pop(key, None)
+            if entry is not None:
+                return entry[0]
+            store = self._get_store()
+            if store is not None and key in store:
+                return self._restore(key, store)  # Çağıran (export) aggregates'ten kendisi düşer
+            return default
+
+    def put(self, key, session):
+        with self.lock:
+            self.pinned.pop(key, None)
+            self.entries[key] = [session, time.time()]
+            self.entries.move_to_end(key)
+            self._evict(time.time(), keep=key)
+
+    def keys(self):
+        with self.lock:
+            keys = list(self.entries) + list(self.pinned)
+            store = self._get_store()
+            if store is not None:
+                keys.extend(store.keys())
+            return keys
+
+    def __contains__(self, key):
+        with self.lock:
+            store = self._get_store()
+            return key in self.entries or key in self.pinned or (store is not None and key in store)
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    def _restore(self, key, store):
+        session = store.pop(key)
+        self.counters['restored'] += 1
+        if self.on_restore:
+            self.on_restore(key, session)
+        return session
+
+    def _remove(self, key, session, reason: str):
+        """Caller guarantees the session has no active bots or a spill store exists"""
+        del self.entries[key]
+        if session['active_bots']:
+            self._get_store()[key] = session
+            self.counters['spilled'] += 1
+        self.counters[reason] += 1
+        if self.on_evict:
+            self.on_evict(key, session)
+
+    PINNED_RECHECK_SECONDS = 60
+
+    def _pin(self, keys):
+        for key in keys:
+            self.pinned[key] = self.entries.pop(key)
+
+    def _unpin_released(self, now: float):
+        """Pinned sessions whose bots were all withdrawn go back to the LRU front (at most once a minute)"""
+        if now - self.pinned_checked_at < self.PINNED_RECHECK_SECONDS:
+            return
+        self.pinned_checked_at = now
+        for key in [key for key, (session, _) in self.pinned.items() if not session['active_bots']]:
+            self.entries[key] = self.pinned.pop(key)
+            self.entries.move_to_end(key, last=False)
+
+    def _evict(self, now: float, keep=None):
+        """keep: the key just inserted/returned to the caller, never evicted here"""
+        spillable = self._get_store() is not None
+        if not spillable:
+            self._unpin_released(now)
+
+        # Idle: baştan (en eski erişim) TTL'i geçenleri topla; ilk taze kayıtta dur.
+        # Spill store yoksa aktif bot'lu oturumlar pinned'e taşınır, bir daha taranmaz.
+        victims, pins = [], []
+        for key, (session, last_access) in self.entries.items():
+            if now - last_access < self.idle_ttl:
+                break
+            if spillable or not session['active_bots']:
+                victims.append((key, session))
+            else:
+                pins.append(key)
+        for key, session in victims:
+            self._remove(key, session, "evicted_idle")
+        self._pin(pins)
+
+        # Capacity: LRU; aktif bot'lu oturumlar asla düşürülmez (pinned'e taşınır)
+        excess = len(self.entries) + len(self.pinned) - self.max_entries
+        if excess <= 0:
+            return
+        victims, pins = [], []
+        for key, (session, _) in self.entries.items():
+            if key == keep:
+                continue
+            if spillable or not session['active_bots']:
+                victims.append((key, session))
+                if len(victims) == excess:
+                    break
+            else:
+                pins.append(key)
+        for key, session in victims:
+            self._remove(key, session, "evicted_lru")
+        self._pin(pins)
+        if len(victims) < excess:
+            self.counters['over_capacity'] += 1
+
+    def sweep(self):
+        with self.lock:
+            self._evict(time.time())
+
+    def stats(self):
+        with self.lock:
+            self._evict(time.time())
+            store = self._get_store()
+            entries = list(self.entries.values()) + list(self.pinned.values())
+            return {
+                "entries": len(entries),
+                "pinned_entries": len(self.pinned),
+                "max_entries": self.max_entries,
+                "idle_ttl_seconds": self.idle_ttl,
+                "active_bot_sessions": sum(1 for session, _ in entries if session['active_bots']),
+                "approx_memory_bytes": estimate_size([entry[0] for entry in entries]),
+                "spilled_entries": len(store) if store is not None else 0,
+                **self.counters,
+            }
+
+
+def drop_session_events(public_key: str):
+    """Forget a wallet's event log; open streams end and their clients reconnect"""
+    with session_events_lock:
+        log = session_events.pop(public_key, None)
+        if log is not None:
+            log['closed'] = True
+            log['cond'].notify_all()
+
+
+def _session_evicted(public_key: str, session: dict):
+    """A session left memory (spilled or idle): same bookkeeping as /admin/sessions/export"""
+    for bot_id in session['active_bots']:
+        record_subscription_change(bot_id, public_key, -1)
+    drop_session_events(public_key)
+
+
+def _session_restored(public_key: str, session: dict):
+    """A spilled session came back: same bookkeeping as /admin/sessions/import"""
+    for bot_id, bot_data in session['active_bots'].items():
+        record_subscription_change(bot_id, public_key, +1, bot_data['total_profit'])
+
+
+user_sessions = SessionCache(
+    SESSION_CACHE_MAX_ENTRIES,
+    SESSION_IDLE_TTL_SECONDS,
+    SESSION_SPILL_PATH,
+    on_evict=_session_evicted,
+    on_restore=_session_restored,
+)
+
+def generate_daily_performance(bot_id: str, day: int):
+    """Daily performance (%) of a bot's backtest on the given simulation day"""
+    returns = get_strategy_returns(bot_id)
+    return float(returns[day % len(returns)])
+
+# ============== STRATEGY ENGINE ==============
+# Daily bot returns come from a vectorised backtest over a local daily price
+# series (WHALEER_PRICE_HISTORY_PATH, one close per line) or, when no file is
+# configured, a seeded synthetic series. Results are cached per bot, so the
+# same bot replays the same path across sessions and restarts.
+STRATEGY_SEED = int(os.getenv("WHALEER_STRATEGY_SEED", "1592"))
+PRICE_HISTORY_PATH = os.getenv("WHALEER_PRICE_HISTORY_PATH")
+SYNTHETIC_HISTORY_DAYS = 365
+EMA_CHUNK_SIZE = 128
+
+strategy_return_cache = {}
+price_history_cache = {}
+
+
+def _np():
+    """NumPy, imported on first use so cold starts of cheap routes never load it"""
+    import numpy
+
+    return numpy
+
+
+def load_price_history():
+    """Daily close prices for the backtest (file or seeded synthetic GBM)"""
+    np = _np()
+
+    if 'close' in price_history_cache:
+        return price_history_cache['close']
+
+    if PRICE_HISTORY_PATH:
+        close = np.loadtxt(PRICE_HISTORY_PATH, delimiter=",", usecols=-1, ndmin=1, comments="#")
+    else:
+        rng = np.random.default_rng(STRATEGY_SEED)
+        log_returns = rng.normal(0.0015, 0.025, SYNTHETIC_HISTORY_DAYS)
+        close = 0.40 * np.exp(np.cumsum(log_returns))
+
+    price_history_cache['close'] = close
+    return close
+
+
+def ema(values: np.ndarray, window: int):
+    """
+    Exponential moving average without a Python loop per element.
+    Uses the closed form ema_j = (1-a)^(j+1) * carry + a * (1-a)^j * cumsum(x_k * (1-a)^-k)
+    on fixed-size chunks so the scaling factors stay inside float64 range.
+    """
+    np = _np()
+
+    alpha = 2.0 / (window + 1)
+    decay = 1.0 - alpha
+    out = np.empty_like(values, dtype=float)
+    carry = float(values[0])
+
+    for start in range(0, len(values), EMA_CHUNK_SIZE):
+        chunk = values[start:start + EMA_CHUNK_SIZE]
+        powers = decay ** np.arange(len(chunk))
+        weighted = np.cumsum(chunk / powers)
+        out[start:start + len(chunk)] = decay * powers * carry + alpha * powers * weighted
+        carry = out[start + len(chunk) - 1]
+
+    return out
+
+
+def ema_crossover_returns(close: np.ndarray, params: dict):
+    """Long when fast EMA > slow EMA (decided on yesterday's close), flat otherwise"""
+    np = _np()
+
+    asset_returns = np.diff(close) / close[:-1]
+    position = (ema(close, params['fast']) > ema(close, params['slow'])).astype(float)[:-1]
+    turnover = np.abs(np.diff(position, prepend=0.0))
+    cost = params['cost_bps'] / 10_000
+    return params['leverage'] * position * asset_returns - turnover * cost
+
+
+def arbitrage_returns(close: np.ndarray, params: dict, rng: np.random.Generator):
+    """Capture the cross-exchange spread whenever it exceeds the entry threshold"""
+    np = _np()
+
+    days = len(close) - 1
+    # İkinci borsa fiyatı: volatiliteyle büyüyen spread gürültüsü
+    volatility = np.abs(np.diff(np.log(close)))
+    spread = np.abs(rng.normal(0.0, 0.002, days) + rng.normal(0.0, 0.2, days) * volatility)
+    slippage = rng.normal(0.0, 0.001, days)
+    entry = params['entry_spread_bps'] / 10_000
+    cost = 2 * params['cost_bps'] / 10_000  # iki bacak: al + sat
+    captured = np.where(spread > entry, spread - cost + slippage, 0.0)
+    return params['utilization'] * captured
+
+
+def dca_returns(close: np.ndarray, params: dict):
+    """
+    Buy one installment every interval_days (plus an extra one on dips),
+    holding until the cycle ends, then start a new cycle from cash.
+    """
+    np = _np()
+
+    asset_returns = np.diff(close) / close[:-1]
+    days = np.arange(len(asset_returns))
+    day_in_cycle = days % params['cycle_days']
+    installments = params['cycle_days'] // params['interval_days']
+
+    scheduled = (day_in_cycle % params['interval_days'] == 0).astype(float)
+    dip = (asset_returns < -params['dip_percent'] / 100).astype(float)
+    buys = scheduled + np.concatenate(([0.0], dip[:-1]))
+
+    # Döngü başına kümülatif alım (her döngü başında sıfırlanır)
+    cumulative = np.cumsum(buys)
+    cycle_start = days - day_in_cycle
+    bought = cumulative - np.concatenate(([0.0], cumulative))[cycle_start]
+    exposure = np.minimum(bought / installments, 1.0)
+
+    cost = params['cost_bps'] / 10_000
+    held = np.concatenate(([0.0], exposure[:-1]))
+    traded = np.abs(np.diff(exposure, prepend=0.0))
+    return params['leverage'] * held * asset_returns - traded * cost
+
+
+STRATEGY_ENGINES = {
+    "ema_crossover": lambda close, params, rng: ema_crossover_returns(close, params),
+    "arbitrage": arbitrage_returns,
+    "dca": lambda close, params, rng: dca_returns(close, params),
+}
+
+
+def get_strategy_returns(bot_id: str):
+    """Precomputed daily returns (%) for a bot, computed once per process"""
+    np = _np()
+
+    returns = strategy_return_cache.get(bot_id)
+    if returns is not None:
+        return returns
+
+    bot = TRADING_BOTS[get_bot_index(bot_id)]
+    engine = bot['engine']
+    rng = np.random.default_rng([STRATEGY_SEED, get_bot_index(bot_id)])
+    daily = STRATEGY_ENGINES[engine['type']](load_price_history(), engine, rng)
+
+    returns = np.round(daily * 100, 2)
+    strategy_return_cache[bot_id] = returns
+    return returns
+
 
 def calculate_contract_rates(total_commission_rate: float, platform_cut_percent: float):
     """
@@ -160,6 +787,29 @@ def calculate_contract_rates(total_commission_rate: float, platform_cut_percent:
     
     return profit_share_bps, platform_cut_bps
 
+def calculate_commission(taxable_profit_xlm, commission_balance, total_commission_rate, platform_cut_percent):
+    """
+    Commission on profit above the HWM, capped by the remaining commission balance.
+    Works on floats and on NumPy arrays (used by the forecast paths).
+    
+    Returns (taxable_profit_xlm, total_commission_xlm, platform_xlm, developer_xlm);
+    when the balance is insufficient the taxable profit is reduced by the same ratio.
+    """
+    np = _np()
+
+    total_commission_xlm = taxable_profit_xlm * (total_commission_rate / 100)
+    insufficient = total_commission_xlm > commission_balance
+    ratio = np.where(
+        insufficient,
+        commission_balance / np.where(total_commission_xlm > 0, total_commission_xlm, 1),
+        1.0,
+    )
+    taxable_profit_xlm = taxable_profit_xlm * ratio
+    total_commission_xlm = np.minimum(total_commission_xlm, commission_balance)
+    platform_commission_xlm = total_commission_xlm * (platform_cut_percent / 100)
+    developer_commission_xlm = total_commission_xlm - platform_commission_xlm
+    return taxable_profit_xlm, total_commission_xlm, platform_commission_xlm, developer_commission_xlm
+
 # ============== SOROBAN CONTRACT FUNCTIONS ==============
 
 def invoke_contract_with_simulation(function_name: str, params: list, signer_secret: str):
@@ -167,11 +817,14 @@ def invoke_contract_with_simulation(function_name: str, params: list, signer_sec
     Invoke Soroban contract with simulation first.
     Simulates transaction, logs errors, then submits.
     """
+    from stellar_sdk import Keypair, TransactionBuilder
+    from stellar_sdk.soroban_rpc import GetTransactionStatus
+    
     try:
         signer_keypair = Keypair.from_secret(signer_secret)
         
         # Load account from Horizon for sequence number
-        source_account = server.load_account(signer_keypair.public_key)
+        source_account = get_horizon_server().load_account(signer_keypair.public_key)
         
         tx = (
             TransactionBuilder(
@@ -190,7 +843,7 @@ def invoke_contract_with_simulation(function_name: str, params: list, signer_sec
         
         # Simulate transaction first
         print(f"⏳ Simulating: {function_name}...")
-        sim_resp = soroban_server.simulate_transaction(tx)
+        sim_resp = get_soroban_server().simulate_transaction(tx)
         
         # Check simulation errors
         if hasattr(sim_resp, 'error') and sim_resp.error:
@@ -200,14 +853,14 @@ def invoke_contract_with_simulation(function_name: str, params: list, signer_sec
         print(f"✅ Simulation successful!")
         
         # Prepare transaction with simulation data
-        tx = soroban_server.prepare_transaction(tx, sim_resp)
+        tx = get_soroban_server().prepare_transaction(tx, sim_resp)
         
         # Sign transaction
         tx.sign(signer_keypair)
         
         # Submit to network
         print(f"🚀 Submitting to network: {function_name}...")
-        response = soroban_server.send_transaction(tx)
+        response = get_soroban_server().send_transaction(tx)
         
         if hasattr(response, 'status') and response.status == "ERROR":
             raise RuntimeError(f"Transaction Failed: {response}")
@@ -217,7 +870,7 @@ def invoke_contract_with_simulation(function_name: str, params: list, signer_sec
         tx_hash = response.hash
         for _ in range(30):
             time.sleep(1)
-            result = soroban_server.get_transaction(tx_hash)
+            result = get_soroban_server().get_transaction(tx_hash)
             if result.status == GetTransactionStatus.SUCCESS:
                 print(f"✅ [CONTRACT] {function_name} SUCCESS!")
                 return result
@@ -232,43 +885,62 @@ def invoke_contract_with_simulation(function_name: str, params: list, signer_sec
         return None
 
 
+def prepare_contract_call(function_name: str, params: list, signer_secret: str):
+    """Build, prepare (simulate) and sign a contract call without submitting it"""
+    from stellar_sdk import Keypair, TransactionBuilder
+    
+    signer_keypair = Keypair.from_secret(signer_secret)
+    source_account = get_soroban_server().load_account(signer_keypair.public_key)
+    
+    tx = (
+        TransactionBuilder(
+            source_account=source_account,
+            network_passphrase=NETWORK_PASSPHRASE,
+            base_fee=100000,
+        )
+        .append_invoke_contract_function_op(
+            contract_id=CONTRACT_ID,
+            function_name=function_name,
+            parameters=params,
+        )
+        .set_timeout(300)
+        .build()
+    )
+    
+    tx = get_soroban_server().prepare_transaction(tx)
+    tx.sign(signer_keypair)
+    return tx
+
+
+def poll_transaction(tx_hash: str, attempts: int = 30):
+    """Poll get_transaction until SUCCESS / FAILED; returns (status, result)"""
+    from stellar_sdk.soroban_rpc import GetTransactionStatus
+    
+    result = None
+    for _ in range(attempts):
+        time.sleep(1)
+        result = get_soroban_server().get_transaction(tx_hash)
+        if result.status != GetTransactionStatus.NOT_FOUND:
+            break
+    return result.status, result
+
+
 def invoke_contract(function_name: str, params: list, signer_secret: str):
     """Generic function to invoke Soroban smart contract methods"""
+    from stellar_sdk.soroban_rpc import GetTransactionStatus
+    
     try:
-        signer_keypair = Keypair.from_secret(signer_secret)
-        source_account = soroban_server.load_account(signer_keypair.public_key)
-        
-        tx = (
-            TransactionBuilder(
-                source_account=source_account,
-                network_passphrase=NETWORK_PASSPHRASE,
-                base_fee=100000,
-            )
-            .append_invoke_contract_function_op(
-                contract_id=CONTRACT_ID,
-                function_name=function_name,
-                parameters=params,
-            )
-            .set_timeout(300)
-            .build()
-        )
-        
-        tx = soroban_server.prepare_transaction(tx)
-        tx.sign(signer_keypair)
-        response = soroban_server.send_transaction(tx)
+        tx = prepare_contract_call(function_name, params, signer_secret)
+        response = get_soroban_server().send_transaction(tx)
         
         print(f"[CONTRACT] {function_name} submitted: {response.hash}")
         
-        tx_hash = response.hash
-        for _ in range(30):
-            time.sleep(1)
-            result = soroban_server.get_transaction(tx_hash)
-            if result.status == GetTransactionStatus.SUCCESS:
-                print(f"[CONTRACT] {function_name} SUCCESS!")
-                return result
-            elif result.status == GetTransactionStatus.FAILED:
-                print(f"[CONTRACT] {function_name} FAILED")
-                return None
+        status, result = poll_transaction(response.hash)
+        if status == GetTransactionStatus.SUCCESS:
+            print(f"[CONTRACT] {function_name} SUCCESS!")
+            return result
+        elif status == GetTransactionStatus.FAILED:
+            print(f"[CONTRACT] {function_name} FAILED")
         
         return None
         
@@ -293,6 +965,8 @@ def contract_init_vault(
     - Platform: 1 XLM (10% of commission)
     - Developer: 9 XLM (remaining)
     """
+    from stellar_sdk import scval
+    
     # Calculate rates for display
     platform_rate = total_commission_rate * platform_cut_percent / 100
     developer_net = total_commission_rate - platform_rate
@@ -341,10 +1015,12 @@ def contract_deposit(bot_id: int, user_id: int, amount_xlm: float, user_public_k
     Create contract deposit XDR for user to sign
     Returns XDR that frontend will sign with Freighter
     """
+    from stellar_sdk import TransactionBuilder, scval
+    
     try:
         amount_stroops = int(amount_xlm * 10_000_000)
         
-        source_account = soroban_server.load_account(user_public_key)
+        source_account = get_soroban_server().load_account(user_public_key)
         
         params = [
             scval.to_uint64(bot_id),
@@ -367,7 +1043,7 @@ def contract_deposit(bot_id: int, user_id: int, amount_xlm: float, user_public_k
             .build()
         )
         
-        tx = soroban_server.prepare_transaction(tx)
+        tx = get_soroban_server().prepare_transaction(tx)
         
         print(f"[CONTRACT] Deposit XDR created: {amount_xlm} XLM")
         return tx.to_xdr(), None
@@ -379,10 +1055,12 @@ def contract_deposit(bot_id: int, user_id: int, amount_xlm: float, user_public_k
 
 def contract_withdraw(bot_id: int, user_id: int, amount_xlm: float, user_public_key: str):
     """Create contract withdraw XDR for user to sign"""
+    from stellar_sdk import TransactionBuilder, scval
+    
     try:
         amount_stroops = int(amount_xlm * 10_000_000)
         
-        source_account = soroban_server.load_account(user_public_key)
+        source_account = get_soroban_server().load_account(user_public_key)
         
         params = [
             scval.to_uint64(bot_id),
@@ -405,7 +1083,7 @@ def contract_withdraw(bot_id: int, user_id: int, amount_xlm: float, user_public_
             .build()
         )
         
-        tx = soroban_server.prepare_transaction(tx)
+        tx = get_soroban_server().prepare_transaction(tx)
         
         print(f"[CONTRACT] Withdraw XDR created: {amount_xlm} XLM")
         return tx.to_xdr(), None
@@ -417,7 +1095,9 @@ def contract_withdraw(bot_id: int, user_id: int, amount_xlm: float, user_public_
 
 def contract_settle_profit(bot_id: int, user_id: int, profit_xlm: float):
     """
-    Settle profit - contract sends commission to developer and platform.
+    Build the signed settle_profit transaction - contract sends commission to
+    developer and platform. The settlement worker submits it, so the tx hash
+    can be written to the outbox before anything reaches the network.
     
     Contract'taki hesaplama:
     - total_commission = profit_amount * profit_share_bps / 10000
@@ -429,6 +1109,8 @@ def contract_settle_profit(bot_id: int, user_id: int, profit_xlm: float):
     - platform_fee = 30 * 1000 / 10000 = 3 XLM
     - dev_fee = 30 - 3 = 27 XLM
     """
+    from stellar_sdk import scval
+    
     profit_stroops = int(profit_xlm * 10_000_000)
     
     if profit_stroops <= 0:
@@ -441,23 +1123,29 @@ def contract_settle_profit(bot_id: int, user_id: int, profit_xlm: float):
     ]
     
     print(f"[CONTRACT] Settling profit: {profit_xlm} XLM (profit amount, not commission)")
-    return invoke_contract("settle_profit", params, PLATFORM_SECRET_KEY)
+    return prepare_contract_call("settle_profit", params, PLATFORM_SECRET_KEY)
 
 
 def submit_signed_tx(signed_xdr: str):
     """Submit a signed Soroban transaction"""
     try:
         from stellar_sdk import TransactionEnvelope
+        from stellar_sdk.soroban_rpc import GetTransactionStatus, SendTransactionStatus
         
         tx = TransactionEnvelope.from_xdr(signed_xdr, network_passphrase=NETWORK_PASSPHRASE)
-        response = soroban_server.send_transaction(tx)
+        response = get_soroban_server().send_transaction(tx)
+        
+        if response.status == SendTransactionStatus.ERROR:
+            return {"success": False, "error": f"Transaction rejected: {response.error_result_xdr}"}
+        if response.status == SendTransactionStatus.TRY_AGAIN_LATER:
+            return {"success": False, "error": "RPC busy, retry shortly"}
         
         print(f"[CONTRACT] TX submitted: {response.hash}")
         
         tx_hash = response.hash
         for _ in range(30):
             time.sleep(1)
-            result = soroban_server.get_transaction(tx_hash)
+            result = get_soroban_server().get_transaction(tx_hash)
             if result.status == GetTransactionStatus.SUCCESS:
                 return {"success": True, "hash": tx_hash}
             elif result.status == GetTransactionStatus.FAILED:
@@ -469,111 +1157,2134 @@ def submit_signed_tx(signed_xdr: str):
         return {"success": False, "error": str(e)}
 
 
-# ============== API ENDPOINTS ==============
-
-@app.route('/bots', methods=['GET'])
-def get_bots():
-    """Return list of available trading bots with commission structure"""
-    bots_public = []
-    for bot in TRADING_BOTS:
-        total_rate = bot['total_commission_rate']  # Developer'ın belirlediği oran (örn: %10)
-        platform_cut = bot['platform_cut_percent']  # Sabit %10 (developer'dan kesilir)
-        
-        # Platform = total_rate * platform_cut / 100
-        # Developer net = total_rate - platform
-        platform_rate = total_rate * platform_cut / 100
-        developer_net_rate = total_rate - platform_rate
-        
-        bots_public.append({
-            "id": bot['id'],
-            "name": bot['name'],
-            "strategy": bot['strategy'],
-            "total_commission_rate": total_rate,       # Toplam kesinti (kullanıcıdan)
-            "developer_rate": developer_net_rate,       # Developer'ın net payı
-            "platform_rate": platform_rate,             # Platform payı
-            "platform_cut_percent": platform_cut,       # Platform kesintisi %10
-            "min_commission_deposit": bot['min_commission_deposit'],
-            "developer": bot['developer'],
-            "platform": bot['platform'],
-            "contract_id": CONTRACT_ID,
-        })
-    return jsonify({"success": True, "bots": bots_public})
+# ============== TRANSACTION PREFLIGHT ==============
+# Client-signed XDR is checked locally before any RPC call: envelope decodes,
+# source signature is valid for NETWORK_PASSPHRASE, time bounds are open, the
+# single operation invokes CONTRACT_ID.<function>(bot_index, user_hash, amount).
+# Only then is the sequence compared with the account's on-chain sequence (one
+# ledger-entry read), so replays are caught on every shard, not just the one
+# that submitted first. A doomed submission is rejected here instead of after
+# a 30 s poll.
+PREFLIGHT_CLOCK_SKEW_SECONDS = 5
 
 
-@app.route('/status', methods=['GET'])
-def get_status():
-    """Get user's current status"""
-    public_key = request.args.get('public_key')
+def preflight_signed_tx(signed_xdr: str, function_name: str, bot_index: int, user_hash: int,
+                        source_public_key: str = None, amount_stroops: int = None,
+                        max_amount_stroops: int = None):
+    """Validate a client-signed contract call; the sequence check is the only RPC read. Returns error or None"""
+    from stellar_sdk import Address, Keypair, TransactionEnvelope, scval, xdr as stellar_xdr
+    from stellar_sdk.exceptions import AccountNotFoundException, BadSignatureError
+    from stellar_sdk.operation import InvokeHostFunction
     
-    if not public_key:
-        return jsonify({"success": False, "error": "Missing public_key"}), 400
+    try:
+        envelope = TransactionEnvelope.from_xdr(signed_xdr, network_passphrase=NETWORK_PASSPHRASE)
+    except Exception:
+        return "Malformed transaction XDR"
+    tx = envelope.transaction
     
-    session = get_user_session(public_key)
+    # Source account and signature (the hash commits to the network passphrase)
+    source = tx.source.account_id
+    if source_public_key and source != source_public_key:
+        return "Transaction source does not match user_public_key"
+    keypair = Keypair.from_public_key(source)
+    tx_hash = envelope.hash()
+    signed = False
+    for decorated in envelope.signatures:
+        if decorated.signature_hint != keypair.signature_hint():
+            continue
+        try:
+            keypair.verify(tx_hash, decorated.signature)
+            signed = True
+            break
+        except BadSignatureError:
+            continue
+    if not signed:
+        return "Not signed by the source account for this network"
     
-    active_bots_list = []
-    for bot_id, bot_data in session['active_bots'].items():
-        bot_info = bot_data.copy()
-        bot_info['bot_id'] = bot_id
-        bot_info['is_accessible'] = bot_data['commission_balance'] > 0
-        active_bots_list.append(bot_info)
+    # Time bounds (set_timeout(300) -> max_time)
+    now = time.time()
+    time_bounds = tx.preconditions.time_bounds if tx.preconditions else None
+    if time_bounds:
+        if time_bounds.max_time and now > time_bounds.max_time + PREFLIGHT_CLOCK_SKEW_SECONDS:
+            return "Transaction expired, prepare it again"
+        if time_bounds.min_time > now + PREFLIGHT_CLOCK_SKEW_SECONDS:
+            return "Transaction is not valid yet"
     
-    return jsonify({
-        "success": True,
-        "user_public_key": public_key,
-        "active_bots": active_bots_list
-    })
+    # Exactly one contract call: CONTRACT_ID.<function_name>(bot_index, user_hash, amount)
+    if len(tx.operations) != 1 or not isinstance(tx.operations[0], InvokeHostFunction):
+        return "Expected a single contract invocation"
+    host_function = tx.operations[0].host_function
+    if host_function.type != stellar_xdr.HostFunctionType.HOST_FUNCTION_TYPE_INVOKE_CONTRACT:
+        return "Expected a single contract invocation"
+    invoke = host_function.invoke_contract
+    if Address.from_xdr_sc_address(invoke.contract_address).address != CONTRACT_ID:
+        return "Transaction targets a different contract"
+    if invoke.function_name.sc_symbol.decode() != function_name:
+        return f"Expected a {function_name} call"
+    
+    try:
+        tx_bot, tx_user, tx_amount = invoke.args
+        tx_bot, tx_user, tx_amount = scval.from_uint64(tx_bot), scval.from_uint64(tx_user), scval.from_int128(tx_amount)
+    except (TypeError, ValueError):
+        return f"Unexpected {function_name} arguments"
+    if (tx_bot, tx_user) != (bot_index, user_hash):
+        return "Transaction is for a different vault"
+    if tx_amount <= 0:
+        return "Amount must be positive"
+    if amount_stroops is not None and tx_amount != amount_stroops:
+        return "Transaction amount does not match"
+    if max_amount_stroops is not None and tx_amount > max_amount_stroops:
+        return "Withdraw amount exceeds the remaining balance"
+    
+    # Stale sequence: an older or replayed envelope would fail with txBadSeq.
+    # Zincirdeki sıra numarası tüm shard'lar için ortak tek doğru kaynak.
+    try:
+        account_sequence = get_soroban_server().load_account(source).sequence
+    except AccountNotFoundException:
+        return "Source account not found"
+    except Exception as e:
+        # RPC okunamadı: kontrolü atla, gönderim hatayı zaten bildirir
+        print(f"[PREFLIGHT] Sequence check skipped for {source}: {e}")
+        return None
+    if tx.sequence <= account_sequence:
+        return "Stale sequence number, prepare the transaction again"
+    
+    return None
 
 
-@app.route('/create-deposit-tx', methods=['POST'])
-def create_deposit_tx():
-    """Create contract deposit transaction for Freighter to sign"""
+# ============== VAULT READINESS ==============
+# create-deposit-tx starts init_vault in the background and prepares the deposit
+# XDR at the same time instead of waiting for init_vault's confirmation first.
+# An existing vault answers at deposit-prepare latency. A new vault cannot be
+# simulated against before init_vault lands (RPC only simulates committed
+# state), so the request returns 202 instead of blocking; the init job prepares
+# the deposit the moment init_vault confirms and the client's follow-up call is
+# served from that cache; repeat calls while init_vault is still pending skip
+# the doomed simulation. Each vault (bot_index, user_hash) gets a readiness
+# entry; submit-transaction waits on it so a signed deposit is never sent
+# before its vault is confirmed.
+#   pending     -> init_vault submitted, not confirmed yet
+#   ready       -> init_vault confirmed, or the deposit simulation saw the vault
+#   unconfirmed -> init_vault did not succeed (usually: vault already existed);
+#                  not resubmitted, so a real failure surfaces as the deposit error
+# Settled entries (ready / unconfirmed) are evicted after VAULT_READINESS_TTL_SECONDS;
+# after that a new request starts over.
+VAULT_READY_TIMEOUT_SECONDS = float(os.getenv("WHALEER_VAULT_READY_TIMEOUT_SECONDS", "45"))
+VAULT_INIT_WORKERS = int(os.getenv("WHALEER_VAULT_INIT_WORKERS", "4"))
+VAULT_POLL_HINT_SECONDS = 2
+PREPARED_DEPOSIT_TTL_SECONDS = 240  # contract_deposit set_timeout(300) altında kalır
+VAULT_READINESS_TTL_SECONDS = float(os.getenv("WHALEER_VAULT_READINESS_TTL_SECONDS", "900"))
+
+vault_readiness = {}
+vault_readiness_lock = threading.Lock()
+vault_readiness_pruned_at = 0.0
+vault_executor = None
+
+
+def vault_handle(bot_index: int, user_hash: int) -> str:
+    return f"{bot_index}:{user_hash}"
+
+
+def parse_vault_handle(handle: str):
     try:
-        data = request.json
-        bot_id = data.get('bot_id')
-        user_public_key = data.get('user_public_key')
-        amount = float(data.get('amount', 10))
-        
-        print(f"[DEPOSIT] Creating contract TX: bot={bot_id}, amount={amount} XLM")
-        
-        if not all([bot_id, user_public_key]):
-            return jsonify({"success": False, "error": "Missing parameters"}), 400
-        
-        bot = next((b for b in TRADING_BOTS if b['id'] == bot_id), None)
-        if not bot:
-            return jsonify({"success": False, "error": "Bot not found"}), 404
-        
-        bot_index = get_bot_index(bot_id)
-        user_hash = get_user_hash(user_public_key)
-        
-        # Get bot configuration
-        developer_address = bot['developer']
-        total_rate = bot['total_commission_rate']
-        platform_cut = bot['platform_cut_percent']
-        platform_rate = total_rate * platform_cut / 100
-        developer_net_rate = total_rate - platform_rate
-        
-        # Init vault if needed (ignore errors - might already exist)
-        try:
-            contract_init_vault(
-                bot_id=bot_index,
-                user_id=user_hash,
+        bot_index, user_hash = handle.split(":")
+        return int(bot_index), int(user_hash)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _get_vault_executor():
+    global vault_executor
+    if vault_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        vault_executor = ThreadPoolExecutor(max_workers=VAULT_INIT_WORKERS, thread_name_prefix="vault-init")
+    return vault_executor
+
+
+def _init_vault_job(key: tuple, user_public_key: str, bot: dict):
+    try:
+        with profiled("worker init_vault"):
+            result = contract_init_vault(
+                bot_id=key[0],
+                user_id=key[1],
                 user_address=user_public_key,
-                developer_address=developer_address,
-                total_commission_rate=total_rate,
-                platform_cut_percent=platform_cut,
+                developer_address=bot['developer'],
+                total_commission_rate=bot['total_commission_rate'],
+                platform_cut_percent=bot['platform_cut_percent'],
+            )
+    except Exception as e:
+        print(f"[INIT_VAULT] Error: {e}")
+        result = None
+
+    # Bekleyen bir deposit isteği varsa vault onaylanır onaylanmaz hazırla (state'ten önce)
+    with vault_readiness_lock:
+        deposit_request = vault_readiness[key].get('deposit_request')
+    prepared = None
+    if result and deposit_request:
+        amount, public_key = deposit_request
+        xdr, error = contract_deposit(key[0], key[1], amount, public_key)
+        if xdr:
+            prepared = {"amount": amount, "public_key": public_key, "xdr": xdr,
+                        "expires_at": time.time() + PREPARED_DEPOSIT_TTL_SECONDS}
+
+    with vault_readiness_lock:
+        entry = vault_readiness[key]
+        entry['future'] = None
+        entry['deposit_request'] = None
+        entry['prepared_deposit'] = prepared
+        if entry['state'] == "pending":
+            entry['state'] = "ready" if result else "unconfirmed"
+            entry['updated_at'] = time.time()
+        if result:
+            entry['init_tx'] = result.transaction_hash
+    print(f"[INIT_VAULT] {vault_handle(*key)} -> {entry['state']}")
+
+
+def _prune_vault_readiness(now: float):
+    """Evict settled entries older than the TTL, at most once per TTL (caller holds vault_readiness_lock)"""
+    global vault_readiness_pruned_at
+    if now - vault_readiness_pruned_at < VAULT_READINESS_TTL_SECONDS:
+        return
+    vault_readiness_pruned_at = now
+    expired = [
+        key for key, entry in vault_readiness.items()
+        if entry['state'] != "pending" and now - entry['updated_at'] >= VAULT_READINESS_TTL_SECONDS
+    ]
+    for key in expired:
+        del vault_readiness[key]
+
+
+def start_vault_init(bot_index: int, user_hash: int, user_public_key: str, bot: dict) -> dict:
+    """Kick off init_vault in the background unless the vault's state is already known"""
+    key = (bot_index, user_hash)
+    now = time.time()
+    with vault_readiness_lock:
+        _prune_vault_readiness(now)
+        entry = vault_readiness.get(key)
+        if entry and (entry['state'] == "pending" or now - entry['updated_at'] < VAULT_READINESS_TTL_SECONDS):
+            return entry
+        entry = {"state": "pending", "future": None, "init_tx": None, "updated_at": now}
+        vault_readiness[key] = entry
+        entry['future'] = _get_vault_executor().submit(_init_vault_job, key, user_public_key, bot)
+        return entry
+
+
+def request_deposit_prepare(bot_index: int, user_hash: int, amount: float, user_public_key: str,
+                            only_if_waiting: bool = False) -> bool:
+    """
+    Ask the pending init job to prepare this deposit once the vault confirms;
+    False if not pending anymore. only_if_waiting: succeed only if an earlier
+    request already found the vault missing (no need to simulate again).
+    """
+    with vault_readiness_lock:
+        entry = vault_readiness.get((bot_index, user_hash))
+        if entry is None or entry['state'] != "pending":
+            return False
+        if only_if_waiting and not entry.get('deposit_request'):
+            return False
+        entry['deposit_request'] = (amount, user_public_key)
+        return True
+
+
+def take_prepared_deposit(bot_index: int, user_hash: int, amount: float, user_public_key: str):
+    """Deposit XDR the init job prepared for exactly this request, or None"""
+    with vault_readiness_lock:
+        entry = vault_readiness.get((bot_index, user_hash))
+        prepared = entry and entry.get('prepared_deposit')
+        if not prepared:
+            return None
+        entry['prepared_deposit'] = None
+    if (prepared['amount'], prepared['public_key']) != (amount, user_public_key) or prepared['expires_at'] < time.time():
+        return None
+    return prepared['xdr']
+
+
+def mark_vault_ready(bot_index: int, user_hash: int):
+    now = time.time()
+    with vault_readiness_lock:
+        _prune_vault_readiness(now)
+        entry = vault_readiness.setdefault((bot_index, user_hash), {"future": None, "init_tx": None})
+        entry['state'] = "ready"
+        entry['updated_at'] = now
+
+
+def wait_for_vault(bot_index: int, user_hash: int, timeout: float = VAULT_READY_TIMEOUT_SECONDS):
+    """Block until a pending init_vault settles; returns the state, or None if unknown"""
+    from concurrent.futures import TimeoutError as FutureTimeout
+
+    with vault_readiness_lock:
+        entry = vault_readiness.get((bot_index, user_hash))
+        future = entry and entry['future']
+    if entry is None:
+        return None
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except FutureTimeout:
+            pass
+    return entry['state']
+
+
+def get_vault_status(bot_index: int, user_hash: int):
+    with vault_readiness_lock:
+        entry = vault_readiness.get((bot_index, user_hash))
+        if entry is None:
+            return {"state": "unknown"}
+        return {"state": entry['state'], "init_tx": entry.get('init_tx'), "updated_at": entry.get('updated_at')}
+
+
+# ============== SETTLEMENT SCHEDULER ==============
+# Taxable profit is netted per vault (bot_index, user_hash) and settled with a
+# single settle_profit call once an amount or age threshold is crossed, or when
+# the user withdraws. Local commission accounting in simulate_day stays exact;
+# only the on-chain transfer is deferred.
+#
+# Every ledger change is written to the settlement outbox (JSONL) in the same
+# order it is applied in memory, and fsync'd (group commit, outside
+# settlement_lock) before anything outside the process depends on it, so a
+# restart replays the file and no commission that was already deducted
+# locally is lost. Request handlers
+# only enqueue; the settlement worker claims batches, submits them and retries
+# with backoff. A batch keeps its id and last tx hash across retries: the
+# worker checks that hash first and only sends a new transaction once the old
+# one failed or its time bounds expired, so a retry never pays twice. After
+# SETTLEMENT_MAX_ATTEMPTS the batch is dead-lettered for manual requeue.
+# Once the log passes SETTLEMENT_OUTBOX_COMPACT_BYTES the worker rewrites it as
+# a snapshot, dropping vaults with nothing pending, in flight or dead-lettered.
+# When main.py moves a wallet to another shard its vault entries move with it
+# (export/import records on both sides); a vault whose batch the worker is
+# processing is handed over only after that attempt finishes.
+SETTLEMENT_FLUSH_PROFIT_XLM = float(os.getenv("WHALEER_SETTLEMENT_FLUSH_PROFIT_XLM", "50"))
+SETTLEMENT_FLUSH_INTERVAL_SECONDS = float(os.getenv("WHALEER_SETTLEMENT_FLUSH_INTERVAL_SECONDS", "3600"))
+# Varsayılan: uygulamanın yanında bir dosya; WHALEER_SETTLEMENT_OUTBOX_PATH="" dayanıklılığı kapatır (sadece bellek)
+SETTLEMENT_OUTBOX_PATH = os.getenv(
+    "WHALEER_SETTLEMENT_OUTBOX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "settlement_outbox.jsonl"),
+) or None
+SETTLEMENT_MAX_ATTEMPTS = int(os.getenv("WHALEER_SETTLEMENT_MAX_ATTEMPTS", "8"))
+SETTLEMENT_RETRY_BASE_SECONDS = float(os.getenv("WHALEER_SETTLEMENT_RETRY_BASE_SECONDS", "30"))
+SETTLEMENT_OUTBOX_COMPACT_BYTES = int(os.getenv("WHALEER_SETTLEMENT_OUTBOX_COMPACT_BYTES", str(4 * 1024 * 1024)))
+SETTLEMENT_SWEEP_SECONDS = 30
+
+settlement_ledger = {}
+settlement_dead_letters = []
+settlement_lock = threading.Lock()
+settlement_busy = set()  # Worker'ın şu an işlediği vault'lar (devir bunları bekler)
+settlement_idle = threading.Condition(settlement_lock)
+settlement_wakeup = threading.Event()
+settlement_thread = None
+settlement_resume_checked = False
+settlement_outbox = None
+settlement_outbox_lock = threading.Lock()
+
+
+class SettlementOutbox:
+    """
+    Append-only JSONL log with group commit. write() only buffers the line and
+    returns a ticket (cheap, safe under settlement_lock so file order matches
+    memory order); sync(ticket) returns once that line is durable, and
+    concurrent syncs share one fsync.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.file = open(path, "a") if path else None
+        self.write_lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        self.fsyncs = 0
+        self.size = os.path.getsize(path) if path else 0
+        self.compactions = 0
+
+    @staticmethod
+    def read(path: str):
+        records = []
+        if not path or not os.path.exists(path):
+            return records
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # Çökme sırasında yarım kalmış son satır
+        return records
+
+    @staticmethod
+    def compact(path: str, records: list):
+        """Atomically replace the log with a snapshot of the replayed state"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def write(self, record: dict) -> int:
+        if self.file is None:
+            return 0
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.write_lock:
+            self.file.write(line)
+            self.written += 1
+            self.size += len(line)
+            return self.written
+
+    def sync(self, ticket: int):
+        if self.file is None or not ticket:
+            return
+        with self.sync_lock:
+            if self.synced >= ticket:
+                return  # Başka bir yazarın fsync'i bu satırı da kapsadı
+            with self.write_lock:
+                self.file.flush()
+                target = self.written
+            os.fsync(self.file.fileno())
+            self.synced = target
+            self.fsyncs += 1
+
+    def rewrite(self, records: list):
+        """Swap the live log for a snapshot (caller holds settlement_lock, so nothing is written meanwhile)"""
+        if self.file is None:
+            return
+        with self.sync_lock, self.write_lock:
+            self.file.close()
+            self.compact(self.path, records)
+            self.file = open(self.path, "a")
+            self.size = os.path.getsize(self.path)
+            self.synced = self.written  # Snapshot fsync'li: bekleyen her bilet kapsandı
+            self.compactions += 1
+
+    def stats(self):
+        return {"path": self.path, "records": self.written, "fsyncs": self.fsyncs,
+                "bytes": self.size, "compactions": self.compactions}
+
+
+def _new_settlement_entry():
+    return {
+        "accrued_profit_xlm": 0.0,      # Toplam vergilendirilebilir kâr (tüm zamanlar)
+        "accrued_commission_xlm": 0.0,  # Lokal olarak düşülen toplam komisyon
+        "pending_profit_xlm": 0.0,      # Henüz bir batch'e alınmamış kâr
+        "pending_commission_xlm": 0.0,
+        "settled_profit_xlm": 0.0,      # Zincirde onaylanmış kâr
+        "settled_commission_xlm": 0.0,
+        "dead_profit_xlm": 0.0,         # Dead-letter'a düşmüş kâr
+        "dead_commission_xlm": 0.0,
+        "settlement_count": 0,
+        "failed_attempts": 0,
+        "first_pending_at": None,
+        "last_settled_at": None,
+        "last_settle_tx": None,
+        "in_flight": None,              # Worker'ın gönderdiği batch (id, tutar, tx hash, deneme)
+    }
+
+
+def _merge_settlement_entry(entry: dict, incoming: dict):
+    """Fold a vault entry handed over by another shard into ours"""
+    for field, value in incoming.items():
+        if field.endswith('_xlm') or field in ('settlement_count', 'failed_attempts'):
+            entry[field] += value
+    entry['public_key'] = entry.get('public_key') or incoming.get('public_key')
+    pending_since = [at for at in (entry['first_pending_at'], incoming['first_pending_at']) if at]
+    entry['first_pending_at'] = min(pending_since) if pending_since else None
+    if (incoming['last_settled_at'] or 0) > (entry['last_settled_at'] or 0):
+        entry['last_settled_at'] = incoming['last_settled_at']
+        entry['last_settle_tx'] = incoming['last_settle_tx']
+    entry['in_flight'] = entry['in_flight'] or incoming['in_flight']
+
+
+def _apply_outbox_record(record: dict):
+    """Apply one outbox record to the in-memory ledger (live and on replay; caller holds settlement_lock)"""
+    op = record['op']
+    if op == "dead_letter":
+        settlement_dead_letters.append(record['batch'])
+        return
+
+    key = tuple(record['key'])
+    if op == "snapshot":
+        settlement_ledger[key] = record['entry']
+        return
+    if op == "export":
+        settlement_ledger.pop(key, None)
+        settlement_dead_letters[:] = [batch for batch in settlement_dead_letters if tuple(batch['key']) != key]
+        return
+    if op == "import":
+        if key in settlement_ledger:
+            _merge_settlement_entry(settlement_ledger[key], record['entry'])
+        else:
+            settlement_ledger[key] = dict(record['entry'])
+        known = {batch['id'] for batch in settlement_dead_letters}
+        settlement_dead_letters.extend(batch for batch in record['dead_letters'] if batch['id'] not in known)
+        return
+
+    entry = settlement_ledger.setdefault(key, _new_settlement_entry())
+    if op == "accrue":
+        entry['public_key'] = record.get('public_key') or entry.get('public_key')
+        entry['accrued_profit_xlm'] += record['profit_xlm']
+        entry['accrued_commission_xlm'] += record['commission_xlm']
+        entry['pending_profit_xlm'] += record['profit_xlm']
+        entry['pending_commission_xlm'] += record['commission_xlm']
+        entry['first_pending_at'] = entry['first_pending_at'] or record['at']
+    elif op == "claim":
+        entry['pending_profit_xlm'] = max(entry['pending_profit_xlm'] - record['profit_xlm'], 0.0)
+        entry['pending_commission_xlm'] = max(entry['pending_commission_xlm'] - record['commission_xlm'], 0.0)
+        entry['first_pending_at'] = record['at'] if entry['pending_profit_xlm'] > 1e-9 else None
+        entry['in_flight'] = {
+            "id": record['id'],
+            "profit_xlm": record['profit_xlm'],
+            "commission_xlm": record['commission_xlm'],
+            "reason": record['reason'],
+            "claimed_at": record['at'],
+            "attempts": 0,
+            "tx_hash": None,
+            "expires_at": None,
+            "next_attempt_at": record['at'],
+            "last_error": None,
+        }
+    elif op == "requeue":
+        batch = next((b for b in settlement_dead_letters if b['id'] == record['id']), None)
+        if batch is not None:
+            settlement_dead_letters.remove(batch)
+            entry['dead_profit_xlm'] -= batch['profit_xlm']
+            entry['dead_commission_xlm'] -= batch['commission_xlm']
+            entry['pending_profit_xlm'] += batch['profit_xlm']
+            entry['pending_commission_xlm'] += batch['commission_xlm']
+            entry['first_pending_at'] = entry['first_pending_at'] or record['at']
+    else:
+        batch = entry['in_flight']
+        if batch is None or batch['id'] != record['id']:
+            return  # Artık aktif olmayan bir batch'e ait kayıt
+        if op == "submitted":
+            batch['tx_hash'] = record['tx_hash']
+            batch['expires_at'] = record['expires_at']
+        elif op == "retry":
+            batch['attempts'] += 1
+            batch['tx_hash'] = record.get('tx_hash')  # Hâlâ zincire düşebilecekse korunur
+            batch['last_error'] = record['error']
+            batch['next_attempt_at'] = record['next_attempt_at']
+            entry['failed_attempts'] += 1
+        elif op == "settled":
+            entry['settled_profit_xlm'] += batch['profit_xlm']
+            entry['settled_commission_xlm'] += batch['commission_xlm']
+            entry['settlement_count'] += 1
+            entry['last_settled_at'] = record['at']
+            entry['last_settle_tx'] = record.get('tx_hash')
+            entry['in_flight'] = None
+        elif op == "dead":
+            entry['dead_profit_xlm'] += batch['profit_xlm']
+            entry['dead_commission_xlm'] += batch['commission_xlm']
+            settlement_dead_letters.append(
+                dict(batch, key=list(key), last_error=record['error'], dead_at=record['at'])
+            )
+            entry['in_flight'] = None
+
+
+def _settlement_snapshot():
+    """
+    Drop vaults with nothing pending, in flight or dead-lettered, then return
+    the records that rebuild the ledger (caller holds settlement_lock).
+    """
+    idle = [
+        key for key, entry in settlement_ledger.items()
+        if entry['pending_profit_xlm'] <= 1e-9 and entry['in_flight'] is None and entry['dead_profit_xlm'] <= 1e-9
+    ]
+    for key in idle:
+        del settlement_ledger[key]
+    return [
+        {"op": "snapshot", "key": list(key), "entry": entry}
+        for key, entry in settlement_ledger.items()
+    ] + [{"op": "dead_letter", "batch": batch} for batch in settlement_dead_letters]
+
+
+def get_settlement_outbox() -> SettlementOutbox:
+    """Open the outbox on first use, replaying and compacting what a previous process left behind"""
+    global settlement_outbox
+    if settlement_outbox is not None:
+        return settlement_outbox
+
+    with settlement_outbox_lock:
+        if settlement_outbox is None:
+            path = SETTLEMENT_OUTBOX_PATH
+            if path and not os.access(os.path.dirname(os.path.abspath(path)), os.W_OK):
+                # Salt okunur dosya sistemi (ör. serverless): çökmek yerine uyar ve bellekte devam et
+                print(f"[SETTLEMENT] WARNING: outbox directory for {path} is not writable, "
+                      f"pending settlements will NOT survive a restart")
+                path = None
+            records = SettlementOutbox.read(path)
+            with settlement_lock:
+                for record in records:
+                    _apply_outbox_record(record)
+                if records:
+                    SettlementOutbox.compact(path, _settlement_snapshot())
+                    in_flight = sum(1 for entry in settlement_ledger.values() if entry['in_flight'])
+                    print(f"[SETTLEMENT] Replayed {len(records)} outbox records, {in_flight} batches in flight")
+            settlement_outbox = SettlementOutbox(path)
+    return settlement_outbox
+
+
+def _log_settlement(record: dict) -> int:
+    """
+    Buffer the record in the outbox, then apply it in memory (caller holds
+    settlement_lock). Returns the outbox ticket; the caller syncs it after
+    releasing the lock and before anything outside the process depends on it.
+    """
+    ticket = settlement_outbox.write(record)
+    _apply_outbox_record(record)
+    return ticket
+
+
+def accrue_settlement(bot_index: int, user_hash: int, profit_xlm: float, commission_xlm: float,
+                      public_key: str = None):
+    """
+    Durably add taxable profit to the vault's netting bucket (no on-chain call).
+    Must run before the session deducts the commission; raises if the outbox
+    cannot be written, so the caller never changes state that is not logged.
+    """
+    if profit_xlm <= 0:
+        return
+
+    record = {
+        "op": "accrue",
+        "key": [bot_index, user_hash],
+        "profit_xlm": profit_xlm,
+        "commission_xlm": commission_xlm,
+        "public_key": public_key,
+        "at": time.time(),
+    }
+    outbox = get_settlement_outbox()
+    with settlement_lock:
+        ticket = _log_settlement(record)
+        threshold_crossed = settlement_ledger[(bot_index, user_hash)]['pending_profit_xlm'] >= SETTLEMENT_FLUSH_PROFIT_XLM
+    # fsync lock dışında: eşzamanlı accrue'lar tek fsync'i paylaşır, /status beklemez
+    outbox.sync(ticket)
+
+    start_settlement_scheduler()
+    if threshold_crossed:
+        settlement_wakeup.set()
+
+
+def claim_settlement(bot_index: int, user_hash: int, reason: str):
+    """Move everything pending on a vault into one batch; returns its id (idempotency key)"""
+    outbox = get_settlement_outbox()
+    with settlement_lock:
+        entry = settlement_ledger.get((bot_index, user_hash))
+        if entry is None or entry['pending_profit_xlm'] <= 0 or entry['in_flight'] is not None:
+            return None
+        settlement_id = os.urandom(8).hex()
+        ticket = _log_settlement({
+            "op": "claim",
+            "key": [bot_index, user_hash],
+            "id": settlement_id,
+            "profit_xlm": entry['pending_profit_xlm'],
+            "commission_xlm": entry['pending_commission_xlm'],
+            "reason": reason,
+            "at": time.time(),
+        })
+    outbox.sync(ticket)
+    return settlement_id
+
+
+def request_settlement_flush(bot_index: int, user_hash: int, reason: str = "withdraw"):
+    """Enqueue the vault's pending profit for the worker without waiting on the network"""
+    settlement_id = claim_settlement(bot_index, user_hash, reason)
+    start_settlement_scheduler()
+    settlement_wakeup.set()
+    return settlement_id
+
+
+def process_settlement_batch(bot_index: int, user_hash: int):
+    """Submit (or confirm) the vault's in-flight batch once; schedules a retry on failure"""
+    key = (bot_index, user_hash)
+    with settlement_lock:
+        if key in settlement_busy or key not in settlement_ledger:
+            return  # Başka bir shard'a devredildi
+        settlement_busy.add(key)
+    try:
+        _process_settlement_batch(bot_index, user_hash)
+    finally:
+        with settlement_lock:
+            settlement_busy.discard(key)
+            settlement_idle.notify_all()
+
+
+def _process_settlement_batch(bot_index: int, user_hash: int):
+    from stellar_sdk.soroban_rpc import GetTransactionStatus, SendTransactionStatus
+
+    key = (bot_index, user_hash)
+    with settlement_lock:
+        entry = settlement_ledger.get(key)
+        batch = dict(entry['in_flight']) if entry and entry['in_flight'] else None
+    if batch is None or batch['next_attempt_at'] > time.time():
+        return
+
+    tx_hash = batch['tx_hash']
+    status = None
+    error = None
+    try:
+        if tx_hash:
+            # Önceki deneme zincire ulaşmış olabilir: yeniden göndermeden önce hash'e bak
+            expired = time.time() >= batch['expires_at']
+            status, _ = poll_transaction(tx_hash, attempts=1 if expired else 30)
+            if status == GetTransactionStatus.NOT_FOUND and expired:
+                tx_hash = None  # Zaman sınırı geçti, artık zincire düşemez
+            elif status == GetTransactionStatus.FAILED:
+                tx_hash = None
+
+        if tx_hash is None:
+            print(f"[SETTLEMENT] Flushing vault {key} ({batch['reason']}, attempt {batch['attempts'] + 1}): "
+                  f"{batch['profit_xlm']:.7f} XLM profit")
+            tx = contract_settle_profit(bot_index, user_hash, batch['profit_xlm'])
+            if tx is None:
+                status = GetTransactionStatus.SUCCESS  # Zincire gönderilecek bir tutar yok
+            else:
+                with settlement_lock:
+                    ticket = _log_settlement({
+                        "op": "submitted",
+                        "key": [bot_index, user_hash],
+                        "id": batch['id'],
+                        "tx_hash": tx.hash_hex(),
+                        "expires_at": tx.transaction.preconditions.time_bounds.max_time,
+                        "at": time.time(),
+                    })
+                settlement_outbox.sync(ticket)  # Hash diskte olmadan gönderilmez
+                # Kayıt yazıldığı andan itibaren bu tx zincire düşebilir: ağ/timeout hatasında
+                # hash korunur ve bir sonraki deneme yeniden göndermeden önce ona bakar
+                tx_hash = tx.hash_hex()
+                response = get_soroban_server().send_transaction(tx)
+                if response.status in (SendTransactionStatus.ERROR, SendTransactionStatus.TRY_AGAIN_LATER):
+                    tx_hash = None  # RPC açıkça reddetti, zincire düşemez
+                    raise RuntimeError(f"send_transaction {response.status.value}")
+                status, _ = poll_transaction(tx_hash)
+                if status == GetTransactionStatus.FAILED:
+                    tx_hash = None
+    except Exception as e:
+        error = str(e)
+
+    now = time.time()
+    with settlement_lock:
+        if status == GetTransactionStatus.SUCCESS:
+            ticket = _log_settlement({"op": "settled", "key": [bot_index, user_hash], "id": batch['id'],
+                             "tx_hash": tx_hash, "at": now})
+            outcome = "settled"
+        elif batch['attempts'] + 1 >= SETTLEMENT_MAX_ATTEMPTS:
+            ticket = _log_settlement({"op": "dead", "key": [bot_index, user_hash], "id": batch['id'],
+                             "error": error or f"last status {getattr(status, 'value', status)}", "at": now})
+            outcome = "dead"
+        else:
+            delay = min(SETTLEMENT_RETRY_BASE_SECONDS * 2 ** batch['attempts'], SETTLEMENT_FLUSH_INTERVAL_SECONDS)
+            ticket = _log_settlement({"op": "retry", "key": [bot_index, user_hash], "id": batch['id'],
+                             "tx_hash": tx_hash, "error": error or f"status {getattr(status, 'value', status)}",
+                             "next_attempt_at": now + delay, "at": now})
+            outcome = "retry"
+        public_key = settlement_ledger[key].get('public_key')
+    settlement_outbox.sync(ticket)
+
+    print(f"[SETTLEMENT] Vault {key} batch {batch['id']}: {outcome}")
+    if outcome == "settled":
+        record_settlement(TRADING_BOTS[bot_index]['id'], batch['profit_xlm'], batch['commission_xlm'])
+    if public_key and outcome != "retry":
+        publish_session_event(public_key, "settlement", {
+            "bot_id": TRADING_BOTS[bot_index]['id'],
+            "success": outcome == "settled",
+            "profit_xlm": round(batch['profit_xlm'], 7),
+            "commission_xlm": round(batch['commission_xlm'], 7),
+            "transaction_hash": tx_hash if outcome == "settled" else None,
+        })
+
+
+def flush_due_settlements():
+    """Claim vaults whose pending amount or age crossed a threshold, then work every due batch"""
+    get_settlement_outbox()
+    now = time.time()
+    with settlement_lock:
+        due = [
+            key for key, entry in settlement_ledger.items()
+            if entry['pending_profit_xlm'] > 0 and entry['in_flight'] is None and (
+                entry['pending_profit_xlm'] >= SETTLEMENT_FLUSH_PROFIT_XLM
+                or now - entry['first_pending_at'] >= SETTLEMENT_FLUSH_INTERVAL_SECONDS
             )
+        ]
+    for bot_index, user_hash in due:
+        claim_settlement(bot_index, user_hash, reason="threshold")
+
+    with settlement_lock:
+        ready = [
+            key for key, entry in settlement_ledger.items()
+            if entry['in_flight'] and entry['in_flight']['next_attempt_at'] <= now
+        ]
+    for bot_index, user_hash in ready:
+        with profiled("worker settle_profit"):
+            process_settlement_batch(bot_index, user_hash)
+
+
+def compact_settlement_outbox(force: bool = False):
+    """Rewrite the outbox as a snapshot once it passes SETTLEMENT_OUTBOX_COMPACT_BYTES"""
+    outbox = get_settlement_outbox()
+    if outbox.file is None or (not force and outbox.size < SETTLEMENT_OUTBOX_COMPACT_BYTES):
+        return False
+    before = outbox.size
+    # Seyrek (eşik başına bir kez) ve küçük bir dosya: fsync lock altında kabul edilebilir
+    with settlement_lock:
+        outbox.rewrite(_settlement_snapshot())
+    print(f"[SETTLEMENT] Outbox compacted: {before} -> {outbox.size} bytes, {len(settlement_ledger)} vaults kept")
+    return True
+
+
+def settlement_scheduler_loop():
+    while True:
+        try:
+            flush_due_settlements()
+            compact_settlement_outbox()
         except Exception as e:
-            print(f"[INIT_VAULT] Already exists or error: {e}")
+            print(f"[SETTLEMENT] Scheduler error: {e}")
+        settlement_wakeup.wait(timeout=SETTLEMENT_SWEEP_SECONDS)
+        settlement_wakeup.clear()
+
+
+def start_settlement_scheduler():
+    """Start the background settlement worker on first use"""
+    global settlement_thread
+    if settlement_thread is not None:
+        return
+    with settlement_lock:
+        if settlement_thread is None:
+            settlement_thread = threading.Thread(
+                target=settlement_scheduler_loop, name="settlement-scheduler", daemon=True
+            )
+            settlement_thread.start()
+
+
+@app.before_request
+def resume_settlements():
+    """After a restart, drain whatever the outbox still holds without waiting for new profit"""
+    global settlement_resume_checked
+    if settlement_resume_checked:
+        return
+    settlement_resume_checked = True
+    # Boş/olmayan outbox için worker başlatılmaz (cold start'ta gereksiz thread yok)
+    if settlement_thread is None and SETTLEMENT_OUTBOX_PATH and os.path.exists(SETTLEMENT_OUTBOX_PATH) \
+            and os.path.getsize(SETTLEMENT_OUTBOX_PATH) > 0:
+        start_settlement_scheduler()
+
+
+def requeue_dead_settlement(settlement_id: str) -> bool:
+    """Move a dead-lettered batch back to pending"""
+    outbox = get_settlement_outbox()
+    with settlement_lock:
+        batch = next((b for b in settlement_dead_letters if b['id'] == settlement_id), None)
+        if batch is None:
+            return False
+        ticket = _log_settlement({"op": "requeue", "key": batch['key'], "id": settlement_id, "at": time.time()})
+    outbox.sync(ticket)
+    settlement_wakeup.set()
+    return True
+
+
+def settlement_public_keys():
+    """Wallets that own a vault entry here (they move with their sessions on a rebalance)"""
+    get_settlement_outbox()
+    with settlement_lock:
+        return {entry['public_key'] for entry in settlement_ledger.values() if entry.get('public_key')}
+
+
+def export_settlements(public_keys: list = None):
+    """
+    Remove the wallets' vault entries and dead letters (every vault if
+    public_keys is None) and return them for import on another shard. Waits
+    for a batch the worker is currently submitting, so it never runs twice.
+    """
+    outbox = get_settlement_outbox()
+    user_hashes = None if public_keys is None else {get_user_hash(public_key) for public_key in public_keys}
+    vaults = []
+    ticket = 0
+    with settlement_lock:
+        while True:
+            keys = [key for key in settlement_ledger if user_hashes is None or key[1] in user_hashes]
+            if not settlement_busy.intersection(keys):
+                break
+            settlement_idle.wait()
+        for key in keys:
+            vaults.append({
+                "key": list(key),
+                "entry": settlement_ledger[key],
+                "dead_letters": [batch for batch in settlement_dead_letters if tuple(batch['key']) == key],
+            })
+            ticket = _log_settlement({"op": "export", "key": list(key), "at": time.time()})
+    outbox.sync(ticket)  # Devredilen vault burada tekrar yüklenmesin
+    return vaults
+
+
+def import_settlements(vaults: list):
+    """Take over vault entries exported by another shard; raises ValueError on a conflicting batch"""
+    if not vaults:
+        return 0
+    outbox = get_settlement_outbox()
+    with settlement_lock:
+        for vault in vaults:
+            entry = settlement_ledger.get(tuple(vault['key']))
+            if entry and entry['in_flight'] and vault['entry']['in_flight']:
+                raise ValueError(f"Vault {vault['key']} already has a batch in flight")
+        for vault in vaults:
+            ticket = _log_settlement({"op": "import", "key": vault['key'], "entry": vault['entry'],
+                                      "dead_letters": vault['dead_letters'], "at": time.time()})
+    outbox.sync(ticket)
+    start_settlement_scheduler()
+    settlement_wakeup.set()
+    return len(vaults)
+
+
+def get_settlement_summary(bot_index: int, user_hash: int):
+    """Accrued / pending / in-flight / settled amounts for one vault"""
+    get_settlement_outbox()
+    with settlement_lock:
+        entry = dict(settlement_ledger.get((bot_index, user_hash)) or _new_settlement_entry())
+    entry.pop('public_key', None)
+
+    batch = entry.pop('in_flight')
+    entry['in_flight_profit_xlm'] = batch['profit_xlm'] if batch else 0.0
+    entry['in_flight_commission_xlm'] = batch['commission_xlm'] if batch else 0.0
+    entry['in_flight_attempts'] = batch['attempts'] if batch else 0
+    for field in list(entry):
+        if field.endswith('_xlm'):
+            entry[field] = round(entry[field], 7)
+    return entry
+
+
+def get_settlement_outbox_stats():
+    outbox = get_settlement_outbox()
+    with settlement_lock:
+        in_flight = [
+            dict(entry['in_flight'], key=list(key))
+            for key, entry in settlement_ledger.items() if entry['in_flight']
+        ]
+        dead_letters = [dict(batch) for batch in settlement_dead_letters]
+    return {
+        "outbox": outbox.stats(),
+        "worker_running": settlement_thread is not None,
+        "in_flight": in_flight,
+        "dead_letters": dead_letters,
+    }
+
+
+# ============== SUBSCRIPTION ARCHIVE ==============
+# Closed subscriptions (withdrawn bots) are appended to a binary archive
+# instead of being dropped with the session: one fixed-width header plus one
+# fixed-width row per simulated day, and a separate fixed-width index file
+# (public_key, bot_id) -> offset. Reads go through mmap + memoryview, so
+# archived history costs no heap until a query decodes the requested rows.
+# Data is fsync'd before its index entry, so a crash can leave at most an
+# unindexed tail that is ignored. Under main.py all shards share one archive,
+# so a wallet's history stays readable after it moves to another shard.
+# Varsayılan: uygulamanın yanında bir dosya; WHALEER_ARCHIVE_PATH="" arşivi kapatır (geçmiş atılır)
+ARCHIVE_PATH = os.getenv(
+    "WHALEER_ARCHIVE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "subscription_archive.bin"),
+) or None  # index lives at ARCHIVE_PATH + ".idx"
+
+ARCHIVE_HEADER = struct.Struct("<56s16s64s7d2I")
+ARCHIVE_HEADER_FIELDS = (
+    "closed_at", "total_deposited", "total_commission_paid", "amount_withdrawn",
+    "total_profit", "simulation_balance", "high_water_mark",
+)
+ARCHIVE_ROW = struct.Struct("<I9d")
+ARCHIVE_ROW_FIELDS = (
+    "performance_percent", "profit_usd", "commission_xlm", "developer_xlm", "platform_xlm",
+    "simulation_balance", "commission_balance", "high_water_mark", "xlm_usd_rate",
+)
+ARCHIVE_INDEX = struct.Struct("<56s16sQId")  # public_key, bot_id, offset, row_count, closed_at
+
+
+def _pack_str(value: str) -> bytes:
+    return (value or "").encode()
+
+
+def _unpack_str(value: bytes) -> str:
+    return value.rstrip(b"\0").decode()
+
+
+def _archive_float(value):
+    return None if value != value else value  # NaN = alan yoktu
+
+
+class SubscriptionArchive:
+    """
+    Shared by every process that points at the same path (main.py shards):
+    appends hold an exclusive flock so offsets never interleave, and readers
+    pick up entries other processes appended by reading only the new tail of
+    the index file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.lock = threading.Lock()
+        self.index = {}         # public_key -> {bot_id: [(offset, row_count, closed_at)]}
+        self.index_offset = 0   # .idx bytes already loaded
+        self.map = None
+
+    def _refresh_index(self):
+        """Load index entries appended since the last call, by any process (caller holds self.lock)"""
+        try:
+            index_size = os.path.getsize(self.index_path)
+        except OSError:
+            return
+        if index_size - self.index_offset < ARCHIVE_INDEX.size:
+            return
+
+        with open(self.index_path, "rb") as f:
+            f.seek(self.index_offset)
+            raw = f.read(index_size - self.index_offset)
+        usable = len(raw) - len(raw) % ARCHIVE_INDEX.size  # Yazılmakta olan son kayıt sonraki çağrıya kalır
+        data_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        for public_key, bot_id, offset, row_count, closed_at in ARCHIVE_INDEX.iter_unpack(raw[:usable]):
+            if offset + ARCHIVE_HEADER.size + row_count * ARCHIVE_ROW.size > data_size:
+                continue
+            bots = self.index.setdefault(_unpack_str(public_key), {})
+            bots.setdefault(_unpack_str(bot_id), []).append((offset, row_count, closed_at))
+        self.index_offset += usable
+
+    def append(self, public_key: str, bot_id: str, bot_data: dict):
+        import fcntl
+
+        history = bot_data.get('daily_history', [])
+        closed_at = time.time()
+        block = [ARCHIVE_HEADER.pack(
+            _pack_str(public_key),
+            _pack_str(bot_id),
+            _pack_str(bot_data.get('deposit_tx')),
+            closed_at,
+            bot_data.get('total_deposited', 0.0),
+            bot_data.get('total_commission_paid', 0.0),
+            bot_data.get('amount_withdrawn', bot_data.get('commission_balance', 0.0)),
+            bot_data.get('total_profit', 0.0),
+            bot_data.get('simulation_balance', 0.0),
+            bot_data.get('high_water_mark', 0.0),
+            bot_data.get('current_day', 0),
+            len(history),
+        )]
+        for row in history:
+            block.append(ARCHIVE_ROW.pack(
+                row.get('day', 0),
+                *(float(row.get(field, float("nan"))) for field in ARCHIVE_ROW_FIELDS),
+            ))
+
+        # flock ayrı fd'ler arasında da geçerli: aynı süreçteki thread'leri ve diğer shard'ları sıralar,
+        # okuyucuları (self.lock) fsync süresince bekletmez
+        with open(self.path, "ab") as data, open(self.index_path, "ab") as index:
+            fcntl.flock(data.fileno(), fcntl.LOCK_EX)
+            try:
+                offset = data.seek(0, os.SEEK_END)
+                data.write(b"".join(block))
+                data.flush()
+                os.fsync(data.fileno())
+
+                # Çökmeden kalan yarım index kaydı kesilir, yoksa sonraki tüm kayıtlar kayar
+                index_size = index.seek(0, os.SEEK_END)
+                if index_size % ARCHIVE_INDEX.size:
+                    index.truncate(index_size - index_size % ARCHIVE_INDEX.size)
+                index.write(ARCHIVE_INDEX.pack(_pack_str(public_key), _pack_str(bot_id), offset, len(history), closed_at))
+                index.flush()
+                os.fsync(index.fileno())
+            finally:
+                fcntl.flock(data.fileno(), fcntl.LOCK_UN)
+
+    def _view(self):
+        """Read-only mapping covering the whole data file; remapped as it grows"""
+        size = os.path.getsize(self.path)
+        if self.map is None or len(self.map) < size:
+            # Eski map kapatılmaz: devam eden okumaların memoryview'ları onu tutuyor olabilir
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.map)
+
+    def find(self, public_key: str, bot_id: str = None):
+        """(bot_id, offset, row_count, closed_at) of a wallet's archived subscriptions, oldest first"""
+        with self.lock:
+            self._refresh_index()
+            bots = self.index.get(public_key)
+            if not bots:
+                return []
+            if bot_id is not None:
+                bots = {bot_id: bots[bot_id]} if bot_id in bots else {}
+            return sorted(
+                ((archived_bot_id, *entry) for archived_bot_id, entries in bots.items() for entry in entries),
+                key=lambda item: item[3],
+            )
+
+    @staticmethod
+    def _row_bound(view, start: int, row_count: int, day: int, after: bool = False) -> int:
+        """Binary search over the (day-ordered) rows: index of the first row with day >= day (> day if after)"""
+        lo, hi = 0, row_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (mid_day,) = struct.unpack_from("<I", view, start + mid * ARCHIVE_ROW.size)
+            if mid_day < day or (after and mid_day == day):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read(self, public_key: str, bot_id: str = None, include_history: bool = True,
+             from_day: int = None, to_day: int = None):
+        """Archived subscriptions of a wallet, oldest first; only rows inside the day range are decoded"""
+        matches = self.find(public_key, bot_id)
+        if not matches:
+            return []
+
+        with self.lock:
+            view = self._view()
+        records = []
+        for archived_bot_id, offset, row_count, _closed_at in matches:
+            header = ARCHIVE_HEADER.unpack_from(view, offset)
+            record = {
+                "bot_id": archived_bot_id,
+                "deposit_tx": _unpack_str(header[2]) or None,
+                **dict(zip(ARCHIVE_HEADER_FIELDS, header[3:10])),
+                "current_day": header[10],
+                "total_points": row_count,
+            }
+            if include_history:
+                start = offset + ARCHIVE_HEADER.size
+                first = self._row_bound(view, start, row_count, from_day) if from_day is not None else 0
+                last = self._row_bound(view, start, row_count, to_day, after=True) if to_day is not None else row_count
+                rows = view[start + first * ARCHIVE_ROW.size:start + max(last, first) * ARCHIVE_ROW.size]
+                record['daily_history'] = [
+                    {"day": values[0], **{
+                        field: _archive_float(value) for field, value in zip(ARCHIVE_ROW_FIELDS, values[1:])
+                    }}
+                    for values in ARCHIVE_ROW.iter_unpack(rows)
+                ]
+            records.append(record)
+        return records
+
+    def stats(self):
+        with self.lock:
+            self._refresh_index()
+            return {
+                "path": self.path,
+                "subscriptions": sum(len(entries) for bots in self.index.values() for entries in bots.values()),
+                "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+                "header_bytes": ARCHIVE_HEADER.size,
+                "row_bytes": ARCHIVE_ROW.size,
+            }
+
+
+def open_subscription_archive(path: str):
+    if not path:
+        return None
+    if not os.access(os.path.dirname(os.path.abspath(path)), os.W_OK):
+        # Salt okunur dosya sistemi (ör. serverless): çökmek yerine uyar ve arşivsiz devam et
+        print(f"[ARCHIVE] WARNING: archive directory for {path} is not writable, "
+              f"closed subscriptions will NOT be archived")
+        return None
+    return SubscriptionArchive(path)
+
+
+subscription_archive = open_subscription_archive(ARCHIVE_PATH)
+
+
+# ============== REVENUE AGGREGATES ==============
+# Running counters per bot and per (bot, UTC day), updated in O(1) from
+# simulate_day, settlements and subscription changes, plus a ranking of
+# subscriptions by total_profit. Dashboards read these instead of scanning
+# every session's daily_history.
+#
+# The ranking is a min-heap on -total_profit with lazy deletion:
+# subscription_profit holds the current value, an update only pushes
+# (O(log n)), and heap entries that no longer match it are skipped and dropped
+# when a top-N read reaches them. The heap is rebuilt from subscription_profit
+# once stale entries outnumber live ones. Day buckets older than
+# AGGREGATES_RETENTION_DAYS are pruned once per UTC day.
+AGGREGATES_DEFAULT_TOP_N = 10
+AGGREGATES_RETENTION_DAYS = int(os.getenv("WHALEER_AGGREGATES_RETENTION_DAYS", "90"))
+
+aggregates_lock = threading.Lock()
+bot_aggregates = {}
+daily_aggregates = {}
+aggregates_pruned_day = None
+subscription_profit = {}
+profit_ranking = []  # heap of (-total_profit, public_key, bot_id), may hold stale entries
+
+
+def _new_aggregate():
+    return {
+        "commission_xlm": 0.0,
+        "developer_xlm": 0.0,
+        "platform_xlm": 0.0,
+        "profit_usd": 0.0,
+        "simulated_days": 0,
+        "settled_profit_xlm": 0.0,
+        "settled_commission_xlm": 0.0,
+        "settlements": 0,
+        "active_subscriptions": 0,
+    }
+
+
+def _aggregate_buckets(bot_id: str):
+    """(all-time, today) counters for a bot; caller holds aggregates_lock"""
+    global aggregates_pruned_day
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    if day != aggregates_pruned_day:
+        # Gün başına bir kez: saklama süresini aşan gün bucket'larını at (ISO tarihleri sıralı)
+        cutoff = time.strftime("%Y-%m-%d", time.gmtime(time.time() - AGGREGATES_RETENTION_DAYS * 86400))
+        for key in [key for key in daily_aggregates if key[1] < cutoff]:
+            del daily_aggregates[key]
+        aggregates_pruned_day = day
+    total = bot_aggregates.setdefault(bot_id, _new_aggregate())
+    today = daily_aggregates.setdefault((bot_id, day), _new_aggregate())
+    today['active_subscriptions'] = total['active_subscriptions']
+    return total, today
+
+
+def _update_profit_ranking(public_key: str, bot_id: str, total_profit: float = None):
+    """Move (or remove, when total_profit is None) a subscription in the ranking; caller holds aggregates_lock"""
+    global profit_ranking
+    key = (public_key, bot_id)
+    if total_profit is None:
+        subscription_profit.pop(key, None)  # Heap'teki kaydı okuma sırasında düşer
+        return
+    if subscription_profit.get(key) == total_profit:
+        return
+    subscription_profit[key] = total_profit
+    heappush(profit_ranking, (-total_profit, public_key, bot_id))
+    if len(profit_ranking) > 2 * len(subscription_profit) + 64:
+        profit_ranking = [(-profit, pk, bot) for (pk, bot), profit in subscription_profit.items()]
+        heapify(profit_ranking)
+
+
+def _top_profit(top_n: int):
+    """Highest total_profit subscriptions; pops stale heap entries on the way (caller holds aggregates_lock)"""
+    top = []
+    while profit_ranking and len(top) < top_n:
+        entry = heappop(profit_ranking)
+        neg_profit, public_key, bot_id = entry
+        if subscription_profit.get((public_key, bot_id)) == -neg_profit and (not top or top[-1] != entry):
+            top.append(entry)
+    for entry in top:
+        heappush(profit_ranking, entry)
+    return top
+
+
+def record_simulated_day(bot_id: str, public_key: str, profit_usd: float, commission_xlm: float,
+                         developer_xlm: float, platform_xlm: float, total_profit: float):
+    with aggregates_lock:
+        for bucket in _aggregate_buckets(bot_id):
+            bucket['commission_xlm'] += commission_xlm
+            bucket['developer_xlm'] += developer_xlm
+            bucket['platform_xlm'] += platform_xlm
+            bucket['profit_usd'] += profit_usd
+            bucket['simulated_days'] += 1
+        _update_profit_ranking(public_key, bot_id, total_profit)
+
+
+def record_settlement(bot_id: str, profit_xlm: float, commission_xlm: float):
+    with aggregates_lock:
+        for bucket in _aggregate_buckets(bot_id):
+            bucket['settled_profit_xlm'] += profit_xlm
+            bucket['settled_commission_xlm'] += commission_xlm
+            bucket['settlements'] += 1
+
+
+def record_subscription_change(bot_id: str, public_key: str, delta: int, total_profit: float = None):
+    """delta=+1 new subscription, -1 closed (removed from ranking), 0 reset"""
+    with aggregates_lock:
+        total, today = _aggregate_buckets(bot_id)
+        total['active_subscriptions'] += delta
+        today['active_subscriptions'] = total['active_subscriptions']
+        _update_profit_ranking(public_key, bot_id, None if delta < 0 else total_profit)
+
+
+def close_subscription(session: dict, public_key: str, bot_id: str):
+    """
+    Archive a bot subscription's history, then remove it from the session and
+    the aggregates. Raises OSError, leaving the subscription in place, if the
+    archive cannot be written.
+    """
+    bot_data = session['active_bots'].get(bot_id)
+    if bot_data is None:
+        return None
+    if subscription_archive is not None:
+        subscription_archive.append(public_key, bot_id, bot_data)
+    session['active_bots'].pop(bot_id, None)
+    record_subscription_change(bot_id, public_key, -1)
+    return bot_data
+
+
+def get_aggregates(day: str = None, top_n: int = AGGREGATES_DEFAULT_TOP_N):
+    day = day or time.strftime("%Y-%m-%d", time.gmtime())
+    with aggregates_lock:
+        return {
+            "day": day,
+            "bots": {bot_id: dict(counters) for bot_id, counters in bot_aggregates.items()},
+            "daily": {
+                bot_id: dict(counters)
+                for (bot_id, bucket_day), counters in daily_aggregates.items()
+                if bucket_day == day
+            },
+            "top_by_profit": [
+                {"public_key": public_key, "bot_id": bot_id, "total_profit": round(-neg_profit, 2)}
+                for neg_profit, public_key, bot_id in _top_profit(top_n)
+            ],
+        }
+
+
+# ============== COMMISSION FORECAST ==============
+# Monte Carlo over the bot's backtest returns: every path replays simulate_day's
+# HWM and commission rules, all paths advancing together one day at a time.
+FORECAST_DEFAULT_PATHS = 10_000
+FORECAST_MAX_PATHS = 50_000
+FORECAST_DEFAULT_DAYS = 365
+FORECAST_MAX_DAYS = 1825
+FORECAST_MAX_PATH_DAYS = 20_000_000  # paths * days üst sınırı (CPU); bellek gün sayısından bağımsız
+
+
+def forecast_commission_depletion(bot: dict, bot_session: dict, xlm_usd_rate: float,
+                                  paths: int, days: int, seed: int = None):
+    """Distribution of days until commission_balance hits zero and expected payouts"""
+    np = _np()
+
+    returns = get_strategy_returns(bot['id']) / 100
+    rng = np.random.default_rng(seed)
+
+    balance = np.full(paths, float(bot_session['simulation_balance']))
+    hwm = np.full(paths, float(bot_session.get('high_water_mark', bot_session['starting_balance'])))
+    commission_balance = np.full(paths, float(bot_session['commission_balance']))
+    developer_total = np.zeros(paths)
+    platform_total = np.zeros(paths)
+    depleted_on = np.zeros(paths, dtype=np.int32)
+
+    for day in range(days):
+        active = commission_balance > 0
+        # Bootstrap: o günün getirileri backtest dağılımından örneklenir (days x paths matris tutulmaz)
+        new_balance = balance * (1 + rng.choice(returns, size=paths))
+        above_hwm = active & (new_balance > hwm)
+        taxable_profit_xlm = np.where(above_hwm, new_balance - hwm, 0.0) / xlm_usd_rate
+
+        _, total_xlm, platform_xlm, developer_xlm = calculate_commission(
+            taxable_profit_xlm, commission_balance,
+            bot['total_commission_rate'], bot['platform_cut_percent'],
+        )
+
+        hwm = np.where(above_hwm, new_balance, hwm)
+        balance = np.where(active, new_balance, balance)
+        commission_balance = commission_balance - total_xlm
+        developer_total += developer_xlm
+        platform_total += platform_xlm
+        depleted_on[active & (commission_balance <= 0)] = day + 1
+
+    depleted = depleted_on > 0
+    depletion_days = depleted_on[depleted]
+    percentiles = {}
+    if depletion_days.size:
+        for p, value in zip((5, 25, 50, 75, 95), np.percentile(depletion_days, (5, 25, 50, 75, 95))):
+            percentiles[f"p{p}"] = float(value)
+
+    return {
+        "paths": paths,
+        "days": days,
+        "xlm_usd_rate": xlm_usd_rate,
+        "depletion_probability": round(float(depleted.mean()), 4),
+        "days_until_depletion": {
+            "mean": round(float(depletion_days.mean()), 2) if depletion_days.size else None,
+            "percentiles": percentiles,
+            "histogram": np.bincount((depletion_days - 1) * 10 // days, minlength=10).tolist(),
+        },
+        "expected_developer_xlm": round(float(developer_total.mean()), 4),
+        "expected_platform_xlm": round(float(platform_total.mean()), 4),
+        "expected_commission_xlm": round(float((developer_total + platform_total).mean()), 4),
+        "expected_final_commission_balance": round(float(commission_balance.mean()), 4),
+        "expected_final_simulation_balance": round(float(balance.mean()), 2),
+    }
+
+
+# ============== HISTORY DOWNSAMPLING ==============
+# Charts can only draw a few hundred points, so long daily_history ranges are
+# reduced server-side: LTTB picks shape-preserving rows on simulation_balance
+# ("points"), each of HISTORY_SERIES is also LTTB-downsampled on its own values
+# ("series"), and every bucket carries min/max/first/last plus commission totals.
+HISTORY_DEFAULT_MAX_POINTS = 300
+HISTORY_MAX_POINTS_LIMIT = 2000
+HISTORY_SERIES = ("simulation_balance", "high_water_mark", "commission_balance")
+HISTORY_SUMS = ("profit_usd", "commission_xlm", "developer_xlm", "platform_xlm")
+
+
+def slice_history(rows: list, from_day: int = None, to_day: int = None):
+    """Rows with from_day <= day <= to_day (days are contiguous, so this is index math)"""
+    if not rows:
+        return []
+    first_day = rows[0]['day']
+    start = 0 if from_day is None else max(from_day - first_day, 0)
+    end = len(rows) if to_day is None else max(to_day - first_day + 1, 0)
+    return rows[start:end]
+
+
+def lttb_downsample(rows: list, max_points: int, field: str = "simulation_balance"):
+    """Largest-Triangle-Three-Buckets selection of rows on one series"""
+    n = len(rows)
+    if max_points >= n or max_points < 3:
+        return rows
+
+    sampled = [rows[0]]
+    bucket_size = (n - 2) / (max_points - 2)
+    a = 0
+
+    for i in range(max_points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        # Sonraki bucket'ın ortalaması üçgenin üçüncü köşesi
+        next_start = end
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        next_rows = rows[next_start:next_end] or [rows[-1]]
+        avg_x = sum(r['day'] for r in next_rows) / len(next_rows)
+        avg_y = sum(r.get(field, 0) for r in next_rows) / len(next_rows)
+
+        ax, ay = rows[a]['day'], rows[a].get(field, 0)
+        best_area = -1.0
+        best_index = start
+        for j in range(start, end):
+            area = abs(
+                (ax - avg_x) * (rows[j].get(field, 0) - ay)
+                - (ax - rows[j]['day']) * (avg_y - ay)
+            )
+            if area > best_area:
+                best_area = area
+                best_index = j
+
+        sampled.append(rows[best_index])
+        a = best_index
+
+    sampled.append(rows[-1])
+    return sampled
+
+
+def bucket_aggregates(rows: list, bucket_count: int):
+    """Split rows into equal day buckets with min/max/first/last per series and sums"""
+    n = len(rows)
+    if n == 0 or bucket_count <= 0:
+        return []
+
+    bucket_count = min(bucket_count, n)
+    buckets = []
+    for i in range(bucket_count):
+        chunk = rows[i * n // bucket_count:(i + 1) * n // bucket_count]
+        bucket = {
+            "day_start": chunk[0]['day'],
+            "day_end": chunk[-1]['day'],
+            "count": len(chunk),
+        }
+        for field in HISTORY_SERIES:
+            values = [r.get(field, 0) for r in chunk]
+            bucket[field] = {
+                "first": values[0],
+                "last": values[-1],
+                "min": min(values),
+                "max": max(values),
+            }
+        for field in HISTORY_SUMS:
+            bucket[f"{field}_total"] = round(sum(r.get(field, 0) for r in chunk), 4)
+        buckets.append(bucket)
+    return buckets
+
+
+def downsample_series(rows: list, max_points: int):
+    """[day, value] pairs per HISTORY_SERIES, each chosen by LTTB on that series"""
+    return {
+        field: [[r['day'], r.get(field, 0)] for r in lttb_downsample(rows, max_points, field)]
+        for field in HISTORY_SERIES
+    }
+
+
+def parse_max_points(value, default: int = HISTORY_DEFAULT_MAX_POINTS):
+    if value in (None, ""):
+        return default
+    return max(3, min(int(value), HISTORY_MAX_POINTS_LIMIT))
+
+
+def parse_query_arg(name: str, cast=int, default=None):
+    """Query arg converted with cast; missing -> default, invalid -> ValueError (routes answer 400)"""
+    value = request.args.get(name)
+    if value in (None, ""):
+        return default
+    value = cast(value)
+    if cast is float and not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    return value
+
+
+# ============== SESSION EVENT STREAM ==============
+# Per-wallet event log backing /status/stream. Each wallet keeps the last
+# SSE_BACKLOG_SIZE events so a reconnecting client can resume from
+# Last-Event-ID; older gaps fall back to a full snapshot.
+SSE_HEARTBEAT_SECONDS = 15
+SSE_BACKLOG_SIZE = 256
+
+session_events = {}
+session_events_lock = threading.Lock()
+# Henüz log'u olmayan cüzdanların stream'leri tek bir ortak condition'da bekler
+session_events_created = threading.Condition(session_events_lock)
+
+
+def _get_event_log(public_key: str):
+    """Write path only (caller holds session_events_lock); readers use session_events.get"""
+    log = session_events.get(public_key)
+    if log is None:
+        log = session_events[public_key] = {
+            "last_id": 0,
+            "events": deque(maxlen=SSE_BACKLOG_SIZE),
+            "cond": threading.Condition(session_events_lock),
+        }
+        session_events_created.notify_all()
+    return log
+
+
+def publish_session_event(public_key: str, event_type: str, data: dict):
+    """Append an event to the wallet's log and wake its stream listeners"""
+    with session_events_lock:
+        log = _get_event_log(public_key)
+        log['last_id'] += 1
+        log['events'].append((log['last_id'], event_type, json.dumps(data)))
+        log['cond'].notify_all()
+        return log['last_id']
+
+
+def format_sse(event_id, event_type: str, payload: str) -> str:
+    return f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n"
+
+
+# ============== ADMISSION CONTROL ==============
+# Contract-bound routes can hold a worker for tens of seconds. Each pool caps
+# concurrent requests and the number allowed to wait for a slot; beyond that
+# requests fail fast with 503 + Retry-After instead of exhausting workers, so
+# cheap routes (/health, /bots, /status) keep their latency. A single wallet
+# may only have WALLET_MAX_CONCURRENT expensive requests in flight (429).
+ADMISSION_POOLS = {
+    # pool: (max_concurrent, max_queue, max_wait_seconds)
+    "contract": (int(os.getenv("WHALEER_CONTRACT_CONCURRENCY", "8")), 16, 5.0),
+    "simulate": (int(os.getenv("WHALEER_SIMULATE_CONCURRENCY", "16")), 32, 2.0),
+    "compute": (int(os.getenv("WHALEER_COMPUTE_CONCURRENCY", "4")), 8, 2.0),
+}
+WALLET_MAX_CONCURRENT = int(os.getenv("WHALEER_WALLET_MAX_CONCURRENT", "2"))
+ADMISSION_RETRY_AFTER_SECONDS = 2
+ADMIN_API_TOKEN = os.getenv("WHALEER_ADMIN_API_TOKEN")
+
+admission_lock = threading.Lock()
+admission_state = {
+    name: {
+        "slots": threading.BoundedSemaphore(max_concurrent),
+        "max_concurrent": max_concurrent,
+        "max_queue": max_queue,
+        "max_wait": max_wait,
+        "active": 0,
+        "waiting": 0,
+        "admitted": 0,
+        "rejected_saturated": 0,
+        "rejected_wallet": 0,
+    }
+    for name, (max_concurrent, max_queue, max_wait) in ADMISSION_POOLS.items()
+}
+wallet_inflight = {}
+
+
+def overloaded_response(status_code: int, error: str):
+    response = jsonify({"success": False, "error": error, "retry_after": ADMISSION_RETRY_AFTER_SECONDS})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER_SECONDS)
+    return response
+
+
+def _acquire_slot(pool: dict):
+    if pool['slots'].acquire(blocking=False):
+        return True
+
+    with admission_lock:
+        if pool['waiting'] >= pool['max_queue']:
+            return False
+        pool['waiting'] += 1
+    try:
+        return pool['slots'].acquire(timeout=pool['max_wait'])
+    finally:
+        with admission_lock:
+            pool['waiting'] -= 1
+
+
+def admission_controlled(pool_name: str):
+    """Route decorator: bounded concurrency per pool and per wallet"""
+    pool = admission_state[pool_name]
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            wallet = data.get('user_public_key') or request.args.get('public_key')
+
+            if wallet:
+                with admission_lock:
+                    if wallet_inflight.get(wallet, 0) >= WALLET_MAX_CONCURRENT:
+                        pool['rejected_wallet'] += 1
+                        return overloaded_response(429, "Too many concurrent requests for this wallet")
+                    wallet_inflight[wallet] = wallet_inflight.get(wallet, 0) + 1
+
+            try:
+                if not _acquire_slot(pool):
+                    with admission_lock:
+                        pool['rejected_saturated'] += 1
+                    return overloaded_response(503, "Server busy, please retry shortly")
+
+                with admission_lock:
+                    pool['active'] += 1
+                    pool['admitted'] += 1
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    with admission_lock:
+                        pool['active'] -= 1
+                    pool['slots'].release()
+            finally:
+                if wallet:
+                    with admission_lock:
+                        remaining = wallet_inflight.get(wallet, 1) - 1
+                        if remaining > 0:
+                            wallet_inflight[wallet] = remaining
+                        else:
+                            wallet_inflight.pop(wallet, None)
+
+        return wrapper
+    return decorator
+
+
+def admin_required(fn):
+    """Admin routes need WHALEER_ADMIN_API_TOKEN in the X-Admin-Token header"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_API_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_API_TOKEN:
+            return jsonify({"success": False, "error": "Forbidden"}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def get_admission_stats():
+    with admission_lock:
+        pools = {
+            name: {key: value for key, value in pool.items() if key != 'slots'}
+            for name, pool in admission_state.items()
+        }
+        return {"pools": pools, "wallets_in_flight": len(wallet_inflight)}
+
+
+# ============== SAMPLING PROFILER ==============
+# Opt-in wall-clock sampler. A request is profiled when it carries
+# "X-Profile: 1" together with a valid X-Admin-Token, or, while the admin
+# toggle is on, with probability sample_rate. One sampler thread snapshots the
+# stacks of profiled threads every interval_ms and folds them into collapsed
+# stacks ("POST /simulate-day;frame;frame <count>") for flamegraph.pl or
+# speedscope. Background jobs (vault init, settlement worker) are sampled the
+# same way through profiled(). When nothing is profiled a request only pays
+# for one dict lookup and one header lookup.
+PROFILER_SAMPLE_RATE = float(os.getenv("WHALEER_PROFILER_SAMPLE_RATE", "0.05"))
+PROFILER_INTERVAL_MS = float(os.getenv("WHALEER_PROFILER_INTERVAL_MS", "5"))
+PROFILER_MAX_STACKS = 20000
+
+profiler_state = {"enabled": False, "sample_rate": PROFILER_SAMPLE_RATE, "interval_ms": PROFILER_INTERVAL_MS}
+profiler_lock = threading.Lock()
+profiler_wakeup = threading.Event()
+profiler_thread = None
+profiled_threads = {}  # thread id -> [root label, sample count]
+profile_stacks = Counter()
+profile_stats = {"samples": 0, "profiled_requests": 0, "dropped_stacks": 0, "since": time.time()}
+frame_labels = {}
+
+
+def _frame_label(code) -> str:
+    label = frame_labels.get(code)
+    if label is None:
+        path = code.co_filename
+        marker = path.rfind("site-packages" + os.sep)
+        path = path[marker + len("site-packages") + 1:] if marker >= 0 else os.path.basename(path)
+        label = f"{code.co_name} ({path}:{code.co_firstlineno})"
+        frame_labels[code] = label
+    return label
+
+
+def _collapse_stack(frame) -> str:
+    """Root-to-leaf frame labels, starting at the outermost frame of this module"""
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    # Werkzeug / thread bootstrap çerçeveleri her örnekte aynı, ilk index.py çerçevesinden başla
+    outer = next((i for i in range(len(codes) - 1, -1, -1) if codes[i].co_filename == __file__), len(codes) - 1)
+    return ";".join(_frame_label(code) for code in reversed(codes[:outer + 1]))
+
+
+def profiler_loop():
+    while True:
+        if not profiled_threads:
+            profiler_wakeup.wait()
+            profiler_wakeup.clear()
+            continue
+
+        time.sleep(profiler_state['interval_ms'] / 1000)
+        frames = sys._current_frames()
+        with profiler_lock:
+            for thread_id, slot in profiled_threads.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = slot[0] + ";" + _collapse_stack(frame)
+                if stack in profile_stacks or len(profile_stacks) < PROFILER_MAX_STACKS:
+                    profile_stacks[stack] += 1
+                else:
+                    profile_stats['dropped_stacks'] += 1
+                slot[1] += 1
+                profile_stats['samples'] += 1
+        del frames
+
+
+def should_profile(headers=None) -> bool:
+    if headers is not None and headers.get('X-Profile') == '1':
+        return bool(ADMIN_API_TOKEN) and headers.get('X-Admin-Token') == ADMIN_API_TOKEN
+    if not profiler_state['enabled']:
+        return False
+    import random
+    return random.random() < profiler_state['sample_rate']
+
+
+def start_profiling(label: str):
+    """Sample the calling thread until stop_profiling()"""
+    global profiler_thread
+    with profiler_lock:
+        profiled_threads[threading.get_ident()] = [label, 0]
+        profile_stats['profiled_requests'] += 1
+        if profiler_thread is None:
+            profiler_thread = threading.Thread(target=profiler_loop, name="profiler", daemon=True)
+            profiler_thread.start()
+    profiler_wakeup.set()
+
+
+def stop_profiling() -> int:
+    """Stop sampling the calling thread; returns how many samples it got"""
+    with profiler_lock:
+        slot = profiled_threads.pop(threading.get_ident(), None)
+    return slot[1] if slot else 0
+
+
+@contextmanager
+def profiled(label: str):
+    """Profile a background job under the admin toggle (request threads use the hooks below)"""
+    active = should_profile()
+    if active:
+        start_profiling(label)
+    try:
+        yield
+    finally:
+        if active:
+            stop_profiling()
+
+
+@app.before_request
+def profile_request():
+    if profiler_state['enabled'] or 'X-Profile' in request.headers:
+        if should_profile(request.headers):
+            rule = request.url_rule.rule if request.url_rule else request.path
+            start_profiling(f"{request.method} {rule}")
+
+
+@app.after_request
+def attach_profile_samples(response):
+    slot = profiled_threads.get(threading.get_ident()) if profiled_threads else None
+    if slot is not None:
+        response.headers['X-Profile-Samples'] = str(slot[1])
+    return response
+
+
+@app.teardown_request
+def stop_request_profile(exc=None):
+    if profiled_threads:
+        stop_profiling()
+
+
+def configure_profiler(enabled=None, sample_rate=None, interval_ms=None, reset=False):
+    with profiler_lock:
+        if enabled is not None:
+            profiler_state['enabled'] = bool(enabled)
+        if sample_rate is not None:
+            profiler_state['sample_rate'] = min(max(float(sample_rate), 0.0), 1.0)
+        if interval_ms is not None:
+            profiler_state['interval_ms'] = max(float(interval_ms), 1.0)
+        if reset:
+            profile_stacks.clear()
+            profile_stats.update(samples=0, profiled_requests=0, dropped_stacks=0, since=time.time())
+
+
+def get_profiler_status():
+    with profiler_lock:
+        return {
+            **profiler_state,
+            **profile_stats,
+            "distinct_stacks": len(profile_stacks),
+            "active_threads": len(profiled_threads),
+        }
+
+
+def dump_profile(fmt: str = "collapsed", top: int = 50, reset: bool = False):
+    """Collapsed stacks as text, or a JSON summary with top stacks and self time per frame"""
+    with profiler_lock:
+        stacks = profile_stacks.most_common()
+    if reset:
+        configure_profiler(reset=True)
+
+    if fmt == "collapsed":
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    self_samples = Counter()
+    route_samples = Counter()
+    for stack, count in stacks:
+        frames = stack.split(";")
+        route_samples[frames[0]] += count
+        self_samples[frames[-1]] += count
+    return {
+        "routes": dict(route_samples.most_common()),
+        "self": [{"frame": frame, "samples": count} for frame, count in self_samples.most_common(top)],
+        "stacks": [{"stack": stack, "samples": count} for stack, count in stacks[:top]],
+    }
+
+
+# ============== API ENDPOINTS ==============
+
+def static_json(payload: dict) -> bytes:
+    """Serialize a static route payload once at import time"""
+    return json.dumps(payload, sort_keys=True).encode()
+
+
+def build_bots_payload():
+    bots_public = []
+    for bot in TRADING_BOTS:
+        total_rate = bot['total_commission_rate']  # Developer'ın belirlediği oran (örn: %10)
+        platform_cut = bot['platform_cut_percent']  # Sabit %10 (developer'dan kesilir)
+        
+        # Platform = total_rate * platform_cut / 100
+        # Developer net = total_rate - platform
+        platform_rate = total_rate * platform_cut / 100
+        developer_net_rate = total_rate - platform_rate
+        
+        bots_public.append({
+            "id": bot['id'],
+            "name": bot['name'],
+            "strategy": bot['strategy'],
+            "total_commission_rate": total_rate,       # Toplam kesinti (kullanıcıdan)
+            "developer_rate": developer_net_rate,       # Developer'ın net payı
+            "platform_rate": platform_rate,             # Platform payı
+            "platform_cut_percent": platform_cut,       # Platform kesintisi %10
+            "min_commission_deposit": bot['min_commission_deposit'],
+            "developer": bot['developer'],
+            "platform": bot['platform'],
+            "contract_id": CONTRACT_ID,
+        })
+    return {"success": True, "bots": bots_public}
+
+
+# Static payloads: computed once per process, served without per-request work
+BOTS_RESPONSE = static_json(build_bots_payload())
+HEALTH_RESPONSE = static_json({
+    "status": "healthy",
+    "network": "stellar-testnet",
+    "contract_id": CONTRACT_ID,
+    "developer": DEVELOPER_PUBLIC_KEY,
+})
+CONTRACT_INFO_RESPONSE = static_json({
+    "success": True,
+    "contract_id": CONTRACT_ID,
+    "developer_wallet": DEVELOPER_PUBLIC_KEY,
+    "native_asset": NATIVE_ASSET_ID,
+    "network": "testnet",
+    "explorer": f"https://stellar.expert/explorer/testnet/contract/{CONTRACT_ID}"
+})
+
+
+@app.route('/bots', methods=['GET'])
+def get_bots():
+    """Return list of available trading bots with commission structure"""
+    return Response(BOTS_RESPONSE, mimetype='application/json')
+
+
+def build_bot_status(public_key: str, bot_id: str, bot_data: dict, include_history: bool = True):
+    """Public view of one bot subscription (shared by /status and the event stream)"""
+    bot_info = bot_data.copy()
+    if not include_history:
+        bot_info.pop('daily_history', None)
+    bot_info['bot_id'] = bot_id
+    bot_info['is_accessible'] = bot_data['commission_balance'] > 0
+    bot_info['settlement'] = get_settlement_summary(get_bot_index(bot_id), get_user_hash(public_key))
+    return bot_info
+
+
+def build_status_payload(public_key: str, session: dict, max_points: int = None):
+    active_bots_list = [
+        build_bot_status(public_key, bot_id, bot_data)
+        for bot_id, bot_data in session['active_bots'].items()
+    ]
+    if max_points:
+        for bot_info in active_bots_list:
+            bot_info['daily_history'] = lttb_downsample(bot_info['daily_history'], max_points)
+    return {
+        "success": True,
+        "user_public_key": public_key,
+        "active_bots": active_bots_list
+    }
+
+
+def publish_bot_update(public_key: str, bot_id: str, bot_data: dict, history_row: dict = None):
+    """Push a bot delta: summary fields plus the newest daily_history row"""
+    publish_session_event(public_key, "bot_update", {
+        "bot": build_bot_status(public_key, bot_id, bot_data, include_history=False),
+        "history_row": history_row,
+    })
+
+
+@app.route('/status', methods=['GET'])
+def get_status():
+    """Get user's current status"""
+    public_key = request.args.get('public_key')
+    
+    if not public_key:
+        return jsonify({"success": False, "error": "Missing public_key"}), 400
+    
+    try:
+        max_points = parse_max_points(request.args.get('max_points'), default=None)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid max_points"}), 400
+    
+    session = get_user_session(public_key)
+    
+    return jsonify(build_status_payload(public_key, session, max_points))
+
+
+@app.route('/history', methods=['GET'])
+def get_history():
+    """Downsampled daily_history range for charts"""
+    public_key = request.args.get('public_key')
+    bot_id = request.args.get('bot_id')
+    
+    if not all([public_key, bot_id]):
+        return jsonify({"success": False, "error": "Missing parameters"}), 400
+    
+    try:
+        from_day = parse_query_arg('from_day')
+        to_day = parse_query_arg('to_day')
+        max_points = parse_max_points(request.args.get('max_points'))
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid range parameters"}), 400
+    
+    session = get_user_session(public_key)
+    
+    if bot_id not in session['active_bots']:
+        return jsonify({"success": False, "error": "Not subscribed to this bot"}), 400
+    
+    history = session['active_bots'][bot_id]['daily_history']
+    rows = slice_history(history, from_day, to_day)
+    
+    return jsonify({
+        "success": True,
+        "bot_id": bot_id,
+        "from_day": rows[0]['day'] if rows else from_day,
+        "to_day": rows[-1]['day'] if rows else to_day,
+        "total_points": len(rows),
+        "max_points": max_points,
+        "points": lttb_downsample(rows, max_points),
+        "series": downsample_series(rows, max_points),
+        "buckets": bucket_aggregates(rows, max_points),
+    })
+
+
+@app.route('/history/archived', methods=['GET'])
+def get_archived_history():
+    """Closed (withdrawn) subscriptions of a wallet, read from the mmap archive"""
+    public_key = request.args.get('public_key')
+    bot_id = request.args.get('bot_id')
+    
+    if not public_key:
+        return jsonify({"success": False, "error": "Missing public_key"}), 400
+    if subscription_archive is None:
+        return jsonify({"success": False, "error": "Archive not configured"}), 404
+    
+    try:
+        from_day = parse_query_arg('from_day')
+        to_day = parse_query_arg('to_day')
+        max_points = parse_max_points(request.args.get('max_points'), default=None)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid range parameters"}), 400
+    include_history = request.args.get('include_history', '1') != '0'
+    
+    subscriptions = subscription_archive.read(public_key, bot_id, include_history, from_day, to_day)
+    if max_points and include_history:
+        for record in subscriptions:
+            record['daily_history'] = lttb_downsample(record['daily_history'], max_points)
+    
+    return jsonify({
+        "success": True,
+        "user_public_key": public_key,
+        "subscriptions": subscriptions,
+    })
+
+
+@app.route('/status/stream', methods=['GET'])
+def stream_status():
+    """
+    Server-Sent Events stream of session deltas.
+    Resume with the Last-Event-ID header (or ?last_event_id=); a fresh or
+    too-old cursor first receives a full 'snapshot' event.
+    """
+    public_key = request.args.get('public_key')
+    
+    if not public_key:
+        return jsonify({"success": False, "error": "Missing public_key"}), 400
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        cursor = int(last_event_id) if last_event_id else None
+    except ValueError:
+        cursor = None
+    
+    def generate():
+        nonlocal cursor
+        yield f"retry: {SSE_HEARTBEAT_SECONDS * 1000}\n\n"
+        
+        # Okuma yolu bellek ayırmaz: log'u olmayan cüzdan ilk event'i bekler
+        log = None
+        
+        while True:
+            with session_events_lock:
+                if log is None:
+                    log = session_events.get(public_key)
+                if log is None:
+                    # Bu cüzdan için henüz event yok: bir kez snapshot, sonra ortak condition'da bekle
+                    if cursor != 0:
+                        cursor = 0
+                        needs_snapshot, pending = True, None
+                    else:
+                        session_events_created.wait(timeout=SSE_HEARTBEAT_SECONDS)
+                        if session_events.get(public_key) is not None:
+                            continue  # İlk event yayınlandı, log'dan oku
+                        needs_snapshot, pending = False, []
+                elif log.get('closed'):
+                    return  # Session evicted or handed to another shard
+                else:
+                    events = log['events']
+                    oldest_id = events[0][0] if events else log['last_id'] + 1
+                    needs_snapshot = (
+                        cursor is None
+                        or cursor > log['last_id']
+                        or (cursor < oldest_id - 1)
+                    )
+                    if needs_snapshot:
+                        cursor = log['last_id']
+                        pending = None
+                    else:
+                        pending = [evt for evt in events if evt[0] > cursor]
+                        if not pending:
+                            log['cond'].wait(timeout=SSE_HEARTBEAT_SECONDS)
+                            if log.get('closed'):
+                                return
+                            pending = [evt for evt in events if evt[0] > cursor]
+            
+            if needs_snapshot:
+                snapshot = build_status_payload(public_key, get_user_session(public_key))
+                yield format_sse(cursor, "snapshot", json.dumps(snapshot))
+                continue
+            
+            if not pending:
+                yield ": heartbeat\n\n"
+                continue
+            
+            for event_id, event_type, payload in pending:
+                yield format_sse(event_id, event_type, payload)
+                cursor = event_id
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+
+
+def vault_pending_response(bot_index: int, user_hash: int):
+    return jsonify({
+        "success": False,
+        "error": "Vault is being created, poll /vault-status and retry",
+        "vault_handle": vault_handle(bot_index, user_hash),
+        "vault_state": "pending",
+        "retry_after": VAULT_POLL_HINT_SECONDS,
+    }), 202
+
+
+@app.route('/create-deposit-tx', methods=['POST'])
+@admission_controlled("contract")
+def create_deposit_tx():
+    """Create contract deposit transaction for Freighter to sign"""
+    try:
+        data = request.json
+        bot_id = data.get('bot_id')
+        user_public_key = data.get('user_public_key')
+        amount = float(data.get('amount', 10))
+        
+        print(f"[DEPOSIT] Creating contract TX: bot={bot_id}, amount={amount} XLM")
+        
+        if not all([bot_id, user_public_key]):
+            return jsonify({"success": False, "error": "Missing parameters"}), 400
+        
+        bot = next((b for b in TRADING_BOTS if b['id'] == bot_id), None)
+        if not bot:
+            return jsonify({"success": False, "error": "Bot not found"}), 404
+        
+        bot_index = get_bot_index(bot_id)
+        user_hash = get_user_hash(user_public_key)
+        
+        # Get bot configuration
+        developer_address = bot['developer']
+        total_rate = bot['total_commission_rate']
+        platform_cut = bot['platform_cut_percent']
+        platform_rate = total_rate * platform_cut / 100
+        developer_net_rate = total_rate - platform_rate
         
-        # Create contract deposit XDR
-        xdr, error = contract_deposit(bot_index, user_hash, amount, user_public_key)
+        # init_vault runs in the background while the deposit is prepared. An
+        # existing vault lets the deposit simulation succeed right away; a new
+        # one has to land on ledger first, so answer 202 instead of blocking.
+        vault = start_vault_init(bot_index, user_hash, user_public_key, bot)
+        xdr = take_prepared_deposit(bot_index, user_hash, amount, user_public_key)
+        error = None
+        if xdr is None and request_deposit_prepare(bot_index, user_hash, amount, user_public_key, only_if_waiting=True):
+            # Önceki istek vault'u henüz göremedi; init bitmeden simülasyon yine başarısız olur
+            return vault_pending_response(bot_index, user_hash)
+        if xdr is None:
+            xdr, error = contract_deposit(bot_index, user_hash, amount, user_public_key)
+        
+        if error and vault['state'] == "ready":
+            # init_vault bu arada onaylandı: simülasyonu bir kez daha dene
+            xdr, error = contract_deposit(bot_index, user_hash, amount, user_public_key)
+        elif error and request_deposit_prepare(bot_index, user_hash, amount, user_public_key):
+            return vault_pending_response(bot_index, user_hash)
         
         if error:
-            return jsonify({"success": False, "error": f"Contract error: {error}"}), 400
+            return jsonify({
+                "success": False,
+                "error": f"Contract error: {error}",
+                "vault_handle": vault_handle(bot_index, user_hash),
+                "vault_state": vault['state'],
+            }), 400
+        
+        # Deposit simulation only succeeds against an existing vault
+        mark_vault_ready(bot_index, user_hash)
         
         return jsonify({
             "success": True,
             "xdr": xdr,
+            "vault_handle": vault_handle(bot_index, user_hash),
+            "vault_state": "ready",
             "network_passphrase": NETWORK_PASSPHRASE,
             "contract_id": CONTRACT_ID,
             "developer": developer_address,
@@ -588,7 +3299,21 @@ def create_deposit_tx():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/vault-status', methods=['GET'])
+def vault_status():
+    """Readiness of a vault started by create-deposit-tx (handle or bot_id + user_public_key)"""
+    key = parse_vault_handle(request.args.get('handle'))
+    if key is None:
+        bot_id = request.args.get('bot_id')
+        user_public_key = request.args.get('user_public_key')
+        if not bot_id or not user_public_key:
+            return jsonify({"success": False, "error": "Missing handle"}), 400
+        key = (get_bot_index(bot_id), get_user_hash(user_public_key))
+    return jsonify({"success": True, "vault_handle": vault_handle(*key), **get_vault_status(*key)})
+
+
 @app.route('/submit-transaction', methods=['POST'])
+@admission_controlled("contract")
 def submit_transaction():
     """Submit a signed contract transaction"""
     try:
@@ -602,17 +3327,36 @@ def submit_transaction():
         
         if not signed_xdr:
             return jsonify({"success": False, "error": "Missing signed_xdr"}), 400
+        if not (bot_id and user_public_key):
+            return jsonify({"success": False, "error": "Missing bot_id or user_public_key"}), 400
+        
+        error = preflight_signed_tx(
+            signed_xdr, "deposit", get_bot_index(bot_id), get_user_hash(user_public_key),
+            source_public_key=user_public_key, amount_stroops=int(amount * 10_000_000),
+        )
+        if error:
+            print(f"[SUBMIT] Preflight rejected: {error}")
+            return jsonify({"success": False, "error": error}), 400
+        
+        # Never send a deposit before its vault is confirmed on chain
+        vault_state = wait_for_vault(get_bot_index(bot_id), get_user_hash(user_public_key))
+        if vault_state == "pending":
+            return jsonify({"success": False, "error": "Vault not confirmed yet, retry shortly"}), 409
         
         result = submit_signed_tx(signed_xdr)
         
         if not result['success']:
+            if user_public_key:
+                publish_session_event(user_public_key, "tx_result", {
+                    "bot_id": bot_id, "kind": "deposit", "success": False, "error": result.get('error'),
+                })
             return jsonify({"success": False, "error": result.get('error')}), 400
         
         tx_hash = result.get('hash', '')
         
         # Update session
         if bot_id and user_public_key:
-            session = get_user_session(user_public_key)
+            session = get_user_session(user_public_key, create=True)
             
             if bot_id in session['active_bots']:
                 session['active_bots'][bot_id]['commission_balance'] += amount
@@ -640,6 +3384,13 @@ def submit_transaction():
                     "deposit_tx": tx_hash,
                     "contract_id": CONTRACT_ID,
                 }
+                record_subscription_change(bot_id, user_public_key, +1, 0.0)
+            
+            bot_data = session['active_bots'][bot_id]
+            publish_session_event(user_public_key, "tx_result", {
+                "bot_id": bot_id, "kind": "deposit", "success": True, "transaction_hash": tx_hash,
+            })
+            publish_bot_update(user_public_key, bot_id, bot_data, bot_data['daily_history'][-1])
         
         return jsonify({
             "success": True,
@@ -653,7 +3404,116 @@ def submit_transaction():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def run_simulate_day(session: dict, user_public_key: str, bot_id: str):
+    """Advance one subscription by a day; returns (payload, status_code)"""
+    if bot_id not in session['active_bots']:
+        return {"success": False, "error": "Not subscribed to this bot"}, 400
+    
+    bot = next((b for b in TRADING_BOTS if b['id'] == bot_id), None)
+    if not bot:
+        return {"success": False, "error": "Bot not found"}, 404
+    
+    bot_session = session['active_bots'][bot_id]
+    
+    if bot_session['commission_balance'] <= 0:
+        bot_session['is_accessible'] = False
+        return {
+            "success": False,
+            "error": "Commission balance depleted! Add more to continue.",
+            "needs_topup": True
+        }, 400
+    
+    # Generate daily performance
+    performance_percent = generate_daily_performance(bot_id, bot_session['current_day'])
+    profit_usd = bot_session['simulation_balance'] * (performance_percent / 100)
+    new_balance = bot_session['simulation_balance'] + profit_usd
+    
+    high_water_mark = bot_session.get('high_water_mark', bot_session['starting_balance'])
+    
+    # XLM/USD TWAP (spot fiyat sıçramaları komisyonu oynatmasın)
+    xlm_usd_rate = get_xlm_usd_twap()
+    total_commission_xlm = 0
+    developer_commission_xlm = 0
+    platform_commission_xlm = 0
+    
+    # Only charge commission on NEW profits above HWM
+    if new_balance > high_water_mark:
+        taxable_profit = new_balance - high_water_mark
+        taxable_profit_xlm = taxable_profit / xlm_usd_rate
+        
+        # Calculate commissions (reduced proportionally if balance is insufficient)
+        taxable_profit_xlm, total_commission_xlm, platform_commission_xlm, developer_commission_xlm = (
+            float(value) for value in calculate_commission(
+                taxable_profit_xlm,
+                bot_session['commission_balance'],
+                bot['total_commission_rate'],
+                bot['platform_cut_percent'],
+            )
+        )
+        
+        # Net the profit for a later settle_profit call (contract distributes commissions).
+        # Written to the settlement outbox before the session is touched.
+        bot_index = get_bot_index(bot_id)
+        user_hash = get_user_hash(user_public_key)
+        accrue_settlement(bot_index, user_hash, taxable_profit_xlm, total_commission_xlm, user_public_key)
+        
+        bot_session['high_water_mark'] = new_balance
+    
+    # Update session
+    bot_session['simulation_balance'] = new_balance
+    bot_session['total_profit'] += profit_usd
+    bot_session['commission_balance'] -= total_commission_xlm
+    bot_session['total_commission_paid'] += total_commission_xlm
+    bot_session['current_day'] += 1
+    
+    if bot_session['commission_balance'] <= 0:
+        bot_session['is_accessible'] = False
+    
+    history_row = {
+        "day": bot_session['current_day'],
+        "performance_percent": performance_percent,
+        "profit_usd": round(profit_usd, 2),
+        "commission_xlm": round(total_commission_xlm, 4),
+        "developer_xlm": round(developer_commission_xlm, 4),
+        "platform_xlm": round(platform_commission_xlm, 4),
+        "simulation_balance": round(bot_session['simulation_balance'], 2),
+        "commission_balance": round(bot_session['commission_balance'], 4),
+        "high_water_mark": round(bot_session['high_water_mark'], 2),
+        "xlm_usd_rate": round(xlm_usd_rate, 6),
+    }
+    bot_session['daily_history'].append(history_row)
+    record_simulated_day(
+        bot_id, user_public_key, profit_usd, total_commission_xlm,
+        developer_commission_xlm, platform_commission_xlm, bot_session['total_profit'],
+    )
+    publish_bot_update(user_public_key, bot_id, bot_session, history_row)
+    
+    print(f"[SIMULATE] Day {bot_session['current_day']}: {performance_percent}%")
+    print(f"  → Developer ({bot['developer'][:16]}...): {developer_commission_xlm:.4f} XLM")
+    print(f"  → Platform ({PLATFORM_PUBLIC_KEY[:16]}...): {platform_commission_xlm:.4f} XLM")
+    
+    return {
+        "success": True,
+        "day": bot_session['current_day'],
+        "performance_percent": performance_percent,
+        "profit_usd": round(profit_usd, 2),
+        "commission_xlm": round(total_commission_xlm, 4),
+        "developer_xlm": round(developer_commission_xlm, 4),
+        "platform_xlm": round(platform_commission_xlm, 4),
+        "simulation_balance": round(bot_session['simulation_balance'], 2),
+        "commission_balance": round(bot_session['commission_balance'], 4),
+        "high_water_mark": round(bot_session['high_water_mark'], 2),
+        "total_profit": round(bot_session['total_profit'], 2),
+        "total_commission_paid": round(bot_session['total_commission_paid'], 4),
+        "xlm_usd_rate": round(xlm_usd_rate, 6),
+        "is_accessible": bot_session['is_accessible'],
+        "commission_to": bot['developer'],
+        "contract_id": CONTRACT_ID,
+    }, 200
+
+
 @app.route('/simulate-day', methods=['POST'])
+@admission_controlled("simulate")
 def simulate_day():
     """Simulate next day's trading and calculate commissions"""
     try:
@@ -664,117 +3524,59 @@ def simulate_day():
         if not all([bot_id, user_public_key]):
             return jsonify({"success": False, "error": "Missing parameters"}), 400
         
-        session = get_user_session(user_public_key)
-        
-        if bot_id not in session['active_bots']:
-            return jsonify({"success": False, "error": "Not subscribed to this bot"}), 400
-        
-        bot = next((b for b in TRADING_BOTS if b['id'] == bot_id), None)
-        if not bot:
-            return jsonify({"success": False, "error": "Bot not found"}), 404
-        
-        bot_session = session['active_bots'][bot_id]
-        
-        if bot_session['commission_balance'] <= 0:
-            bot_session['is_accessible'] = False
-            return jsonify({
-                "success": False,
-                "error": "Commission balance depleted! Add more to continue.",
-                "needs_topup": True
-            }), 400
-        
-        # Generate daily performance
-        performance_percent = generate_daily_performance()
-        profit_usd = bot_session['simulation_balance'] * (performance_percent / 100)
-        new_balance = bot_session['simulation_balance'] + profit_usd
-        
-        high_water_mark = bot_session.get('high_water_mark', bot_session['starting_balance'])
-        
-        # Get real-time XLM/USD price
-        xlm_usd_rate = get_xlm_usd_price()
-        total_commission_xlm = 0
-        developer_commission_xlm = 0
-        platform_commission_xlm = 0
-        
-        # Only charge commission on NEW profits above HWM
-        if new_balance > high_water_mark:
-            taxable_profit = new_balance - high_water_mark
-            taxable_profit_xlm = taxable_profit / xlm_usd_rate
-            
-            total_commission_rate = bot['total_commission_rate']
-            platform_cut_percent = bot['platform_cut_percent']
-            
-            # Calculate commissions
-            total_commission_xlm = taxable_profit_xlm * (total_commission_rate / 100)
-            platform_commission_xlm = total_commission_xlm * (platform_cut_percent / 100)
-            developer_commission_xlm = total_commission_xlm - platform_commission_xlm
-            
-            if total_commission_xlm > bot_session['commission_balance']:
-                # Reduce proportionally if insufficient balance
-                ratio = bot_session['commission_balance'] / total_commission_xlm
-                taxable_profit_xlm *= ratio
-                total_commission_xlm = bot_session['commission_balance']
-                platform_commission_xlm = total_commission_xlm * (platform_cut_percent / 100)
-                developer_commission_xlm = total_commission_xlm - platform_commission_xlm
-            
-            bot_session['high_water_mark'] = new_balance
-            
-            # Call contract to settle profit (contract calculates and distributes commissions)
-            if taxable_profit_xlm > 0.0001:
-                bot_index = get_bot_index(bot_id)
-                user_hash = get_user_hash(user_public_key)
-                contract_settle_profit(bot_index, user_hash, taxable_profit_xlm)
-        
-        # Update session
-        bot_session['simulation_balance'] = new_balance
-        bot_session['total_profit'] += profit_usd
-        bot_session['commission_balance'] -= total_commission_xlm
-        bot_session['total_commission_paid'] += total_commission_xlm
-        bot_session['current_day'] += 1
-        
-        if bot_session['commission_balance'] <= 0:
-            bot_session['is_accessible'] = False
-        
-        bot_session['daily_history'].append({
-            "day": bot_session['current_day'],
-            "performance_percent": performance_percent,
-            "profit_usd": round(profit_usd, 2),
-            "commission_xlm": round(total_commission_xlm, 4),
-            "developer_xlm": round(developer_commission_xlm, 4),
-            "platform_xlm": round(platform_commission_xlm, 4),
-            "simulation_balance": round(bot_session['simulation_balance'], 2),
-            "commission_balance": round(bot_session['commission_balance'], 4),
-            "high_water_mark": round(bot_session['high_water_mark'], 2)
-        })
-        
-        print(f"[SIMULATE] Day {bot_session['current_day']}: {performance_percent}%")
-        print(f"  → Developer ({bot['developer'][:16]}...): {developer_commission_xlm:.4f} XLM")
-        print(f"  → Platform ({PLATFORM_PUBLIC_KEY[:16]}...): {platform_commission_xlm:.4f} XLM")
-        
-        return jsonify({
-            "success": True,
-            "day": bot_session['current_day'],
-            "performance_percent": performance_percent,
-            "profit_usd": round(profit_usd, 2),
-            "commission_xlm": round(total_commission_xlm, 4),
-            "developer_xlm": round(developer_commission_xlm, 4),
-            "platform_xlm": round(platform_commission_xlm, 4),
-            "simulation_balance": round(bot_session['simulation_balance'], 2),
-            "commission_balance": round(bot_session['commission_balance'], 4),
-            "high_water_mark": round(bot_session['high_water_mark'], 2),
-            "total_profit": round(bot_session['total_profit'], 2),
-            "total_commission_paid": round(bot_session['total_commission_paid'], 4),
-            "is_accessible": bot_session['is_accessible'],
-            "commission_to": bot['developer'],
-            "contract_id": CONTRACT_ID,
-        })
+        payload, status_code = run_simulate_day(get_user_session(user_public_key), user_public_key, bot_id)
+        return jsonify(payload), status_code
         
     except Exception as e:
         print(f"[SIMULATE] Error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def run_withdraw_prepare(session: dict, user_public_key: str, bot_id: str):
+    """Queue pending settlement and build the withdraw XDR; returns (payload, status_code)"""
+    if bot_id not in session['active_bots']:
+        return {"success": False, "error": "Not subscribed"}, 400
+    
+    bot_session = session['active_bots'][bot_id]
+    remaining = bot_session['commission_balance']
+    bot_index = get_bot_index(bot_id)
+    user_hash = get_user_hash(user_public_key)
+    
+    # Queue netted profit for settlement; the worker pays it out in the background
+    request_settlement_flush(bot_index, user_hash, reason="withdraw")
+    
+    if remaining <= 0.0001:
+        try:
+            close_subscription(session, user_public_key, bot_id)
+        except OSError as e:
+            print(f"[ARCHIVE] Could not archive {bot_id} for {user_public_key[:8]}...: {e}")
+            return {"success": False, "error": "Could not archive the subscription history, retry shortly"}, 503
+        publish_session_event(user_public_key, "bot_removed", {"bot_id": bot_id, "amount_withdrawn": 0})
+        return {
+            "success": True,
+            "message": "No balance to withdraw",
+            "amount_withdrawn": 0,
+            "needs_signing": False
+        }, 200
+    
+    # Create contract withdraw XDR
+    xdr, error = contract_withdraw(bot_index, user_hash, remaining, user_public_key)
+    
+    if error:
+        return {"success": False, "error": f"Contract error: {error}"}, 400
+    
+    return {
+        "success": True,
+        "xdr": xdr,
+        "amount": round(remaining, 4),
+        "network_passphrase": NETWORK_PASSPHRASE,
+        "contract_id": CONTRACT_ID,
+        "needs_signing": True
+    }, 200
+
+
 @app.route('/withdraw', methods=['POST'])
+@admission_controlled("contract")
 def withdraw():
     """Create contract withdraw transaction"""
     try:
@@ -785,46 +3587,15 @@ def withdraw():
         if not all([bot_id, user_public_key]):
             return jsonify({"success": False, "error": "Missing parameters"}), 400
         
-        session = get_user_session(user_public_key)
-        
-        if bot_id not in session['active_bots']:
-            return jsonify({"success": False, "error": "Not subscribed"}), 400
-        
-        bot_session = session['active_bots'][bot_id]
-        remaining = bot_session['commission_balance']
-        
-        if remaining <= 0.0001:
-            del session['active_bots'][bot_id]
-            return jsonify({
-                "success": True,
-                "message": "No balance to withdraw",
-                "amount_withdrawn": 0,
-                "needs_signing": False
-            })
-        
-        # Create contract withdraw XDR
-        bot_index = get_bot_index(bot_id)
-        user_hash = get_user_hash(user_public_key)
-        
-        xdr, error = contract_withdraw(bot_index, user_hash, remaining, user_public_key)
-        
-        if error:
-            return jsonify({"success": False, "error": f"Contract error: {error}"}), 400
-        
-        return jsonify({
-            "success": True,
-            "xdr": xdr,
-            "amount": round(remaining, 4),
-            "network_passphrase": NETWORK_PASSPHRASE,
-            "contract_id": CONTRACT_ID,
-            "needs_signing": True
-        })
+        payload, status_code = run_withdraw_prepare(get_user_session(user_public_key), user_public_key, bot_id)
+        return jsonify(payload), status_code
         
     except Exception as e:
         print(f"[WITHDRAW] Error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/submit-withdraw', methods=['POST'])
+@admission_controlled("contract")
 def submit_withdraw():
     """Submit signed withdraw transaction"""
     try:
@@ -835,22 +3606,55 @@ def submit_withdraw():
         
         if not signed_xdr:
             return jsonify({"success": False, "error": "Missing signed_xdr"}), 400
+        if not (bot_id and user_public_key):
+            return jsonify({"success": False, "error": "Missing bot_id or user_public_key"}), 400
+        
+        bot_data = get_user_session(user_public_key)['active_bots'].get(bot_id)
+        error = preflight_signed_tx(
+            signed_xdr, "withdraw", get_bot_index(bot_id), get_user_hash(user_public_key),
+            source_public_key=user_public_key,
+            max_amount_stroops=int(bot_data['commission_balance'] * 10_000_000) if bot_data else None,
+        )
+        if error:
+            print(f"[SUBMIT-WITHDRAW] Preflight rejected: {error}")
+            return jsonify({"success": False, "error": error}), 400
         
         result = submit_signed_tx(signed_xdr)
         
         if not result['success']:
+            if user_public_key:
+                publish_session_event(user_public_key, "tx_result", {
+                    "bot_id": bot_id, "kind": "withdraw", "success": False, "error": result.get('error'),
+                })
             return jsonify({"success": False, "error": result.get('error')}), 400
         
         # Remove subscription
         session = get_user_session(user_public_key)
         amount = 0
+        archived = True
         if bot_id in session['active_bots']:
-            amount = session['active_bots'][bot_id]['commission_balance']
-            del session['active_bots'][bot_id]
+            bot_data = session['active_bots'][bot_id]
+            amount = bot_data['commission_balance']
+            try:
+                close_subscription(session, user_public_key, bot_id)
+            except OSError as e:
+                # Çekim zincirde gerçekleşti: bakiye sıfırlanır, abonelik arşivlenene kadar
+                # oturumda kalır; bir sonraki /withdraw (sıfır bakiye) arşivlemeyi yeniden dener
+                print(f"[ARCHIVE] Could not archive {bot_id} for {user_public_key[:8]}...: {e}")
+                bot_data['amount_withdrawn'] = amount
+                bot_data['commission_balance'] = 0.0
+                archived = False
+        
+        publish_session_event(user_public_key, "tx_result", {
+            "bot_id": bot_id, "kind": "withdraw", "success": True, "transaction_hash": result.get('hash', ''),
+        })
+        if archived:
+            publish_session_event(user_public_key, "bot_removed", {"bot_id": bot_id, "amount_withdrawn": round(amount, 4)})
         
         return jsonify({
             "success": True,
             "amount_withdrawn": round(amount, 4),
+            "archived": archived,
             "transaction_hash": result.get('hash', ''),
             "explorer_url": f"https://stellar.expert/explorer/testnet/tx/{result.get('hash', '')}"
         })
@@ -859,6 +3663,49 @@ def submit_withdraw():
         print(f"[SUBMIT-WITHDRAW] Error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+def run_reset_simulation(session: dict, user_public_key: str, bot_id: str):
+    """Reset one subscription's simulation (keeps the deposit); returns (payload, status_code)"""
+    if bot_id not in session['active_bots']:
+        return {"success": False, "error": "Not subscribed"}, 400
+    
+    bot_session = session['active_bots'][bot_id]
+    original_deposit = bot_session['total_deposited']
+    
+    session['active_bots'][bot_id] = {
+        "commission_balance": original_deposit,
+        "total_deposited": original_deposit,
+        "total_commission_paid": 0,
+        "simulation_balance": STARTING_SIMULATION_BALANCE,
+        "starting_balance": STARTING_SIMULATION_BALANCE,
+        "total_profit": 0,
+        "high_water_mark": STARTING_SIMULATION_BALANCE,
+        "current_day": 0,
+        "daily_history": [{
+            "day": 0,
+            "performance_percent": 0,
+            "profit_usd": 0,
+            "commission_xlm": 0,
+            "simulation_balance": STARTING_SIMULATION_BALANCE,
+            "commission_balance": original_deposit,
+            "high_water_mark": STARTING_SIMULATION_BALANCE
+        }],
+        "is_accessible": True,
+    }
+    
+    bot_data = session['active_bots'][bot_id]
+    record_subscription_change(bot_id, user_public_key, 0, bot_data['total_profit'])
+    publish_session_event(user_public_key, "bot_reset", {
+        "bot": build_bot_status(user_public_key, bot_id, bot_data),
+    })
+    
+    return {
+        "success": True,
+        "message": "Simulation reset!",
+        "new_commission_balance": original_deposit,
+        "new_simulation_balance": STARTING_SIMULATION_BALANCE
+    }, 200
+
+
 @app.route('/reset-simulation', methods=['POST'])
 def reset_simulation():
     """Reset simulation (keeps deposit, resets trading simulation)"""
@@ -870,70 +3717,289 @@ def reset_simulation():
         if not all([bot_id, user_public_key]):
             return jsonify({"success": False, "error": "Missing parameters"}), 400
         
-        session = get_user_session(user_public_key)
-        
-        if bot_id not in session['active_bots']:
-            return jsonify({"success": False, "error": "Not subscribed"}), 400
-        
-        bot_session = session['active_bots'][bot_id]
-        original_deposit = bot_session['total_deposited']
-        
-        session['active_bots'][bot_id] = {
-            "commission_balance": original_deposit,
-            "total_deposited": original_deposit,
-            "total_commission_paid": 0,
-            "simulation_balance": STARTING_SIMULATION_BALANCE,
-            "starting_balance": STARTING_SIMULATION_BALANCE,
-            "total_profit": 0,
-            "high_water_mark": STARTING_SIMULATION_BALANCE,
-            "current_day": 0,
-            "daily_history": [{
-                "day": 0,
-                "performance_percent": 0,
-                "profit_usd": 0,
-                "commission_xlm": 0,
-                "simulation_balance": STARTING_SIMULATION_BALANCE,
-                "commission_balance": original_deposit,
-                "high_water_mark": STARTING_SIMULATION_BALANCE
-            }],
-            "is_accessible": True,
-        }
-        
-        return jsonify({
-            "success": True,
-            "message": "Simulation reset!",
-            "new_commission_balance": original_deposit,
-            "new_simulation_balance": STARTING_SIMULATION_BALANCE
-        })
+        payload, status_code = run_reset_simulation(get_user_session(user_public_key), user_public_key, bot_id)
+        return jsonify(payload), status_code
         
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+# /batch: one round trip for chatty client flows (e.g. simulate several bots, then
+# refresh status). All ops run in order against a single session load.
+BATCH_MAX_OPS = int(os.getenv("WHALEER_BATCH_MAX_OPS", "50"))
+BATCH_OPS = {
+    "simulate-day": run_simulate_day,
+    "reset": run_reset_simulation,
+    "withdraw-prepare": run_withdraw_prepare,
+}
+
+
+def run_batch_ops(user_public_key: str, ops: list, stop_on_error: bool = False):
+    session = get_user_session(user_public_key)
+    results = []
+    for position, op in enumerate(ops):
+        name = op.get('op') if isinstance(op, dict) else None
+        try:
+            if name == "status":
+                try:
+                    max_points = parse_max_points(op.get('max_points'), default=None)
+                    payload, status_code = build_status_payload(user_public_key, session, max_points), 200
+                except ValueError:
+                    payload, status_code = {"success": False, "error": "Invalid max_points"}, 400
+            elif name in BATCH_OPS:
+                if not op.get('bot_id'):
+                    payload, status_code = {"success": False, "error": "Missing bot_id"}, 400
+                else:
+                    payload, status_code = BATCH_OPS[name](session, user_public_key, op['bot_id'])
+            else:
+                payload, status_code = {"success": False, "error": f"Unknown op: {name}"}, 400
+        except Exception as e:
+            print(f"[BATCH] Error in op {position} ({name}): {e}")
+            payload, status_code = {"success": False, "error": str(e)}, 500
+
+        results.append({"op": name, "status": status_code, **payload})
+        if stop_on_error and status_code >= 400:
+            break
+    return results
+
+
+def _batch():
+    data = request.json or {}
+    results = run_batch_ops(data['user_public_key'], data['ops'], bool(data.get('stop_on_error')))
+    return jsonify({
+        "success": all(result['success'] for result in results),
+        "executed": len(results),
+        "stopped": len(results) < len(data['ops']),
+        "results": results,
+    })
+
+
+# withdraw-prepare talks to the RPC, so such batches queue in the contract pool
+_batch_simulate_pool = admission_controlled("simulate")(_batch)
+_batch_contract_pool = admission_controlled("contract")(_batch)
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Run status / simulate-day / reset / withdraw-prepare ops for one wallet in one request"""
+    data = request.get_json(silent=True) or {}
+    ops = data.get('ops')
+    
+    if not data.get('user_public_key') or not isinstance(ops, list) or not ops:
+        return jsonify({"success": False, "error": "Missing parameters"}), 400
+    if len(ops) > BATCH_MAX_OPS:
+        return jsonify({"success": False, "error": f"At most {BATCH_MAX_OPS} ops per batch"}), 400
+    
+    needs_contract = any(isinstance(op, dict) and op.get('op') == "withdraw-prepare" for op in ops)
+    return (_batch_contract_pool if needs_contract else _batch_simulate_pool)()
+
+@app.route('/forecast', methods=['GET'])
+@admission_controlled("compute")
+def forecast():
+    """Monte Carlo forecast of commission depletion for one subscription"""
+    public_key = request.args.get('public_key')
+    bot_id = request.args.get('bot_id')
+    
+    if not all([public_key, bot_id]):
+        return jsonify({"success": False, "error": "Missing parameters"}), 400
+    
+    try:
+        paths = min(max(int(request.args.get('paths', FORECAST_DEFAULT_PATHS)), 1), FORECAST_MAX_PATHS)
+        days = min(max(int(request.args.get('days', FORECAST_DEFAULT_DAYS)), 1), FORECAST_MAX_DAYS)
+        paths = min(paths, max(FORECAST_MAX_PATH_DAYS // days, 1))
+        seed = parse_query_arg('seed')
+        twap_window = parse_query_arg('twap_window', float)
+        if twap_window is not None and twap_window <= 0:
+            raise ValueError("twap_window must be positive")
+        if seed is not None and seed < 0:
+            raise ValueError("seed must be non-negative")
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid paths/days/seed/twap_window"}), 400
+    
+    session = get_user_session(public_key)
+    
+    if bot_id not in session['active_bots']:
+        return jsonify({"success": False, "error": "Not subscribed to this bot"}), 400
+    
+    bot = next((b for b in TRADING_BOTS if b['id'] == bot_id), None)
+    if not bot:
+        return jsonify({"success": False, "error": "Bot not found"}), 404
+    
+    started = time.perf_counter()
+    result = forecast_commission_depletion(
+        bot, session['active_bots'][bot_id], get_xlm_usd_twap(twap_window), paths, days, seed
+    )
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    
+    return jsonify({"success": True, "bot_id": bot_id, **result})
+
+
+@app.route('/price-history', methods=['GET'])
+def price_history():
+    """Recorded XLM/USD ticks and the current TWAP (for audits and offline replays)"""
+    try:
+        since = parse_query_arg('since', float)
+        window = parse_query_arg('window', float, XLM_TWAP_WINDOW_SECONDS)
+        if window <= 0:
+            raise ValueError("window must be positive")
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid parameters"}), 400
+    
+    return jsonify({
+        "success": True,
+        "spot": xlm_price_ticks.latest() or xlm_price_cache['price'],
+        "twap": xlm_price_ticks.twap(window),
+        "twap_window_seconds": window,
+        "ticks": xlm_price_ticks.ticks(since),
+    })
+
+
+@app.route('/settlements', methods=['GET'])
+def get_settlements():
+    """Accrued, pending and settled commission per vault of a user"""
+    public_key = request.args.get('public_key')
+    
+    if not public_key:
+        return jsonify({"success": False, "error": "Missing public_key"}), 400
+    
+    user_hash = get_user_hash(public_key)
+    get_settlement_outbox()
+    vaults = []
+    for bot_index, bot in enumerate(TRADING_BOTS):
+        if (bot_index, user_hash) not in settlement_ledger:
+            continue
+        summary = get_settlement_summary(bot_index, user_hash)
+        summary['bot_id'] = bot['id']
+        vaults.append(summary)
+    
+    return jsonify({
+        "success": True,
+        "user_public_key": public_key,
+        "flush_profit_xlm": SETTLEMENT_FLUSH_PROFIT_XLM,
+        "flush_interval_seconds": SETTLEMENT_FLUSH_INTERVAL_SECONDS,
+        "vaults": vaults
+    })
+
 @app.route('/topup', methods=['POST'])
+@admission_controlled("contract")
 def topup():
     """Create topup transaction (same as deposit)"""
-    return create_deposit_tx()
+    return create_deposit_tx.__wrapped__()
+
+@app.route('/admin/aggregates', methods=['GET'])
+@admin_required
+def admin_aggregates():
+    """Per-bot and per-day revenue counters plus top subscriptions by profit"""
+    top_n = request.args.get('top', AGGREGATES_DEFAULT_TOP_N, type=int)
+    return jsonify({"success": True, **get_aggregates(request.args.get('day'), max(top_n, 0))})
+
+@app.route('/admin/settlements', methods=['GET'])
+@admin_required
+def admin_settlements():
+    """Settlement outbox state: in-flight batches and dead letters"""
+    return jsonify({"success": True, **get_settlement_outbox_stats()})
+
+@app.route('/admin/settlements/requeue', methods=['POST'])
+@admin_required
+def admin_requeue_settlement():
+    """Move a dead-lettered settlement batch back to pending"""
+    settlement_id = (request.json or {}).get('id')
+    if not settlement_id:
+        return jsonify({"success": False, "error": "Missing id"}), 400
+    if not requeue_dead_settlement(settlement_id):
+        return jsonify({"success": False, "error": "Dead letter not found"}), 404
+    return jsonify({"success": True, "id": settlement_id})
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+@admin_required
+def admin_profiler():
+    """Profiler status; POST toggles it (enabled, sample_rate, interval_ms, reset)"""
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            configure_profiler(
+                enabled=data.get('enabled'),
+                sample_rate=data.get('sample_rate'),
+                interval_ms=data.get('interval_ms'),
+                reset=bool(data.get('reset')),
+            )
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "Invalid profiler settings"}), 400
+    return jsonify({"success": True, **get_profiler_status()})
+
+@app.route('/admin/profiler/dump', methods=['GET'])
+@admin_required
+def admin_profiler_dump():
+    """Collapsed stacks (flamegraph.pl / speedscope) or a JSON summary with format=json"""
+    fmt = request.args.get('format', 'collapsed')
+    reset = request.args.get('reset') == '1'
+    if fmt == 'json':
+        top = request.args.get('top', 50, type=int)
+        return jsonify({"success": True, **dump_profile("json", top, reset)})
+    return Response(dump_profile("collapsed", reset=reset), mimetype='text/plain')
+
+@app.route('/admin/sessions', methods=['GET'])
+@admin_required
+def session_stats():
+    """Session cache entry count, memory estimate and eviction counters"""
+    return jsonify({"success": True, **user_sessions.stats()})
+
+@app.route('/admin/sessions/keys', methods=['GET'])
+@admin_required
+def session_keys():
+    """Wallets whose sessions or vault ledgers this process holds (used by main.py to rebalance shards)"""
+    return jsonify({"success": True, "keys": sorted(set(user_sessions.keys()) | settlement_public_keys())})
+
+@app.route('/admin/sessions/export', methods=['POST'])
+@admin_required
+def export_sessions():
+    """
+    Hand sessions over to another shard: removes them here and returns them
+    with their vaults' settlement entries (all_settlements: every vault left)
+    """
+    data = request.json or {}
+    public_keys = data.get('keys') or []
+    sessions = {}
+    for public_key in public_keys:
+        session = user_sessions.pop(public_key)
+        if session is None:
+            continue
+        for bot_id in session['active_bots']:
+            record_subscription_change(bot_id, public_key, -1)
+        drop_session_events(public_key)
+        sessions[public_key] = session
+    settlements = export_settlements(None if data.get('all_settlements') else public_keys)
+    return jsonify({"success": True, "sessions": sessions, "settlements": settlements})
+
+@app.route('/admin/sessions/import', methods=['POST'])
+@admin_required
+def import_sessions():
+    """Take ownership of sessions (and their vaults' settlement entries) exported by another shard"""
+    data = request.json or {}
+    try:
+        settlements = import_settlements(data.get('settlements') or [])
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    sessions = data.get('sessions') or {}
+    for public_key, session in sessions.items():
+        user_sessions.put(public_key, session)
+        for bot_id, bot_data in session['active_bots'].items():
+            record_subscription_change(bot_id, public_key, +1, bot_data['total_profit'])
+    return jsonify({"success": True, "imported": len(sessions), "settlements": settlements})
+
+@app.route('/admin/admission', methods=['GET'])
+@admin_required
+def admission_stats():
+    """Concurrency, queue and rejection counters per admission pool"""
+    return jsonify({"success": True, **get_admission_stats()})
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({
-        "status": "healthy",
-        "network": "stellar-testnet",
-        "contract_id": CONTRACT_ID,
-        "developer": DEVELOPER_PUBLIC_KEY,
-    })
+    return Response(HEALTH_RESPONSE, mimetype='application/json')
 
 @app.route('/contract-info', methods=['GET'])
 def contract_info():
     """Get contract information"""
-    return jsonify({
-        "success": True,
-        "contract_id": CONTRACT_ID,
-        "developer_wallet": DEVELOPER_PUBLIC_KEY,
-        "native_asset": NATIVE_ASSET_ID,
-        "network": "testnet",
-        "explorer": f"https://stellar.expert/explorer/testnet/contract/{CONTRACT_ID}"
-    })
+    return Response(CONTRACT_INFO_RESPONSE, mimetype='application/json')
 
 if __name__ == '__main__':
     print("=" * 60)
@@ -948,4 +4014,9 @@ if __name__ == '__main__':
     print("=" * 60)
     print()
     
-    app.run(host='127.0.0.1', port=5328, debug=True)
\ No newline at end of file
+    # main.py starts shard workers with their own port and debug disabled
+    app.run(
+        host='127.0.0.1',
+        port=int(os.getenv("WHALEER_PORT", "5328")),
+        debug=os.getenv("WHALEER_DEBUG", "1") == "1",
+    )
\ No newline at end of file
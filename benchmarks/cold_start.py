@@ -0,0 +1,86 @@
+"""
+Cold-start benchmark for the serverless entry point (api/index.py).
+
+Each sample runs in a fresh interpreter, so it measures what a new serverless
+instance pays: importing the module (Flask app + routes) and serving the first
+request of a cheap route. Also prints the heaviest modules from
+`python -X importtime`.
+
+Usage:
+    python benchmarks/cold_start.py [--samples 10] [--top 15]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+CHEAP_ROUTES = ["/health", "/bots", "/contract-info"]
+
+SAMPLE_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+client = index.app.test_client()
+response = client.get(sys.argv[1])
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (served - imported) * 1000,
+    "stellar_sdk_loaded": "stellar_sdk" in sys.modules,
+    "numpy_loaded": "numpy" in sys.modules,
+}))
+"""
+
+
+def run_sample(route: str):
+    output = subprocess.run(
+        [sys.executable, "-c", SAMPLE_SCRIPT, route],
+        cwd=API_DIR, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_profile(top: int):
+    """Heaviest modules by cumulative import time (microseconds)"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import index"],
+        cwd=API_DIR, capture_output=True, text=True, check=True,
+    ).stderr
+
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line.split(":", 1)[1].split("|")
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for api/index.py")
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    print(f"Python {sys.version.split()[0]}, {args.samples} fresh interpreters per route\n")
+    print(f"{'route':<16}{'import ms':>12}{'first req ms':>14}{'total ms':>12}  heavy deps loaded")
+    for route in CHEAP_ROUTES:
+        samples = [run_sample(route) for _ in range(args.samples)]
+        import_ms = statistics.median(s["import_ms"] for s in samples)
+        request_ms = statistics.median(s["first_request_ms"] for s in samples)
+        heavy = [name for name in ("stellar_sdk", "numpy") if samples[-1][f"{name}_loaded"]]
+        print(f"{route:<16}{import_ms:>12.1f}{request_ms:>14.1f}{import_ms + request_ms:>12.1f}  {', '.join(heavy) or '-'}")
+
+    print(f"\nTop {args.top} modules by cumulative import time (python -X importtime):")
+    for cumulative_us, self_us, module in import_profile(args.top):
+        print(f"{cumulative_us / 1000:>9.1f} ms  (self {self_us / 1000:>6.1f} ms)  {module}")
+
+
+if __name__ == "__main__":
+    main()
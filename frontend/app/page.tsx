@@ -1,6 +1,6 @@
 'use client';
 
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { isConnected, requestAccess, getAddress, signTransaction, getNetwork } from '@stellar/freighter-api';
 
 interface Bot {
@@ -95,6 +95,7 @@ export default function Home() {
     simulation_balance: number;
     commission_balance: number;
   } | null>(null);
+  const statusStreamLive = useRef(false);
 
   // 1) Freighter var mı yok mu kontrolü (timeout'lu)
   useEffect(() => {
@@ -188,6 +189,68 @@ export default function Home() {
     }
   }, [wallet.isConnected, wallet.publicKey]);
 
+  // Session delta stream (SSE) — /status yeniden çekmek yerine değişiklikleri uygula
+  useEffect(() => {
+    if (!wallet.isConnected || !wallet.publicKey || typeof EventSource === 'undefined') return;
+
+    const source = new EventSource(`/api/status/stream?public_key=${encodeURIComponent(wallet.publicKey)}`);
+
+    source.onopen = () => {
+      statusStreamLive.current = true;
+    };
+    source.onerror = () => {
+      // EventSource reconnects on its own and resumes from Last-Event-ID
+      statusStreamLive.current = false;
+    };
+
+    source.addEventListener('snapshot', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      if (data.success) {
+        setUserStatus(data);
+      }
+    });
+
+    source.addEventListener('bot_update', (e) => {
+      const { bot, history_row } = JSON.parse((e as MessageEvent).data);
+      setUserStatus((prev) => {
+        const activeBots = prev?.active_bots || [];
+        const existing = activeBots.find((b) => b.bot_id === bot.bot_id);
+        let history = existing?.daily_history || [];
+        if (history_row && !history.some((row) => row.day === history_row.day)) {
+          history = [...history, history_row];
+        }
+        const updated: ActiveBot = { ...existing, ...bot, daily_history: history };
+        return {
+          user_public_key: prev?.user_public_key || wallet.publicKey!,
+          active_bots: existing
+            ? activeBots.map((b) => (b.bot_id === bot.bot_id ? updated : b))
+            : [...activeBots, updated],
+        };
+      });
+    });
+
+    source.addEventListener('bot_reset', (e) => {
+      const { bot } = JSON.parse((e as MessageEvent).data);
+      setUserStatus((prev) => prev && {
+        ...prev,
+        active_bots: prev.active_bots.map((b) => (b.bot_id === bot.bot_id ? bot : b)),
+      });
+    });
+
+    source.addEventListener('bot_removed', (e) => {
+      const { bot_id } = JSON.parse((e as MessageEvent).data);
+      setUserStatus((prev) => prev && {
+        ...prev,
+        active_bots: prev.active_bots.filter((b) => b.bot_id !== bot_id),
+      });
+    });
+
+    return () => {
+      statusStreamLive.current = false;
+      source.close();
+    };
+  }, [wallet.isConnected, wallet.publicKey]);
+
   const fetchBots = async () => {
     try {
       const res = await fetch('/api/bots');
@@ -214,6 +277,13 @@ export default function Home() {
     }
   };
 
+  // Stream açıksa değişiklikler zaten SSE ile geliyor
+  const refreshUserStatus = () => {
+    if (!statusStreamLive.current) {
+      fetchUserStatus();
+    }
+  };
+
   const checkAccountBalance = async () => {
     if (!wallet.publicKey) return;
 
@@ -302,6 +372,36 @@ export default function Home() {
     setShowTopupModal(true);
   };
 
+  // A first deposit answers 202 while the vault's init_vault is confirming:
+  // poll /vault-status and ask again instead of holding the request open
+  const requestDepositTx = async (body: Record<string, unknown>) => {
+    const deadline = Date.now() + 90_000;
+    while (true) {
+      const res = await fetch('/api/create-deposit-tx', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body),
+      });
+      const data = await res.json();
+      if (res.status !== 202) return data;
+
+      setMessage({ type: 'info', text: 'Creating your vault on-chain...' });
+      let state = data.vault_state;
+      while (state === 'pending') {
+        if (Date.now() > deadline) throw new Error('Vault creation is taking too long, please retry');
+        await new Promise((resolve) => setTimeout(resolve, (data.retry_after || 2) * 1000));
+        // bot_id + user_public_key route the poll to the shard that owns this wallet
+        const query = new URLSearchParams({
+          handle: data.vault_handle,
+          bot_id: String(body.bot_id),
+          user_public_key: String(body.user_public_key),
+        });
+        const statusRes = await fetch(`/api/vault-status?${query}`);
+        state = (await statusRes.json()).state;
+      }
+    }
+  };
+
   const handleDeposit = async () => {
     if (!selectedBot || !wallet.publicKey || !freighterInstalled) return;
 
@@ -309,18 +409,12 @@ export default function Home() {
     setMessage(null);
 
     try {
-      const res = await fetch('/api/create-deposit-tx', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          bot_id: selectedBot.id,
-          user_public_key: wallet.publicKey,
-          amount: depositAmount,
-        }),
+      const data = await requestDepositTx({
+        bot_id: selectedBot.id,
+        user_public_key: wallet.publicKey,
+        amount: depositAmount,
       });
 
-      const data = await res.json();
-
       if (!data.success) {
         throw new Error(data.error || 'Failed to create transaction');
       }
@@ -359,7 +453,7 @@ export default function Home() {
           text: `${depositAmount} XLM commission deposited${contractText}! $100 simulation started.`
         });
         setShowDepositModal(false);
-        fetchUserStatus();
+        refreshUserStatus();
         checkAccountBalance();
       } else {
         throw new Error(submitData.error || 'Failed to submit transaction');
@@ -432,7 +526,7 @@ export default function Home() {
           text: `+${topupAmount} XLM commission balance added!`
         });
         setShowTopupModal(false);
-        fetchUserStatus();
+        refreshUserStatus();
         checkAccountBalance();
       } else {
         throw new Error(submitData.error || 'Failed to submit transaction');
@@ -502,7 +596,7 @@ export default function Home() {
           type: 'success',
           text: `🔗 Contract deposit successful! ${amount} XLM deposited to smart contract`
         });
-        fetchUserStatus();
+        refreshUserStatus();
         checkAccountBalance();
       } else {
         throw new Error(submitData.error || 'Contract deposit failed');
@@ -527,16 +621,24 @@ export default function Home() {
     setMessage(null);
 
     try {
-      const res = await fetch('/api/simulate-day', {
+      // Simülasyon + status tek istekte (stream açıksa status zaten SSE ile geliyor)
+      const ops: { op: string; bot_id?: string }[] = [{ op: 'simulate-day', bot_id: botId }];
+      if (!statusStreamLive.current) {
+        ops.push({ op: 'status' });
+      }
+
+      const res = await fetch('/api/batch', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
-          bot_id: botId,
           user_public_key: wallet.publicKey,
+          ops,
+          stop_on_error: true,
         }),
       });
 
-      const data = await res.json();
+      const batch = await res.json();
+      const data = batch.results?.[0] ?? batch;
 
       if (data.success) {
         let scenario: 'profit' | 'loss' | 'below_hwm' = 'profit';
@@ -559,7 +661,10 @@ export default function Home() {
           commission_balance: data.commission_balance,
         });
 
-        fetchUserStatus();
+        const status = batch.results?.[1];
+        if (status?.success) {
+          setUserStatus(status);
+        }
         checkAccountBalance();
       } else {
         if (data.needs_topup) {
@@ -606,7 +711,7 @@ export default function Home() {
         } else {
           setMessage({ type: 'info', text: 'No balance to withdraw' });
         }
-        fetchUserStatus();
+        refreshUserStatus();
         checkAccountBalance();
         return;
       }
@@ -644,7 +749,7 @@ export default function Home() {
         }
       }
 
-      fetchUserStatus();
+      refreshUserStatus();
       checkAccountBalance();
 
     } catch (error: unknown) {
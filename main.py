@@ -0,0 +1,451 @@
+"""
+Local multi-process runner for the Flask backend (api/index.py).
+
+Sessions live in process memory, so every wallet is owned by exactly one
+worker process: a consistent-hash ring on user_public_key picks the owner and
+this dispatcher forwards each request to it. Workers never share session
+state, so updates need no cross-process locks, and CPU-bound routes
+(/simulate-day, /forecast, /batch) scale with cores instead of one GIL.
+
+Adding or removing a worker only moves the wallets whose ring owner changed:
+their sessions and vault settlement ledgers are exported from the old owner and
+imported into the new one through /admin/sessions/*, while requests for those
+wallets wait. A removed worker hands any settlement state still left on it to
+the surviving shards before it is stopped, so no pending payout is stranded in
+its outbox file.
+
+Usage:
+    python main.py --workers 4       # dispatcher on :5328, workers on :5400+
+    curl -X POST   -H "X-Admin-Token: $TOKEN" localhost:5328/admin/shards          # add a worker
+    curl -X DELETE -H "X-Admin-Token: $TOKEN" localhost:5328/admin/shards/shard-1  # remove one
+"""
+
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect
+from collections import Counter
+
+import requests
+from flask import Flask, Response, jsonify, request
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api")
+VIRTUAL_NODES = 128
+WORKER_START_TIMEOUT_SECONDS = 30
+# Export, worker'ın o an gönderdiği settle_profit denemesini (≤30 s poll) bekleyebilir
+EXPORT_TIMEOUT_SECONDS = 120
+# İki import da başarısız olursa taşınan session'lar kaybolmasın diye buraya yazılır
+RESCUE_DIR = os.getenv("WHALEER_SHARD_RESCUE_DIR", os.path.dirname(os.path.abspath(__file__)))
+HOP_HEADERS = {"connection", "content-length", "content-encoding", "keep-alive", "transfer-encoding", "host"}
+ALL_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+
+# Aynı public key her worker'da aynı vault user_id'sine (hash()) düşmeli
+HASH_SEED = os.getenv("PYTHONHASHSEED", "0")
+ADMIN_API_TOKEN = os.getenv("WHALEER_ADMIN_API_TOKEN") or os.urandom(16).hex()
+
+
+# ============== CONSISTENT HASHING ==============
+
+class NoShardsAvailable(RuntimeError):
+    pass
+
+
+class HashRing:
+    """Immutable ring; membership changes build a new ring, so lookups need no lock"""
+
+    def __init__(self, nodes=(), vnodes: int = VIRTUAL_NODES):
+        self.nodes = tuple(sorted(nodes))
+        self.vnodes = vnodes
+        points = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(vnodes)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def owner(self, key: str) -> str:
+        if not self.points:
+            raise NoShardsAvailable("No shard workers")
+        return self.owners[bisect(self.points, self._hash(key)) % len(self.points)]
+
+
+# ============== WORKERS ==============
+
+class Worker:
+    """One api/index.py process owning a slice of the wallets"""
+
+    def __init__(self, name: str, port: int):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.http = requests.Session()
+        self.process = None
+
+    def start(self):
+        env = dict(
+            os.environ,
+            PYTHONHASHSEED=HASH_SEED,
+            WHALEER_PORT=str(self.port),
+            WHALEER_DEBUG="0",
+            WHALEER_SHARD_ID=self.name,
+            WHALEER_ADMIN_API_TOKEN=ADMIN_API_TOKEN,
+        )
+        # Dosyaya yazan state (outbox, spill) shard başına ayrı dosyada tutulur;
+        # outbox varsayılan olarak açık olduğu için varsayılan yolu da ayrılır
+        env.setdefault("WHALEER_SETTLEMENT_OUTBOX_PATH", os.path.join(API_DIR, "settlement_outbox.jsonl"))
+        # WHALEER_ARCHIVE_PATH bilerek paylaşılır (flock + artımlı index okuma), böylece
+        # shard değiştiren bir cüzdanın arşivi yeni shard'dan da okunabilir
+        for var in ("WHALEER_SETTLEMENT_OUTBOX_PATH", "WHALEER_SESSION_SPILL_PATH"):
+            if env.get(var):
+                env[var] = f"{env[var]}.{self.name}"
+
+        self.process = subprocess.Popen([sys.executable, "index.py"], cwd=API_DIR, env=env)
+        deadline = time.time() + WORKER_START_TIMEOUT_SECONDS
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with code {self.process.returncode}")
+            try:
+                if self.http.get(f"{self.url}/health", timeout=1).ok:
+                    print(f"[SHARD] {self.name} ready on :{self.port} (pid {self.process.pid})")
+                    return
+            except requests.RequestException:
+                time.sleep(0.2)
+        raise RuntimeError(f"{self.name} did not become ready")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+    def admin(self, method: str, path: str, timeout: float = 30, **kwargs):
+        response = self.http.request(
+            method, f"{self.url}{path}", headers={"X-Admin-Token": ADMIN_API_TOKEN}, timeout=timeout, **kwargs
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+class Dispatcher:
+    """
+    Routes wallets to their owning worker and moves sessions on membership
+    changes. The only shared state here is routing (ring swap, wallets being
+    moved, in-flight counts); session data is never touched by two workers.
+    """
+
+    def __init__(self, base_port: int):
+        self.base_port = base_port
+        self.workers = {}
+        self.ring = HashRing()
+        self.next_id = 0
+        self.cond = threading.Condition()
+        self.paused = False
+        self.migrating = set()
+        self.inflight = Counter()
+        self.round_robin = 0
+        self.membership_lock = threading.Lock()
+
+    # ---------- routing ----------
+
+    def acquire(self, wallet: str = None, track: bool = True) -> Worker:
+        """Owning worker for a wallet (any worker for keyless routes)"""
+        with self.cond:
+            if wallet is None:
+                names = self.ring.nodes
+                if not names:
+                    raise NoShardsAvailable("No shard workers")
+                self.round_robin += 1
+                return self.workers[names[self.round_robin % len(names)]]
+
+            while self.paused or wallet in self.migrating:
+                self.cond.wait()
+            worker = self.workers[self.ring.owner(wallet)]
+            if track:
+                self.inflight[wallet] += 1
+            return worker
+
+    def release(self, wallet: str):
+        with self.cond:
+            self.inflight[wallet] -= 1
+            if self.inflight[wallet] <= 0:
+                del self.inflight[wallet]
+            self.cond.notify_all()
+
+    # ---------- membership ----------
+
+    def add_worker(self) -> Worker:
+        with self.membership_lock:
+            name = f"shard-{self.next_id}"
+            worker = Worker(name, self.base_port + self.next_id)
+            self.next_id += 1
+            worker.start()
+            self.workers[name] = worker
+            self._rebalance(self.ring.nodes + (name,))
+            return worker
+
+    def remove_worker(self, name: str):
+        with self.membership_lock:
+            if name not in self.workers:
+                raise KeyError(name)
+            if len(self.workers) == 1:
+                raise ValueError("Cannot remove the last worker")
+            self._rebalance(tuple(node for node in self.ring.nodes if node != name))
+            # Outbox dosyası bir daha açılmayacak: kalan settlement state'i durdurmadan önce devredilir
+            self._hand_over_settlements(self.workers[name])
+            self.workers.pop(name).stop()
+
+    def _hand_over_settlements(self, worker: Worker):
+        """Move every vault ledger still on a leaving worker to the owner of its wallet"""
+        payload = {"keys": [], "all_settlements": True}
+        vaults = worker.admin("POST", "/admin/sessions/export", json=payload, timeout=EXPORT_TIMEOUT_SECONDS)["settlements"]
+        by_owner = {}
+        for vault in vaults:
+            public_key = vault["entry"].get("public_key")
+            owner = self.ring.owner(public_key) if public_key else self.ring.nodes[0]
+            by_owner.setdefault(owner, []).append(vault)
+
+        for owner, owned in by_owner.items():
+            try:
+                self.workers[owner].admin("POST", "/admin/sessions/import", json={"settlements": owned})
+            except requests.RequestException as e:
+                # Geri konur ve worker çalışır bırakılır: kendi settlement worker'ı ödemeye devam eder
+                try:
+                    worker.admin("POST", "/admin/sessions/import", json={"settlements": owned})
+                except requests.RequestException:
+                    path = save_rescued_sessions(worker.name, owner, {"settlements": owned})
+                    raise RuntimeError(f"Settlement handover to {owner} failed ({e}); saved to {path}")
+                raise RuntimeError(f"Settlement handover to {owner} failed ({e}); "
+                                   f"{worker.name} left running outside the ring")
+        if vaults:
+            print(f"[SHARD] Handed {len(vaults)} remaining settlement vaults over from {worker.name}")
+
+    def _rebalance(self, nodes: tuple):
+        """Swap in a ring over `nodes` and move every session whose owner changed"""
+        new_ring = HashRing(nodes)
+        if not self.ring.nodes:
+            self.ring = new_ring
+            return
+
+        # Kısa bir duraklama: sahiplik listesi alınırken yeni session oluşmasın
+        with self.cond:
+            self.paused = True
+            while self.inflight:
+                self.cond.wait()
+        try:
+            moves = {}
+            for name in self.ring.nodes:
+                for wallet in self.workers[name].admin("GET", "/admin/sessions/keys")["keys"]:
+                    owner = new_ring.owner(wallet)
+                    if owner != name:
+                        moves.setdefault((name, owner), []).append(wallet)
+            with self.cond:
+                self.migrating = {wallet for wallets in moves.values() for wallet in wallets}
+                self.ring = new_ring
+        finally:
+            with self.cond:
+                self.paused = False
+                self.cond.notify_all()
+
+        try:
+            for (source, target), wallets in moves.items():
+                exported = self.workers[source].admin(
+                    "POST", "/admin/sessions/export", json={"keys": wallets}, timeout=EXPORT_TIMEOUT_SECONDS
+                )
+                payload = {"sessions": exported["sessions"], "settlements": exported["settlements"]}
+                try:
+                    self.workers[target].admin("POST", "/admin/sessions/import", json=payload)
+                except requests.RequestException as e:
+                    # Hedef almadıysa session'ları eski sahibine geri koy, kaybolmasın
+                    print(f"[SHARD] Import into {target} failed ({e}), restoring on {source}")
+                    try:
+                        self.workers[source].admin("POST", "/admin/sessions/import", json=payload)
+                    except requests.RequestException as e:
+                        path = save_rescued_sessions(source, target, payload)
+                        print(f"[SHARD] Restore on {source} failed too ({e}): {len(payload['sessions'])} sessions "
+                              f"saved to {path}; POST it to /admin/sessions/import on the owning shard")
+                        continue
+                print(f"[SHARD] Moved {len(payload['sessions'])} sessions and "
+                      f"{len(payload['settlements'])} settlement vaults {source} -> {target}")
+        finally:
+            with self.cond:
+                self.migrating = set()
+                self.cond.notify_all()
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    def describe(self):
+        return [
+            {
+                "name": worker.name,
+                "port": worker.port,
+                "pid": worker.process.pid if worker.process else None,
+                "alive": bool(worker.process and worker.process.poll() is None),
+                "in_ring": worker.name in self.ring.nodes,
+            }
+            for worker in self.workers.values()
+        ]
+
+
+def save_rescued_sessions(source: str, target: str, payload: dict) -> str:
+    """Durably write an exported payload nobody accepted; returns the file path"""
+    path = os.path.join(RESCUE_DIR, f"shard-rescue-{int(time.time() * 1000)}-{source}-{target}.json")
+    with open(path, "w") as f:
+        json.dump(payload, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return path
+
+
+# ============== DISPATCHER APP ==============
+
+app = Flask(__name__)
+dispatcher = None
+
+
+def wallet_of(req) -> str:
+    wallet = req.args.get('public_key') or req.args.get('user_public_key')
+    if wallet:
+        return wallet
+    data = req.get_json(silent=True)
+    if isinstance(data, dict):
+        return data.get('user_public_key') or data.get('public_key')
+    return None
+
+
+def proxy(worker: Worker, path: str, on_close=None):
+    url = f"{worker.url}/{path}"
+    if request.query_string:
+        url += "?" + request.query_string.decode()
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_HEADERS}
+
+    try:
+        upstream = worker.http.request(
+            request.method, url, data=request.get_data(), headers=headers, stream=True, timeout=(5, None)
+        )
+    except requests.RequestException as e:
+        if on_close:
+            on_close()
+        return jsonify({"success": False, "error": f"Shard {worker.name} unavailable: {e}"}), 502
+
+    response = Response(
+        upstream.iter_content(chunk_size=None),
+        status=upstream.status_code,
+        headers=[(key, value) for key, value in upstream.headers.items() if key.lower() not in HOP_HEADERS],
+    )
+    response.call_on_close(upstream.close)
+    if on_close:
+        response.call_on_close(on_close)
+    return response
+
+
+def require_admin():
+    if request.headers.get('X-Admin-Token') != ADMIN_API_TOKEN:
+        return jsonify({"success": False, "error": "Forbidden"}), 403
+    return None
+
+
+@app.route('/admin/shards', methods=['GET', 'POST'])
+def shards():
+    """List shard workers; POST starts one more and rebalances"""
+    denied = require_admin()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        worker = dispatcher.add_worker()
+        return jsonify({"success": True, "added": worker.name, "shards": dispatcher.describe()})
+    return jsonify({"success": True, "virtual_nodes": VIRTUAL_NODES, "shards": dispatcher.describe()})
+
+
+@app.route('/admin/shards/<name>', methods=['DELETE'])
+def remove_shard(name):
+    """Move a worker's sessions to the remaining shards and stop it"""
+    denied = require_admin()
+    if denied:
+        return denied
+    try:
+        dispatcher.remove_worker(name)
+    except KeyError:
+        return jsonify({"success": False, "error": "Shard not found"}), 404
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except (RuntimeError, requests.RequestException) as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True, "removed": name, "shards": dispatcher.describe()})
+
+
+@app.route('/admin/<path:path>', methods=ALL_METHODS)
+def fan_out_admin(path):
+    """Admin routes report per-process state, so ask every shard"""
+    denied = require_admin()
+    if denied:
+        return denied
+
+    results = {}
+    texts = []
+    for worker in list(dispatcher.workers.values()):
+        upstream = worker.http.request(
+            request.method, f"{worker.url}/admin/{path}", params=request.args, data=request.get_data(),
+            headers={"X-Admin-Token": ADMIN_API_TOKEN, "Content-Type": request.content_type or "application/json"},
+            timeout=30,
+        )
+        if upstream.headers.get("Content-Type", "").startswith("application/json"):
+            results[worker.name] = upstream.json()
+        else:
+            texts.append(upstream.text)  # Collapsed stack dump'ları satır satır birleştirilebilir
+
+    if texts and not results:
+        return Response("".join(texts), mimetype="text/plain")
+    return jsonify({
+        "success": all(result.get("success", False) for result in results.values()),
+        "shards": results,
+    })
+
+
+@app.route('/', defaults={'path': ''}, methods=ALL_METHODS)
+@app.route('/<path:path>', methods=ALL_METHODS)
+def forward(path):
+    wallet = wallet_of(request)
+    # Açık SSE stream'leri rebalance'ı bekletmesin; taşınan session'da stream kapanır ve yeniden bağlanır
+    track = wallet is not None and path != "status/stream"
+    try:
+        worker = dispatcher.acquire(wallet, track=track)
+    except NoShardsAvailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    if wallet is None:
+        return proxy(worker, path)
+    return proxy(worker, path, on_close=(lambda: dispatcher.release(wallet)) if track else None)
+
+
+def main():
+    global dispatcher
+    parser = argparse.ArgumentParser(description="Run the backend as N session-sharded worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Worker processes (default: CPU count)")
+    parser.add_argument("--port", type=int, default=5328, help="Dispatcher port (default: 5328)")
+    parser.add_argument("--base-port", type=int, default=5400, help="First worker port (default: 5400)")
+    args = parser.parse_args()
+
+    dispatcher = Dispatcher(args.base_port)
+    atexit.register(dispatcher.stop)
+    for _ in range(max(args.workers, 1)):
+        dispatcher.add_worker()
+
+    if not os.getenv("WHALEER_ADMIN_API_TOKEN"):
+        print("[SHARD] WHALEER_ADMIN_API_TOKEN not set; admin routes use a generated token")
+    print(f"🐋 Dispatcher on http://127.0.0.1:{args.port} -> {len(dispatcher.workers)} shards")
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Toplu vault oluşturma (bulk init_vault).
+
+Girdi: CSV (başlıklı) veya JSONL satırları
+    bot_id, user_id, user_address, developer, profit_share_rate, platform_cut_rate
+
+- Zaten var olan vault'lar get_vault simülasyonu ile tespit edilip atlanır.
+- İşlemler sınırlı eşzamanlılıkla gönderilir. Her kaynak hesap (admin veya
+  WHALEER_CHANNEL_SECRETS ile verilen channel hesapları) kendi sequence
+  numarasını lokal olarak yönetir: sadece imzala+gönder adımı hesap başına
+  sıralıdır, onay beklemesi (poll) dışarıda yapılır. Admin yetkisi channel
+  kullanılırken auth entry imzası ile verilir.
+- Stellar Core kaynak hesap başına kuyrukta tek işlem kabul eder; fazlası
+  TRY_AGAIN_LATER alır. Bu yüzden --in-flight varsayılanı 1'dir ve
+  throughput channel hesabı eklenerek ölçeklenir:
+      WHALEER_CHANNEL_SECRETS=S...1,S...2,S...3,S...4 python bulk_init_vault.py ...
+  TRY_AGAIN_LATER bir back-pressure sinyalidir (hesabın kuyruğu dolu),
+  daha yüksek --in-flight için bir gerekçe değildir.
+- İlerleme checkpoint dosyasına (JSONL) yazılır, yarıda kalan bir çalıştırma
+  aynı checkpoint ile devam ettirilebilir.
+
+Kullanım:
+    python bulk_init_vault.py vaults.csv --checkpoint vaults.checkpoint.jsonl --concurrency 8
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from stellar_sdk import Account, Keypair, TransactionBuilder, scval, xdr as stellar_xdr
+from stellar_sdk.auth import authorize_entry
+from stellar_sdk.soroban_rpc import GetTransactionStatus, SendTransactionStatus
+
+from init_vault import (
+    ADMIN_PUBLIC,
+    ADMIN_SECRET,
+    ASSET_CONTRACT,
+    NETWORK_PASSPHRASE,
+    VAULT_CONTRACT_ID,
+    build_init_vault_args,
+    horizon_server,
+    soroban_server,
+)
+
+# Admin dışında işlem kaynağı olarak kullanılacak channel hesapları (virgülle ayrılmış secret'lar)
+CHANNEL_SECRETS = [s for s in os.getenv("WHALEER_CHANNEL_SECRETS", "").split(",") if s]
+
+POLL_ATTEMPTS = 30
+SEND_ATTEMPTS = 10  # TRY_AGAIN_LATER (back-pressure: hesabın kuyruğu dolu) için yeniden deneme
+AUTH_VALID_LEDGERS = 100
+PROGRESS_INTERVAL_SECONDS = 5
+
+
+# ============== GİRDİ / CHECKPOINT ==============
+
+def read_rows(path: str):
+    """CSV veya JSONL dosyasından vault satırlarını okur"""
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    return [
+        {
+            "bot_id": int(row["bot_id"]),
+            "user_id": int(row["user_id"]),
+            "user_address": row["user_address"],
+            "developer": row["developer"],
+            "profit_share_rate": row.get("profit_share_rate") or 10,
+            "platform_cut_rate": row.get("platform_cut_rate") or 10,
+        }
+        for row in rows
+    ]
+
+
+def row_key(row: dict) -> str:
+    return f"{row['bot_id']}:{row['user_id']}"
+
+
+def load_checkpoint(path: str):
+    """Daha önce tamamlanmış (created / exists) vault anahtarları"""
+    done = set()
+    if not path or not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Yarım yazılmış son satır
+            if record.get("status") in ("created", "exists"):
+                done.add(record["key"])
+    return done
+
+
+class Checkpoint:
+    """Append-only JSONL ilerleme kaydı (thread-safe)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a") if path else None
+
+    def record(self, key: str, status: str, **extra):
+        if not self.file:
+            return
+        with self.lock:
+            self.file.write(json.dumps({"key": key, "status": status, "at": time.time(), **extra}) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+# ============== KAYNAK HESAPLAR (SEQUENCE YÖNETİMİ) ==============
+
+class ChannelAccount:
+    """
+    İşlem kaynağı hesap. Sequence numarası bir kez Horizon'dan yüklenir,
+    sonra lokal olarak artırılır; sadece txBadSeq durumunda yeniden senkronlanır.
+    send_lock yalnızca sequence atama + imzalama + gönderme adımını kapsar, böylece
+    işlemler ağa sequence sırasıyla ulaşır; in_flight aynı anda onay bekleyen
+    işlem sayısını sınırlar.
+    """
+
+    def __init__(self, secret: str, max_in_flight: int = 1):
+        self.keypair = Keypair.from_secret(secret)
+        self.sequence = None
+        self.send_lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.backpressure = 0  # TRY_AGAIN_LATER sayısı
+
+    def sync(self):
+        self.sequence = horizon_server.load_account(self.keypair.public_key).sequence
+
+    def placeholder_account(self) -> Account:
+        """Simülasyon / prepare için; gerçek sequence gönderimden hemen önce atanır"""
+        return Account(self.keypair.public_key, 0)
+
+    def send(self, tx):
+        """Sıradaki sequence'ı ata, imzala ve gönder (send_lock altında); send response döndürür"""
+        with self.send_lock:
+            if self.sequence is None:
+                self.sync()
+            for attempt in range(SEND_ATTEMPTS):
+                tx.transaction.sequence = self.sequence + 1
+                tx.signatures = []
+                tx.sign(self.keypair)
+
+                send_resp = soroban_server.send_transaction(tx)
+                if send_resp.status == SendTransactionStatus.TRY_AGAIN_LATER:
+                    # Back-pressure: hesabın önceki işlemi hâlâ kuyrukta. Sequence tüketilmedi,
+                    # aynı numara ile geri çekilerek tekrar (send_lock bilerek tutulur:
+                    # bu hesaptan gönderilecek her işlem aynı cevabı alırdı)
+                    self.backpressure += 1
+                    time.sleep(1 + attempt)
+                    continue
+                if send_resp.status == SendTransactionStatus.ERROR:
+                    if is_bad_seq(send_resp.error_result_xdr):
+                        self.sync()
+                    raise RuntimeError(f"Transaction Failed: {send_resp.error_result_xdr}")
+                self.sequence += 1  # PENDING / DUPLICATE: numara tüketildi
+                return send_resp
+
+        raise RuntimeError("RPC busy (TRY_AGAIN_LATER)")
+
+
+def is_bad_seq(error_result_xdr: str) -> bool:
+    try:
+        result = stellar_xdr.TransactionResult.from_xdr(error_result_xdr)
+    except Exception:
+        return False
+    return result.result.code == stellar_xdr.TransactionResultCode.txBAD_SEQ
+
+
+# ============== KONTRAT ÇAĞRILARI ==============
+
+def vault_exists(bot_id: int, user_id: int, source_public_key: str) -> bool:
+    """get_vault simülasyonu: vault yoksa kontrat 'Vault not found' ile panikler"""
+    tx = (
+        TransactionBuilder(
+            source_account=Account(source_public_key, 0),
+            network_passphrase=NETWORK_PASSPHRASE,
+            base_fee=100,
+        )
+        .set_timeout(30)
+        .append_invoke_contract_function_op(
+            contract_id=VAULT_CONTRACT_ID,
+            function_name="get_vault",
+            parameters=[scval.to_uint64(bot_id), scval.to_uint64(user_id)],
+        )
+        .build()
+    )
+    sim_resp = soroban_server.simulate_transaction(tx)
+    return not sim_resp.error
+
+
+def sign_admin_auth(sim_resp, admin_kp: Keypair):
+    """Channel hesabı kaynakken admin.require_auth() için auth entry'leri imzalar"""
+    entries = []
+    for entry_xdr in sim_resp.results[0].auth:
+        entry = stellar_xdr.SorobanAuthorizationEntry.from_xdr(entry_xdr)
+        if entry.credentials.type == stellar_xdr.SorobanCredentialsType.SOROBAN_CREDENTIALS_ADDRESS:
+            entry = authorize_entry(
+                entry, admin_kp, sim_resp.latest_ledger + AUTH_VALID_LEDGERS, NETWORK_PASSPHRASE
+            )
+        entries.append(entry)
+    return entries
+
+
+def build_init_vault_tx(channel: ChannelAccount, args: list, auth=None):
+    return (
+        TransactionBuilder(
+            source_account=channel.placeholder_account(),
+            network_passphrase=NETWORK_PASSPHRASE,
+            base_fee=100,
+        )
+        .set_timeout(60)
+        .append_invoke_contract_function_op(
+            contract_id=VAULT_CONTRACT_ID,
+            function_name="init_vault",
+            parameters=args,
+            auth=auth,
+        )
+        .build()
+    )
+
+
+def submit_init_vault(row: dict, channel: ChannelAccount, admin_kp: Keypair) -> str:
+    """
+    Tek vault için init_vault gönderir ve onayı bekler, tx hash döndürür.
+    Simülasyon ve poll kanal kilidi dışında; sadece channel.send sıralı.
+    """
+    args = build_init_vault_args(
+        row["bot_id"],
+        row["user_id"],
+        row["user_address"],
+        row["developer"],
+        row["profit_share_rate"],
+        row["platform_cut_rate"],
+    )
+
+    tx = build_init_vault_tx(channel, args)
+    if channel.keypair.public_key != admin_kp.public_key:
+        sim_resp = soroban_server.simulate_transaction(tx)
+        if sim_resp.error:
+            raise RuntimeError(f"Simülasyon Başarısız: {sim_resp.error}")
+        tx = build_init_vault_tx(channel, args, auth=sign_admin_auth(sim_resp, admin_kp))
+
+    tx = soroban_server.prepare_transaction(tx)
+    send_resp = channel.send(tx)
+
+    for _ in range(POLL_ATTEMPTS):
+        time.sleep(1)
+        result = soroban_server.get_transaction(send_resp.hash)
+        if result.status == GetTransactionStatus.SUCCESS:
+            return send_resp.hash
+        if result.status == GetTransactionStatus.FAILED:
+            raise RuntimeError(f"Transaction FAILED: {send_resp.hash}")
+
+    raise RuntimeError(f"Timeout: {send_resp.hash}")
+
+
+# ============== TOPLU ÇALIŞTIRMA ==============
+
+class Progress:
+    def __init__(self, total: int):
+        self.total = total
+        self.counts = {"created": 0, "exists": 0, "missing": 0, "failed": 0}
+        self.started = time.time()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def add(self, status: str):
+        with self.lock:
+            self.counts[status] += 1
+            now = time.time()
+            if now - self.last_report >= PROGRESS_INTERVAL_SECONDS:
+                self.last_report = now
+                print(self.summary())
+
+    def summary(self) -> str:
+        elapsed = max(time.time() - self.started, 1e-9)
+        processed = sum(self.counts.values())
+        rate = processed / elapsed
+        eta = (self.total - processed) / rate if rate else 0
+        return (
+            f"📊 {processed}/{self.total} | created={self.counts['created']} "
+            f"exists={self.counts['exists']} missing={self.counts['missing']} "
+            f"failed={self.counts['failed']} | "
+            f"{rate:.2f} vault/s | created {self.counts['created'] / elapsed:.2f} tx/s | ETA {eta:.0f}s"
+        )
+
+
+def provision(rows: list, checkpoint: Checkpoint, concurrency: int, dry_run: bool = False,
+              in_flight: int = 1):
+    if not (VAULT_CONTRACT_ID and ADMIN_SECRET and ASSET_CONTRACT):
+        raise RuntimeError("Vault contract ENV'leri eksik.")
+
+    admin_kp = Keypair.from_secret(ADMIN_SECRET)
+    channels = [ChannelAccount(secret, in_flight) for secret in (CHANNEL_SECRETS or [ADMIN_SECRET])]
+    if in_flight > 1:
+        print(f"⚠️ --in-flight {in_flight}: Stellar Core queues one transaction per source account, "
+              f"extra ones will be back-pressured (TRY_AGAIN_LATER). Add WHALEER_CHANNEL_SECRETS to scale.")
+    next_channel = itertools.count()
+
+    progress = Progress(len(rows))
+
+    def handle(row: dict):
+        key = row_key(row)
+        try:
+            if vault_exists(row["bot_id"], row["user_id"], ADMIN_PUBLIC):
+                checkpoint.record(key, "exists")
+                progress.add("exists")
+                return
+            if dry_run:
+                progress.add("missing")
+                return
+
+            # Hesaplar sırayla dağıtılır; her hesapta en fazla in_flight işlem onay bekler
+            channel = channels[next(next_channel) % len(channels)]
+            with channel.in_flight:
+                tx_hash = submit_init_vault(row, channel, admin_kp)
+
+            checkpoint.record(key, "created", hash=tx_hash)
+            progress.add("created")
+        except Exception as e:
+            print(f"🔴 [{key}] {e}")
+            checkpoint.record(key, "failed", error=str(e))
+            progress.add("failed")
+
+    # Varlık kontrolü (simülasyon) channel sayısından bağımsız paralel çalışır
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in as_completed([executor.submit(handle, row) for row in rows]):
+            future.result()
+
+    print(progress.summary())
+    backpressure = sum(channel.backpressure for channel in channels)
+    if backpressure:
+        print(f"⏳ TRY_AGAIN_LATER {backpressure}x over {len(channels)} source account(s); "
+              f"add channel accounts (WHALEER_CHANNEL_SECRETS) for more throughput")
+    return progress.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk init_vault provisioning")
+    parser.add_argument("input", help="CSV (with header) or .jsonl file of vault rows")
+    parser.add_argument("--checkpoint", help="JSONL progress file; reruns skip completed vaults")
+    parser.add_argument("--concurrency", type=int, default=8, help="Parallel workers (default: 8)")
+    parser.add_argument("--in-flight", type=int, default=1,
+                        help="Transactions awaiting confirmation per source account (default: 1; Stellar Core "
+                             "queues one per account, so scale with WHALEER_CHANNEL_SECRETS instead)")
+    parser.add_argument("--dry-run", action="store_true", help="Only check which vaults already exist")
+    args = parser.parse_args()
+
+    rows = read_rows(args.input)
+    done = load_checkpoint(args.checkpoint)
+    pending = [row for row in rows if row_key(row) not in done]
+    print(f"🚀 {len(pending)} vault to process ({len(rows) - len(pending)} skipped from checkpoint)")
+
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        counts = provision(pending, checkpoint, args.concurrency, args.dry_run, args.in_flight)
+    finally:
+        checkpoint.close()
+
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
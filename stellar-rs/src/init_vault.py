@@ -25,6 +25,39 @@ ASSET_CONTRACT = os.getenv("NATIVE_TOKEN_CONTRACT_ID")  # Native XLM Contract ID
 soroban_server = SorobanServer(RPC_URL)
 horizon_server = Server(HORIZON_URL)
 
+def build_init_vault_args(
+    bot_id: int,
+    user_id: int,
+    user_address: str,
+    developer_address: str,
+    profit_share_rate: Decimal | float | int,
+    platform_cut_rate: Decimal | float | int = 10,
+):
+    """
+    init_vault argümanlarını (scval) hazırlar, oranları % → bps çevirip doğrular.
+    fn init_vault(env, bot_id, user_id, user_address, developer, platform, asset, profit_share_bps, platform_cut_bps)
+    """
+    # % → bps (ör: 15 → 1500)
+    profit_bps = int(Decimal(str(profit_share_rate)) * 100)
+    platform_bps = int(Decimal(str(platform_cut_rate)) * 100)
+
+    if profit_bps < 0 or platform_bps < 0:
+        raise ValueError("Profit share ve platform cut negatif olamaz.")
+    if profit_bps > 10_000 or platform_bps > 10_000:
+        raise ValueError("Oranlar %100 (10000 bps) üzerinde olamaz.")
+
+    return [
+        scval.to_uint64(bot_id),
+        scval.to_uint64(user_id),
+        scval.to_address(user_address),
+        scval.to_address(developer_address),
+        scval.to_address(ADMIN_PUBLIC),
+        scval.to_address(ASSET_CONTRACT),
+        scval.to_uint32(profit_bps),
+        scval.to_uint32(platform_bps),
+    ]
+
+
 def init_vault_on_chain(
     bot_id: int,
     user_id: int,
@@ -49,14 +82,10 @@ def init_vault_on_chain(
     if not (VAULT_CONTRACT_ID and ADMIN_SECRET and ASSET_CONTRACT):
         raise RuntimeError("Vault contract ENV'leri eksik.")
 #
-    # % → bps (ör: 15 → 1500)
-    profit_bps = int(Decimal(str(profit_share_rate)) * 100)
-    platform_bps = int(Decimal(str(platform_cut_rate)) * 100)
-#
-    if profit_bps < 0 or platform_bps < 0:
-        raise ValueError("Profit share ve platform cut negatif olamaz.")
-    if profit_bps > 10_000 or platform_bps > 10_000:
-        raise ValueError("Oranlar %100 (10000 bps) üzerinde olamaz.")
+    # Argümanları Hazırla (scval kullanarak) — oran doğrulaması ağ çağrısından önce
+    args = build_init_vault_args(
+        bot_id, user_id, user_address, developer_address, profit_share_rate, platform_cut_rate
+    )
 #
     # Admin Keypair
     admin_kp = Keypair.from_secret(ADMIN_SECRET)
@@ -66,19 +95,6 @@ def init_vault_on_chain(
         source_account = horizon_server.load_account(admin_kp.public_key)
     except Exception as e:
         raise RuntimeError(f"Admin hesabı yüklenemedi (Horizon hatası): {e}")
-#
-    # 2. Argümanları Hazırla (scval kullanarak)
-    # fn init_vault(env, bot_id, user_id, user_address, developer, platform, asset, profit_share_bps, platform_cut_bps)
-    args = [
-        scval.to_uint64(bot_id),
-        scval.to_uint64(user_id),
-        scval.to_address(user_address),
-        scval.to_address(developer_address),
-        scval.to_address(ADMIN_PUBLIC), 
-        scval.to_address(ASSET_CONTRACT),
-        scval.to_uint32(profit_bps),
-        scval.to_uint32(platform_bps),
-    ]
 #
     # 3. İşlemi Oluştur (TransactionBuilder)
     tx = (
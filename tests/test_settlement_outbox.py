@@ -0,0 +1,120 @@
+"""
+Settlement outbox replay: a batch that was submitted before a restart must be
+confirmed through its recorded tx hash, never paid a second time.
+"""
+
+import json
+import os
+import sys
+import time
+
+import pytest
+
+os.environ.setdefault("WHALEER_SETTLEMENT_OUTBOX_PATH", "")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import index  # noqa: E402
+from stellar_sdk.soroban_rpc import GetTransactionStatus  # noqa: E402
+
+KEY = (0, 7)
+
+
+def restart():
+    """Forget the in-memory ledger as a process restart would"""
+    index.settlement_outbox = None
+    index.settlement_ledger.clear()
+    del index.settlement_dead_letters[:]
+
+
+@pytest.fixture
+def outbox_path(tmp_path, monkeypatch):
+    path = tmp_path / "settlement_outbox.jsonl"
+    monkeypatch.setattr(index, "SETTLEMENT_OUTBOX_PATH", str(path))
+    monkeypatch.setattr(index, "settlement_thread", object())  # Arka plan worker'ı başlatma
+    monkeypatch.setattr(index, "publish_session_event", lambda *args, **kwargs: None)
+    restart()
+    yield path
+    restart()
+
+
+def write_records(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def in_flight_records(expires_at):
+    now = time.time()
+    return [
+        {"op": "accrue", "key": list(KEY), "profit_xlm": 12.5, "commission_xlm": 2.5,
+         "public_key": "GTEST", "at": now - 60},
+        {"op": "claim", "key": list(KEY), "id": "batch-1", "profit_xlm": 12.5, "commission_xlm": 2.5,
+         "reason": "withdraw", "at": now - 30},
+        {"op": "submitted", "key": list(KEY), "id": "batch-1", "tx_hash": "ab" * 32,
+         "expires_at": expires_at, "at": now - 29},
+    ]
+
+
+def test_replayed_in_flight_batch_is_confirmed_by_hash(outbox_path, monkeypatch):
+    write_records(outbox_path, in_flight_records(time.time() + 240))
+    index.get_settlement_outbox()
+
+    batch = index.settlement_ledger[KEY]['in_flight']
+    assert batch['id'] == "batch-1" and batch['tx_hash'] == "ab" * 32
+
+    polled = []
+    monkeypatch.setattr(index, "poll_transaction",
+                        lambda tx_hash, attempts=30: polled.append(tx_hash) or (GetTransactionStatus.SUCCESS, None))
+
+    def no_resend(*args):
+        raise AssertionError("a submitted batch must not be rebuilt")
+
+    monkeypatch.setattr(index, "contract_settle_profit", no_resend)
+    index.process_settlement_batch(*KEY)
+
+    assert polled == ["ab" * 32]
+    entry = index.settlement_ledger[KEY]
+    assert entry['in_flight'] is None
+    assert entry['settled_profit_xlm'] == pytest.approx(12.5)
+    assert entry['last_settle_tx'] == "ab" * 32
+
+    # Onaylanan batch ikinci bir restart'ta yeniden uçuşa girmez
+    restart()
+    index.get_settlement_outbox()
+    assert KEY not in index.settlement_ledger or index.settlement_ledger[KEY]['in_flight'] is None
+
+
+def test_replayed_batch_still_pending_on_chain_stays_in_flight(outbox_path, monkeypatch):
+    write_records(outbox_path, in_flight_records(time.time() + 240))
+    index.get_settlement_outbox()
+
+    monkeypatch.setattr(index, "poll_transaction",
+                        lambda tx_hash, attempts=30: (GetTransactionStatus.NOT_FOUND, None))
+    monkeypatch.setattr(index, "contract_settle_profit", lambda *args: pytest.fail("resent before expiry"))
+    index.process_settlement_batch(*KEY)
+
+    restart()
+    index.get_settlement_outbox()
+    batch = index.settlement_ledger[KEY]['in_flight']
+    assert batch['tx_hash'] == "ab" * 32  # Hash korunur, sonraki deneme yine ona bakar
+    assert batch['attempts'] == 1
+
+
+def test_compaction_drops_only_settled_out_vaults(outbox_path):
+    now = time.time()
+    write_records(outbox_path, in_flight_records(now + 240) + [
+        {"op": "accrue", "key": [1, 7], "profit_xlm": 3.0, "commission_xlm": 0.6, "public_key": "GTEST", "at": now},
+        {"op": "accrue", "key": [2, 7], "profit_xlm": 1.0, "commission_xlm": 0.2, "public_key": "GTEST", "at": now},
+        {"op": "claim", "key": [2, 7], "id": "batch-2", "profit_xlm": 1.0, "commission_xlm": 0.2,
+         "reason": "threshold", "at": now},
+        {"op": "settled", "key": [2, 7], "id": "batch-2", "tx_hash": "cd" * 32, "at": now},
+    ])
+    index.get_settlement_outbox()
+    assert set(index.settlement_ledger) == {KEY, (1, 7)}
+
+    assert index.compact_settlement_outbox(force=True)
+    restart()
+    index.get_settlement_outbox()
+    assert set(index.settlement_ledger) == {KEY, (1, 7)}
+    assert index.settlement_ledger[(1, 7)]['pending_profit_xlm'] == pytest.approx(3.0)
+    assert index.settlement_ledger[KEY]['in_flight']['tx_hash'] == "ab" * 32